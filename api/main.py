@@ -4,11 +4,38 @@ DICOM API - Sistema de análisis de imágenes médicas
 
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
 from fastapi.responses import JSONResponse
 import logging
 from pathlib import Path
 from config.paths import BASE_STATIC_DIR, SERIES_DIR, REPORTES_DIR, MODELOS3D_DIR
+from config.db_schema import asegurar_esquema
+from api.services.cache_service import estadisticas_caches
+from api.services.render_service import estadisticas_render
+from api.services.cas_service import estadisticas_cas
+from api.services.compresion_service import estadisticas_compresion
+from api.services.almacenamiento_service import estadisticas_almacenamiento
+from api.services.borrado_service import (
+    estadisticas_borrados,
+    iniciar_borrados,
+    detener_borrados,
+)
+from api.services.artefactos_service import (
+    estadisticas_artefactos,
+    iniciar_gc_artefactos,
+    detener_gc_artefactos,
+)
+from api.services.volumen_service import estadisticas_volumen
+from api.services.derivados_service import (
+    StaticConRegeneracion,
+    estadisticas_derivados,
+    iniciar_presupuesto_disco,
+    detener_presupuesto_disco,
+)
+from api.utils.executors import (
+    estadisticas_executors,
+    iniciar_monitor_event_loop,
+    detener_monitor_event_loop,
+)
 
 # Importar routers
 from api.routers import (
@@ -18,6 +45,10 @@ from api.routers import (
     modelos3d_router,
     pacientes_router,
     reportes_router,
+    upload_router,
+    visor_router,
+    metadatos_router,
+    mantenimiento_router,
 )
 
 # ============ Configuración de logging ============
@@ -65,8 +96,8 @@ BASE_STATIC_DIR = Path("/data/static")
 # Crear el directorio si no existe (persistente)
 BASE_STATIC_DIR.mkdir(parents=True, exist_ok=True)
 
-# Montar /static -> /data/static
-app.mount("/static", StaticFiles(directory=BASE_STATIC_DIR), name="static")
+# Montar /static -> /data/static (los derivados desalojados se regeneran al pedirlos)
+app.mount("/static", StaticConRegeneracion(directory=BASE_STATIC_DIR), name="static")
 
 
 
@@ -97,6 +128,21 @@ def health():
         "static_path": str(BASE_STATIC_DIR),
     }
 
+@app.get("/metrics")
+def metrics():
+    return {
+        "caches": estadisticas_caches(),
+        "render": estadisticas_render(),
+        "cas": estadisticas_cas(),
+        "compresion": estadisticas_compresion(),
+        "artefactos": estadisticas_artefactos(),
+        "derivados": estadisticas_derivados(),
+        "almacenamiento": estadisticas_almacenamiento(),
+        "borrados": estadisticas_borrados(),
+        "volumen": estadisticas_volumen(),
+        "executors": estadisticas_executors(),
+    }
+
 # ============ Incluir routers ============
 app.include_router(login_router.router, tags=["Auth"])
 app.include_router(dicom_router.router, tags=["DICOM"])
@@ -104,6 +150,10 @@ app.include_router(historial_router.router, tags=["Historial"])
 app.include_router(modelos3d_router.router, tags=["Modelos3D"])
 app.include_router(pacientes_router.router, tags=["Pacientes"])
 app.include_router(reportes_router.router, tags=["Reportes"])
+app.include_router(upload_router.router, tags=["Uploads"])
+app.include_router(visor_router.router, tags=["Visor"])
+app.include_router(metadatos_router.router, tags=["Metadatos"])
+app.include_router(mantenimiento_router.router, tags=["Mantenimiento"])
 
 # ============ Eventos ============
 @app.on_event("startup")
@@ -113,6 +163,22 @@ async def startup():
     logger.info(f"Static path persistente: {BASE_STATIC_DIR.absolute()}")
     logger.info("=" * 60)
 
+    # Migraciones antes que cualquier worker: sin esquema no se arranca
+    try:
+        asegurar_esquema()
+    except Exception as exc:
+        logger.error(f"No se pudieron aplicar las migraciones: {exc}")
+        raise
+
+    iniciar_monitor_event_loop()
+    iniciar_gc_artefactos()
+    iniciar_presupuesto_disco()
+    iniciar_borrados()
+
 @app.on_event("shutdown")
 async def shutdown():
     logger.info("Cerrando DICOM API")
+    detener_monitor_event_loop()
+    detener_gc_artefactos()
+    detener_presupuesto_disco()
+    detener_borrados()
@@ -1,7 +1,10 @@
 # api/routers/dicom_router.py
+import asyncio
+import io
 import tempfile
 import json
 import os
+import shutil
 from pathlib import Path
 from typing import Optional
 import pydicom
@@ -17,41 +20,50 @@ from fastapi import (
     HTTPException,
     Query
 )
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 
 from config.paths import SERIES_DIR
-from api.services.dicom_service import convert_dicom_zip_to_png_paths
+from api.services.cache_service import cargar_mapping
+from api.services.dicom_service import convert_dicom_zip_to_series
+from api.services.ingesta_service import (
+    iniciar_ingesta_series,
+    estado_ingesta,
+    eventos_desde,
+    respuesta_ingesta,
+)
 from api.services.segmentation3d_service import segmentar_serie_3d
+from api.utils.executors import ejecutar_cpu, ejecutar_io
 
 router = APIRouter()
 
+# Cada cuánto se revisan eventos nuevos al hacer streaming del progreso
+INTERVALO_EVENTOS_S = 0.25
+
 # ========== 1. Subir DICOM suelto ==========
 @router.post("/upload-dicom")
 async def upload_dicom(file: UploadFile = File(...)):
     try:
         contents = await file.read()
-        temp_dir = tempfile.mkdtemp()
-        temp_path = os.path.join(temp_dir, file.filename)
-
-        with open(temp_path, "wb") as f:
-            f.write(contents)
-
-        dcm = pydicom.dcmread(temp_path)
-
-        metadata = {
-            "PatientID": dcm.get("PatientID", "N/A"),
-            "StudyDate": dcm.get("StudyDate", "N/A"),
-            "Modality": dcm.get("Modality", "N/A"),
-            "Rows": dcm.get("Rows", "N/A"),
-            "Columns": dcm.get("Columns", "N/A"),
-        }
-
+        metadata = await ejecutar_io(_leer_metadata_dicom, contents)
         return {"message": "OK", "metadata": metadata}
 
     except Exception as e:
         return JSONResponse({"error": str(e)}, 500)
 
 
+def _leer_metadata_dicom(contents: bytes) -> dict:
+    # Solo cabecera y desde memoria: sin archivo temporal que limpiar
+    dcm = pydicom.dcmread(io.BytesIO(contents), stop_before_pixels=True)
+
+    return {
+        "PatientID": dcm.get("PatientID", "N/A"),
+        "StudyDate": dcm.get("StudyDate", "N/A"),
+        "Modality": dcm.get("Modality", "N/A"),
+        "Rows": dcm.get("Rows", "N/A"),
+        "Columns": dcm.get("Columns", "N/A"),
+    }
+
+
 # ========== 2. Subir ZIP serie DICOM ==========
 @router.post("/upload-dicom-series/")
 async def upload_dicom_series(
@@ -63,23 +75,95 @@ async def upload_dicom_series(
 
     try:
         zip_bytes = await file.read()
-        result = convert_dicom_zip_to_png_paths(zip_bytes, user_id=x_user_id)
+        result = await ejecutar_cpu(convert_dicom_zip_to_series, zip_bytes, user_id=x_user_id)
         return result
     except Exception as e:
         raise HTTPException(500, str(e))
 
 
+# ========== 2b. Subir ZIP serie DICOM (ingesta en segundo plano) ==========
+@router.post("/upload-dicom-series-async/", status_code=202)
+async def upload_dicom_series_async(
+    file: UploadFile = File(...),
+    x_user_id: int = Header(..., alias="X-User-Id"),
+):
+    if not file.filename.endswith(".zip"):
+        raise HTTPException(400, "Debe subir un ZIP")
+
+    try:
+        zip_path = await ejecutar_io(_guardar_upload_temporal, file.file)
+        sesiones = await ejecutar_io(iniciar_ingesta_series, zip_path, x_user_id, limpiar=zip_path)
+        return respuesta_ingesta(sesiones)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    except Exception as e:
+        raise HTTPException(500, str(e))
+
+
+@router.get("/ingesta/{session_id}")
+def get_estado_ingesta(session_id: str, x_user_id: int = Header(..., alias="X-User-Id")):
+    estado = estado_ingesta(session_id, x_user_id)
+    if estado is None:
+        return JSONResponse({"error": "Ingesta no encontrada"}, 404)
+    return estado
+
+
+@router.get("/ingesta/{session_id}/eventos")
+async def get_eventos_ingesta(
+    session_id: str,
+    x_user_id: int = Header(..., alias="X-User-Id"),
+    formato: str = Query("sse", pattern="^(sse|ndjson)$"),
+    last_event_id: Optional[str] = Header(None, alias="Last-Event-ID"),
+):
+    if eventos_desde(session_id, x_user_id) is None:
+        return JSONResponse({"error": "Ingesta no encontrada"}, 404)
+
+    desde = int(last_event_id) + 1 if last_event_id and last_event_id.isdigit() else 0
+
+    async def stream():
+        siguiente = desde
+        while True:
+            res = eventos_desde(session_id, x_user_id, siguiente)
+            if res is None:
+                return
+            eventos, terminado = res
+
+            for ev in eventos:
+                if formato == "sse":
+                    yield f"id: {ev['seq']}\nevent: {ev['tipo']}\ndata: {json.dumps(ev, ensure_ascii=False)}\n\n"
+                else:
+                    yield json.dumps(ev, ensure_ascii=False) + "\n"
+            if eventos:
+                # seq, no el número recibido: los eventos antiguos pueden haberse descartado
+                siguiente = eventos[-1]["seq"] + 1
+
+            if terminado and not eventos:
+                return
+            await asyncio.sleep(INTERVALO_EVENTOS_S)
+
+    media_type = "text/event-stream" if formato == "sse" else "application/x-ndjson"
+    return StreamingResponse(
+        stream(),
+        media_type=media_type,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def _guardar_upload_temporal(origen) -> str:
+    fd, zip_path = tempfile.mkstemp(suffix=".zip")
+    with os.fdopen(fd, "wb") as destino:
+        shutil.copyfileobj(origen, destino, length=1024 * 1024)
+    return zip_path
+
+
 # ========== 3. Obtener mapping ==========
 @router.get("/series-mapping/")
 def get_mapping(session_id: str = Query(...)):
-    mapping_path = SERIES_DIR / session_id / "mapping.json"
-
-    if not mapping_path.exists():
+    try:
+        return {"mapping": cargar_mapping(session_id)}
+    except FileNotFoundError:
         return JSONResponse({"error": "mapping.json no encontrado"}, 404)
 
-    with open(mapping_path, "r") as f:
-        return {"mapping": json.load(f)}
-
 
 # ========== 4. Segmentación desde mapping ==========
 @router.post("/segmentar-desde-mapping/")
@@ -87,13 +171,12 @@ async def segmentar_2d(
     session_id: str = Form(...),
     image_name: str = Form(...),
     x_user_id: int = Header(..., alias="X-User-Id"),
+    umbral: Optional[int] = Form(None),
+    min_size: Optional[int] = Form(None),
 ):
     try:
         series_path = SERIES_DIR / session_id
-        mapping_path = series_path / "mapping.json"
-
-        with open(mapping_path, "r") as f:
-            mapping = json.load(f)
+        mapping = await ejecutar_io(cargar_mapping, session_id)
 
         if image_name not in mapping:
             raise ValueError("imagen no encontrada en mapping")
@@ -102,14 +185,51 @@ async def segmentar_2d(
         archivodicomid = mapping[image_name]["archivodicomid"]
         dicom_path = series_path / dicom_name
 
-        from api.services.segmentation_services import segmentar_dicom
-        result = segmentar_dicom(str(dicom_path), archivodicomid, x_user_id)
+        from api.services.segmentation_services import segmentar_dicom, UMBRAL_2D, MIN_SIZE_2D
+        result = await ejecutar_cpu(
+            segmentar_dicom,
+            str(dicom_path),
+            archivodicomid,
+            x_user_id,
+            umbral=umbral if umbral is not None else UMBRAL_2D,
+            min_size=min_size if min_size is not None else MIN_SIZE_2D,
+        )
         return result
 
     except Exception as e:
         return JSONResponse({"error": str(e)}, 500)
 
 
+# ========== 4b. Segmentación 2D por lotes ==========
+@router.post("/segmentar-serie-2d/")
+async def segmentar_2d_lote(
+    session_id: str = Form(...),
+    image_names: Optional[str] = Form(None, description="Lista separada por comas; vacío = toda la serie"),
+    x_user_id: int = Header(..., alias="X-User-Id"),
+    umbral: Optional[int] = Form(None),
+    min_size: Optional[int] = Form(None),
+):
+    try:
+        nombres = None
+        if image_names:
+            nombres = [n.strip() for n in image_names.split(",") if n.strip()]
+
+        from api.services.segmentation_services import segmentar_serie_2d, UMBRAL_2D, MIN_SIZE_2D
+        return await ejecutar_cpu(
+            segmentar_serie_2d,
+            session_id,
+            x_user_id,
+            image_names=nombres,
+            umbral=umbral if umbral is not None else UMBRAL_2D,
+            min_size=min_size if min_size is not None else MIN_SIZE_2D,
+        )
+
+    except FileNotFoundError as e:
+        return JSONResponse({"error": str(e)}, 404)
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, 500)
+
+
 # ========== 5. Segmentación 3D ==========
 @router.post("/segmentar-serie-3d/")
 def seg3d(
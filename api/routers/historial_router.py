@@ -8,6 +8,7 @@ from api.services.historial_services import (
     listar_segmentaciones_por_session_id,
     eliminar_segmentacion_por_archivo,
 )
+from api.services.borrado_service import estado_borrado, listar_borrados
 
 from api.services.segmentation3d_service import (
     listar_segmentaciones_3d,
@@ -53,11 +54,15 @@ def listar_historial_archivos(x_user_id: int = Header(..., alias="X-User-Id")):
     return obtener_historial_archivos(user_id=x_user_id)
 
 
-@router.delete("/historial/series/{session_id}")
+@router.delete("/historial/series/{session_id}", status_code=202)
 def eliminar_serie(session_id: str, x_user_id: int = Header(..., alias="X-User-Id")):
     try:
         eliminar_serie_por_session_id(session_id, user_id=x_user_id)
-        return {"mensaje": "Serie eliminada correctamente."}
+        # Los archivos se borran en segundo plano
+        return {
+            "mensaje": "Serie eliminada correctamente.",
+            "estado_url": f"/historial/series/{session_id}/borrado",
+        }
     except ValueError as ve:
         if "SERIE_CON_SEGMENTACIONES" in str(ve):
             raise HTTPException(
@@ -68,6 +73,24 @@ def eliminar_serie(session_id: str, x_user_id: int = Header(..., alias="X-User-I
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.get("/historial/series/{session_id}/borrado")
+def estado_borrado_serie(session_id: str, x_user_id: int = Header(..., alias="X-User-Id")):
+    try:
+        estado = estado_borrado(session_id, user_id=x_user_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if estado is None:
+        raise HTTPException(status_code=404, detail="No hay borrado registrado para esta serie")
+    return estado
+
+
+@router.get("/historial/borrados")
+def listar_borrados_pendientes(x_user_id: int = Header(..., alias="X-User-Id")):
+    try:
+        return listar_borrados(user_id=x_user_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @router.get("/historial/series/{session_id}/segmentaciones-3d")
 def listar_segmentaciones_3d_router(session_id: str, x_user_id: int = Header(..., alias="X-User-Id")):
     try:
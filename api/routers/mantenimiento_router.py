@@ -0,0 +1,58 @@
+# api/routers/mantenimiento_router.py
+import json
+import os
+import secrets
+
+from fastapi import APIRouter, Header, HTTPException, Query
+from fastapi.responses import StreamingResponse
+
+from api.services.metadatos_service import indexar_series_pendientes
+from api.services.reconciliacion_service import reconciliar
+
+router = APIRouter()
+
+# Sin token configurado los endpoints de mantenimiento quedan deshabilitados
+MANTENIMIENTO_TOKEN = os.getenv("MANTENIMIENTO_TOKEN")
+
+
+def _autorizar(token: str | None) -> None:
+    if not MANTENIMIENTO_TOKEN:
+        raise HTTPException(403, "Mantenimiento deshabilitado (defina MANTENIMIENTO_TOKEN)")
+    if not token or not secrets.compare_digest(token, MANTENIMIENTO_TOKEN):
+        raise HTTPException(401, "Token de mantenimiento inválido")
+
+
+def _ndjson(borrar: bool, gracia_s: int | None) -> StreamingResponse:
+    # Generador síncrono: Starlette lo itera en el threadpool, fuera del event loop
+    lineas = (json.dumps(h, ensure_ascii=False) + "\n" for h in reconciliar(borrar, gracia_s))
+    return StreamingResponse(lineas, media_type="application/x-ndjson")
+
+
+# ========== 1. Informe de huérfanos (NDJSON en streaming) ==========
+@router.get("/mantenimiento/huerfanos")
+def informe_huerfanos(
+    gracia_s: int | None = Query(None, ge=0),
+    x_mantenimiento_token: str | None = Header(None, alias="X-Mantenimiento-Token"),
+):
+    _autorizar(x_mantenimiento_token)
+    return _ndjson(False, gracia_s)
+
+
+# ========== 2. Borrado de huérfanos ==========
+@router.delete("/mantenimiento/huerfanos")
+def borrar_huerfanos(
+    gracia_s: int | None = Query(None, ge=0),
+    x_mantenimiento_token: str | None = Header(None, alias="X-Mantenimiento-Token"),
+):
+    _autorizar(x_mantenimiento_token)
+    return _ndjson(True, gracia_s)
+
+
+# ========== 3. Relleno del índice de metadatos (series previas) ==========
+@router.post("/mantenimiento/metadatos/indexar")
+def indexar_metadatos(
+    x_mantenimiento_token: str | None = Header(None, alias="X-Mantenimiento-Token"),
+):
+    _autorizar(x_mantenimiento_token)
+    lineas = (json.dumps(r, ensure_ascii=False) + "\n" for r in indexar_series_pendientes())
+    return StreamingResponse(lineas, media_type="application/x-ndjson")
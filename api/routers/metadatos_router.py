@@ -0,0 +1,58 @@
+# api/routers/metadatos_router.py
+from datetime import date
+from typing import Optional
+
+from fastapi import APIRouter, Header, HTTPException, Query
+
+from api.services.metadatos_service import buscar_series, obtener_serie, listar_instancias
+
+router = APIRouter()
+
+
+# ========== 1. Buscar series por campos de cabecera ==========
+@router.get("/metadatos/series")
+def get_series(
+    x_user_id: int = Header(..., alias="X-User-Id"),
+    modality: Optional[str] = Query(None),
+    patient_id: Optional[str] = Query(None),
+    study_instance_uid: Optional[str] = Query(None),
+    fecha_desde: Optional[date] = Query(None),
+    fecha_hasta: Optional[date] = Query(None),
+    limit: int = Query(50, ge=1, le=500),
+    offset: int = Query(0, ge=0),
+):
+    try:
+        return buscar_series(
+            x_user_id,
+            modality=modality,
+            patient_id=patient_id,
+            study_instance_uid=study_instance_uid,
+            fecha_desde=fecha_desde,
+            fecha_hasta=fecha_hasta,
+            limit=limit,
+            offset=offset,
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# ========== 2. Metadatos de una serie ==========
+@router.get("/metadatos/series/{session_id}")
+def get_serie(session_id: str, x_user_id: int = Header(..., alias="X-User-Id")):
+    try:
+        serie = obtener_serie(session_id, x_user_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    if serie is None:
+        raise HTTPException(status_code=404, detail="Serie no encontrada")
+    return serie
+
+
+# ========== 3. Instancias de una serie (orden espacial) ==========
+@router.get("/metadatos/series/{session_id}/instancias")
+def get_instancias(session_id: str, x_user_id: int = Header(..., alias="X-User-Id")):
+    try:
+        return listar_instancias(session_id, x_user_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,103 @@
+# api/routers/upload_router.py
+from fastapi import APIRouter, Form, Header, HTTPException, Query, Request
+from fastapi.responses import JSONResponse
+
+from api.services.ingesta_service import respuesta_ingesta
+from api.services.upload_service import (
+    UPLOAD_CHUNK_MAX_BYTES,
+    OffsetIncorrecto,
+    crear_upload,
+    obtener_upload,
+    escribir_chunk,
+    finalizar_upload,
+)
+from api.utils.executors import ejecutar_io
+
+router = APIRouter()
+
+
+# ========== 1. Iniciar subida ==========
+@router.post("/uploads/", status_code=201)
+async def iniciar_upload(
+    filename: str = Form(...),
+    total_size: int = Form(...),
+    x_user_id: int = Header(..., alias="X-User-Id"),
+):
+    try:
+        estado = await ejecutar_io(crear_upload, filename, total_size, x_user_id)
+        return _respuesta(estado)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    except Exception as e:
+        raise HTTPException(500, str(e))
+
+
+# ========== 2. Subir chunk en un offset ==========
+@router.put("/uploads/{upload_id}")
+async def subir_chunk(
+    upload_id: str,
+    request: Request,
+    offset: int = Query(..., ge=0),
+    x_user_id: int = Header(..., alias="X-User-Id"),
+):
+    # Cuerpo crudo (application/octet-stream), sin multipart
+    datos = bytearray()
+    async for parte in request.stream():
+        datos.extend(parte)
+        if len(datos) > UPLOAD_CHUNK_MAX_BYTES:
+            raise HTTPException(413, f"Chunk demasiado grande (máximo {UPLOAD_CHUNK_MAX_BYTES} bytes)")
+
+    try:
+        estado = await ejecutar_io(escribir_chunk, upload_id, x_user_id, offset, bytes(datos))
+        return _respuesta(estado)
+    except OffsetIncorrecto as e:
+        return JSONResponse({"error": str(e), "offset_esperado": e.esperado}, 409)
+    except FileNotFoundError as e:
+        return JSONResponse({"error": str(e)}, 404)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    except Exception as e:
+        raise HTTPException(500, str(e))
+
+
+# ========== 3. Consultar estado (para reanudar) ==========
+@router.get("/uploads/{upload_id}")
+def get_upload(upload_id: str, x_user_id: int = Header(..., alias="X-User-Id")):
+    try:
+        return _respuesta(obtener_upload(upload_id, x_user_id))
+    except FileNotFoundError as e:
+        return JSONResponse({"error": str(e)}, 404)
+
+
+# ========== 4. Finalizar e iniciar ingesta ==========
+@router.post("/uploads/{upload_id}/finalize", status_code=202)
+async def finalizar(upload_id: str, x_user_id: int = Header(..., alias="X-User-Id")):
+    try:
+        estado = await ejecutar_io(finalizar_upload, upload_id, x_user_id)
+    except OffsetIncorrecto as e:
+        return JSONResponse({"error": "Subida incompleta", "offset_esperado": e.esperado}, 409)
+    except FileNotFoundError as e:
+        return JSONResponse({"error": str(e)}, 404)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    except Exception as e:
+        raise HTTPException(500, str(e))
+
+    # Subidas finalizadas antes de separar por serie solo guardan session_id
+    sesiones = estado.get("sesiones") or [
+        {"session_id": estado["session_id"], "series_instance_uid": None, "n_archivos": len(estado["miembros"])}
+    ]
+    return {**_respuesta(estado), **respuesta_ingesta(sesiones)}
+
+
+def _respuesta(estado: dict) -> dict:
+    return {
+        "upload_id": estado["upload_id"],
+        "filename": estado["filename"],
+        "total_size": estado["total_size"],
+        "recibido": estado["recibido"],
+        "completo": estado["recibido"] == estado["total_size"],
+        "miembros_extraidos": len(estado["miembros"]),
+        "chunk_max": UPLOAD_CHUNK_MAX_BYTES,
+        "session_id": estado["session_id"],
+    }
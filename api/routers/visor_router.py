@@ -0,0 +1,303 @@
+# api/routers/visor_router.py
+import re
+import zlib
+from typing import Optional
+
+from fastapi import APIRouter, Header, Query
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+
+from api.services.render_service import ruta_slice_cacheada, renderizar_slice, obtener_atlas
+from api.services.volumen_service import (
+    PRESETS_VENTANA,
+    EJES,
+    PROYECCIONES,
+    datos_volumen_en_disco,
+    estadisticas_serie,
+    renderizar_slice_ventana,
+    renderizar_plano,
+    renderizar_proyeccion,
+)
+from api.utils.executors import ejecutar_cpu, ejecutar_io
+
+router = APIRouter()
+
+# Los PNG de un slice no cambian mientras no cambie el DICOM (la clave de la
+# caché incluye su versión), así que el navegador puede reutilizarlos
+CACHE_CONTROL_SLICES = "private, max-age=86400"
+
+
+# ========== 1. Imagen de un slice (render perezoso) ==========
+@router.get("/series/{session_id}/imagenes/{image_name}")
+async def get_imagen_slice(session_id: str, image_name: str):
+    try:
+        ruta = await ejecutar_io(ruta_slice_cacheada, session_id, image_name)
+        if ruta is None:
+            ruta = await ejecutar_cpu(renderizar_slice, session_id, image_name)
+    except FileNotFoundError as e:
+        return JSONResponse({"error": str(e)}, 404)
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, 500)
+
+    return FileResponse(
+        ruta,
+        media_type="image/png",
+        headers={"Cache-Control": CACHE_CONTROL_SLICES},
+    )
+
+
+# ========== 2. Volumen HU: cabecera y datos crudos ==========
+# Bloque de lectura al hacer streaming del volumen
+BLOQUE_VOLUMEN = 1024 * 1024
+
+
+@router.get("/series/{session_id}/volumen")
+async def get_volumen_info(session_id: str):
+    try:
+        datos = await ejecutar_cpu(datos_volumen_en_disco, session_id)
+    except FileNotFoundError as e:
+        return JSONResponse({"error": str(e)}, 404)
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, 500)
+
+    return {**datos["cabecera"], "raw_url": f"/series/{session_id}/volumen/raw"}
+
+
+@router.get("/series/{session_id}/volumen/raw")
+async def get_volumen_raw(
+    session_id: str,
+    comprimir: bool = Query(False, description="gzip (solo sin Range)"),
+    rango: Optional[str] = Header(None, alias="Range"),
+    accept_encoding: Optional[str] = Header(None, alias="Accept-Encoding"),
+):
+    """
+    Voxels del volumen (ver /volumen para shape, dtype y spacing) como binario
+    C-order z,y,x. Admite Range de un solo tramo; con comprimir=true y sin
+    Range se envía con Content-Encoding: gzip.
+    """
+    try:
+        datos = await ejecutar_cpu(datos_volumen_en_disco, session_id)
+    except FileNotFoundError as e:
+        return JSONResponse({"error": str(e)}, 404)
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, 500)
+
+    total = datos["nbytes"]
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": f'"{datos["etag"]}"',
+        "Cache-Control": "private, max-age=300",
+        "X-Volumen-Shape": ",".join(str(n) for n in datos["cabecera"]["shape"]),
+        "X-Volumen-Dtype": datos["cabecera"]["dtype"],
+    }
+
+    if rango is not None:
+        tramo = _parsear_rango(rango, total)
+        if tramo is None:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{total}"})
+        inicio, fin = tramo
+        headers["Content-Range"] = f"bytes {inicio}-{fin - 1}/{total}"
+        headers["Content-Length"] = str(fin - inicio)
+        return StreamingResponse(
+            _leer_tramo(datos["ruta"], datos["offset"] + inicio, fin - inicio),
+            status_code=206,
+            media_type="application/octet-stream",
+            headers=headers,
+        )
+
+    if comprimir and accept_encoding and "gzip" in accept_encoding:
+        headers["Content-Encoding"] = "gzip"
+        headers["Vary"] = "Accept-Encoding"
+        return StreamingResponse(
+            _comprimir_gzip(_leer_tramo(datos["ruta"], datos["offset"], total)),
+            media_type="application/octet-stream",
+            headers=headers,
+        )
+
+    headers["Content-Length"] = str(total)
+    return StreamingResponse(
+        _leer_tramo(datos["ruta"], datos["offset"], total),
+        media_type="application/octet-stream",
+        headers=headers,
+    )
+
+
+def _parsear_rango(rango: str, total: int):
+    """'bytes=a-b', 'bytes=a-' o 'bytes=-n' → (inicio, fin exclusivo); None si no es válido."""
+    m = re.fullmatch(r"\s*bytes=(\d*)-(\d*)\s*", rango)
+    if m is None or (not m.group(1) and not m.group(2)):
+        return None
+
+    if not m.group(1):
+        n = int(m.group(2))
+        if n == 0:
+            return None
+        return max(0, total - n), total
+
+    inicio = int(m.group(1))
+    fin = int(m.group(2)) + 1 if m.group(2) else total
+    fin = min(fin, total)
+    if inicio >= total or fin <= inicio:
+        return None
+    return inicio, fin
+
+
+def _leer_tramo(ruta: str, offset: int, longitud: int):
+    # Generador síncrono: Starlette lo itera en el threadpool
+    with open(ruta, "rb") as f:
+        f.seek(offset)
+        pendiente = longitud
+        while pendiente > 0:
+            bloque = f.read(min(BLOQUE_VOLUMEN, pendiente))
+            if not bloque:
+                break
+            pendiente -= len(bloque)
+            yield bloque
+
+
+def _comprimir_gzip(bloques):
+    compresor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for bloque in bloques:
+        salida = compresor.compress(bloque)
+        if salida:
+            yield salida
+    yield compresor.flush()
+
+
+# ========== 3. Slice axial con ventana (window/level) ==========
+@router.get("/series/{session_id}/slices/{indice}")
+async def get_slice_ventana(
+    session_id: str,
+    indice: int,
+    centro: Optional[float] = Query(None, description="Centro de ventana (HU)"),
+    ancho: Optional[float] = Query(None, description="Ancho de ventana (HU)"),
+    preset: Optional[str] = Query(None, pattern="^(" + "|".join(PRESETS_VENTANA) + ")$"),
+    tamano: Optional[int] = Query(None, description="Lado mayor de la imagen en px"),
+):
+    ventana = _resolver_ventana(centro, ancho, preset)
+    if ventana is None:
+        return JSONResponse({"error": "Indique centro y ancho, o un preset"}, 400)
+
+    try:
+        png = await ejecutar_cpu(renderizar_slice_ventana, session_id, indice, *ventana, tamano)
+    except FileNotFoundError as e:
+        return JSONResponse({"error": str(e)}, 404)
+    except IndexError as e:
+        return JSONResponse({"error": str(e)}, 404)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, 400)
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, 500)
+
+    return Response(png, media_type="image/png", headers={"Cache-Control": "private, max-age=300"})
+
+
+# ========== 4. Reconstrucción multiplanar (MPR) ==========
+@router.get("/series/{session_id}/mpr/{eje}/{indice}")
+async def get_plano_mpr(
+    session_id: str,
+    eje: str,
+    indice: int,
+    centro: Optional[float] = Query(None, description="Centro de ventana (HU)"),
+    ancho: Optional[float] = Query(None, description="Ancho de ventana (HU)"),
+    preset: Optional[str] = Query(None, pattern="^(" + "|".join(PRESETS_VENTANA) + ")$"),
+    tamano: Optional[int] = Query(None, description="Lado mayor de la imagen en px"),
+):
+    if eje not in EJES:
+        return JSONResponse({"error": f"Eje inválido, use uno de {', '.join(EJES)}"}, 400)
+
+    ventana = _resolver_ventana(centro, ancho, preset)
+    if ventana is None:
+        return JSONResponse({"error": "Indique centro y ancho, o un preset"}, 400)
+
+    try:
+        png = await ejecutar_cpu(renderizar_plano, session_id, eje, indice, *ventana, tamano)
+    except FileNotFoundError as e:
+        return JSONResponse({"error": str(e)}, 404)
+    except IndexError as e:
+        return JSONResponse({"error": str(e)}, 404)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, 400)
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, 500)
+
+    return Response(png, media_type="image/png", headers={"Cache-Control": "private, max-age=300"})
+
+
+# ========== 5. Proyecciones MIP / MinIP / media ==========
+@router.get("/series/{session_id}/proyeccion/{tipo}/{eje}")
+async def get_proyeccion(
+    session_id: str,
+    tipo: str,
+    eje: str,
+    desde: Optional[int] = Query(None, ge=0, description="Primer índice del slab"),
+    hasta: Optional[int] = Query(None, ge=1, description="Índice final del slab (exclusivo)"),
+    centro: Optional[float] = Query(None, description="Centro de ventana (HU)"),
+    ancho: Optional[float] = Query(None, description="Ancho de ventana (HU)"),
+    preset: Optional[str] = Query(None, pattern="^(" + "|".join(PRESETS_VENTANA) + ")$"),
+    tamano: Optional[int] = Query(None, description="Lado mayor de la imagen en px"),
+):
+    if tipo not in PROYECCIONES:
+        return JSONResponse({"error": f"Proyección inválida, use una de {', '.join(PROYECCIONES)}"}, 400)
+    if eje not in EJES:
+        return JSONResponse({"error": f"Eje inválido, use uno de {', '.join(EJES)}"}, 400)
+
+    ventana = _resolver_ventana(centro, ancho, preset)
+    if ventana is None:
+        return JSONResponse({"error": "Indique centro y ancho, o un preset"}, 400)
+
+    try:
+        png = await ejecutar_cpu(
+            renderizar_proyeccion, session_id, tipo, eje, *ventana, desde, hasta, tamano
+        )
+    except FileNotFoundError as e:
+        return JSONResponse({"error": str(e)}, 404)
+    except IndexError as e:
+        return JSONResponse({"error": str(e)}, 400)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, 400)
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, 500)
+
+    return Response(png, media_type="image/png", headers={"Cache-Control": "private, max-age=300"})
+
+
+# ========== 6. Atlas de miniaturas de toda la serie ==========
+@router.get("/series/{session_id}/atlas")
+async def get_atlas(
+    session_id: str,
+    lado: int = Query(128, description="Lado máximo de cada miniatura en px"),
+):
+    try:
+        indice = await ejecutar_cpu(obtener_atlas, session_id, lado)
+    except FileNotFoundError as e:
+        return JSONResponse({"error": str(e)}, 404)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, 400)
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, 500)
+
+    return {k: v for k, v in indice.items() if k != "firma_mapping"}
+
+
+# ========== 7. Histograma y estadísticas de intensidad ==========
+@router.get("/series/{session_id}/estadisticas")
+async def get_estadisticas(session_id: str):
+    try:
+        stats = await ejecutar_cpu(estadisticas_serie, session_id)
+    except FileNotFoundError as e:
+        return JSONResponse({"error": str(e)}, 404)
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, 500)
+
+    return {k: v for k, v in stats.items() if k != "firma_mapping"}
+
+
+def _resolver_ventana(centro: Optional[float], ancho: Optional[float], preset: Optional[str]):
+    """(centro, ancho) a partir de valores explícitos y/o un preset; None si faltan."""
+    if preset is not None:
+        centro_p, ancho_p = PRESETS_VENTANA[preset]
+        centro = centro if centro is not None else centro_p
+        ancho = ancho if ancho is not None else ancho_p
+    if centro is None or ancho is None:
+        return None
+    return centro, ancho
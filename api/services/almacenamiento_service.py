@@ -0,0 +1,378 @@
+# api/services/almacenamiento_service.py
+import logging
+import os
+import shutil
+import threading
+import uuid
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
+
+# Importar rutas persistentes desde config.paths
+from config.paths import BASE_STATIC_DIR
+
+logger = logging.getLogger(__name__)
+
+# ==============================================================
+# Backend de almacenamiento: volumen local u objeto S3 compatible
+# ==============================================================
+# /data/static sigue siendo la copia de trabajo de cada nodo: los servicios
+# leen y escriben Path como siempre. Lo que no se puede recalcular barato
+# (instancias del CAS, mapping.json, artefactos, máscaras 2D, reportes) se
+# publica además en el backend, con la ruta relativa al volumen como clave, y
+# un nodo que no lo tiene en disco lo rehidrata desde ahí. Así varios nodos de
+# la API pueden servir las mismas sesiones sin compartir disco.
+#
+#   ALMACENAMIENTO=local  (por defecto) el backend ES el volumen: publicar,
+#                         rehidratar y retirar no hacen nada.
+#   ALMACENAMIENTO=s3     bucket S3_BUCKET vía boto3 (dependencia opcional).
+#                         S3_ENDPOINT_URL apunta a MinIO / moto_server en local;
+#                         las credenciales se toman de la configuración de boto3.
+#
+# Las escrituras al backend S3 son streaming: se suben partes de
+# S3_PARTE_BYTES con multipart upload y solo lo que cabe en una parte va en un
+# único PUT. Un error a mitad aborta la subida (no quedan partes huérfanas).
+
+ALMACENAMIENTO = os.getenv("ALMACENAMIENTO", "local").strip().lower()
+S3_BUCKET = os.getenv("S3_BUCKET", "")
+S3_PREFIJO = os.getenv("S3_PREFIJO", "").strip("/")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None
+S3_REGION = os.getenv("S3_REGION") or None
+
+# S3 exige partes de al menos 5 MiB (salvo la última)
+S3_PARTE_MIN = 5 * 1024 * 1024
+S3_PARTE_BYTES = max(S3_PARTE_MIN, int(os.getenv("S3_PARTE_BYTES", 8 * 1024 * 1024)))
+
+_BLOQUE = 1024 * 1024
+
+_lock = threading.Lock()
+_stats = {"publicados": 0, "bytes_publicados": 0, "rehidratados": 0, "retirados": 0, "errores": 0}
+_backend = None
+
+
+# ==============================================================
+# Escrituras en streaming
+# ==============================================================
+
+class _Escritura:
+    """Archivo de solo escritura: se confirma al cerrar y se descarta si hubo error."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, tipo, valor, traza):
+        if tipo is None:
+            self.close()
+        else:
+            self.abortar()
+        return False
+
+    def writable(self) -> bool:
+        return True
+
+
+class _EscrituraLocal(_Escritura):
+    def __init__(self, destino: Path):
+        destino.parent.mkdir(parents=True, exist_ok=True)
+        self._destino = destino
+        self._tmp = destino.with_name(f".{destino.name}.{uuid.uuid4().hex}.tmp")
+        self._f = open(self._tmp, "wb")
+
+    def write(self, datos) -> int:
+        return self._f.write(datos)
+
+    def close(self) -> None:
+        self._f.close()
+        os.replace(self._tmp, self._destino)
+
+    def abortar(self) -> None:
+        self._f.close()
+        self._tmp.unlink(missing_ok=True)
+
+
+class _EscrituraMultiparte(_Escritura):
+    def __init__(self, cliente, bucket: str, clave: str, parte_bytes: int):
+        self._cliente = cliente
+        self._bucket = bucket
+        self._clave = clave
+        self._parte_bytes = parte_bytes
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._partes = []
+
+    def write(self, datos) -> int:
+        self._buffer += datos
+        while len(self._buffer) >= self._parte_bytes:
+            self._subir_parte(bytes(self._buffer[: self._parte_bytes]))
+            del self._buffer[: self._parte_bytes]
+        return len(datos)
+
+    def _subir_parte(self, datos: bytes) -> None:
+        if self._upload_id is None:
+            respuesta = self._cliente.create_multipart_upload(Bucket=self._bucket, Key=self._clave)
+            self._upload_id = respuesta["UploadId"]
+
+        numero = len(self._partes) + 1
+        respuesta = self._cliente.upload_part(
+            Bucket=self._bucket, Key=self._clave, UploadId=self._upload_id, PartNumber=numero, Body=datos
+        )
+        self._partes.append({"PartNumber": numero, "ETag": respuesta["ETag"]})
+
+    def close(self) -> None:
+        if self._upload_id is None:
+            self._cliente.put_object(Bucket=self._bucket, Key=self._clave, Body=bytes(self._buffer))
+            return
+
+        if self._buffer:
+            self._subir_parte(bytes(self._buffer))
+            self._buffer.clear()
+        self._cliente.complete_multipart_upload(
+            Bucket=self._bucket,
+            Key=self._clave,
+            UploadId=self._upload_id,
+            MultipartUpload={"Parts": self._partes},
+        )
+
+    def abortar(self) -> None:
+        self._buffer.clear()
+        if self._upload_id is not None:
+            try:
+                self._cliente.abort_multipart_upload(
+                    Bucket=self._bucket, Key=self._clave, UploadId=self._upload_id
+                )
+            except Exception as exc:
+                logger.warning(f"No se pudo abortar la subida de {self._clave}: {exc}")
+
+
+# ==============================================================
+# Backends
+# ==============================================================
+
+class BackendLocal:
+    """Objetos como archivos bajo `raiz` (por defecto el propio volumen)."""
+
+    nombre = "local"
+
+    def __init__(self, raiz: Path = BASE_STATIC_DIR):
+        self.raiz = Path(raiz)
+
+    def _ruta(self, clave: str) -> Path:
+        return self.raiz / clave
+
+    def escribir(self, clave: str) -> _Escritura:
+        return _EscrituraLocal(self._ruta(clave))
+
+    def subir(self, clave: str, origen) -> None:
+        if os.path.abspath(origen) == os.path.abspath(self._ruta(clave)):
+            return
+        with open(origen, "rb") as f, self.escribir(clave) as destino:
+            shutil.copyfileobj(f, destino, _BLOQUE)
+
+    def descargar(self, clave: str, destino) -> bool:
+        ruta = self._ruta(clave)
+        if os.path.abspath(destino) == os.path.abspath(ruta):
+            return ruta.is_file()
+        try:
+            with open(ruta, "rb") as f, _EscrituraLocal(Path(destino)) as salida:
+                shutil.copyfileobj(f, salida, _BLOQUE)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def existe(self, clave: str) -> bool:
+        return self._ruta(clave).is_file()
+
+    def borrar(self, clave: str) -> None:
+        self._ruta(clave).unlink(missing_ok=True)
+
+    def listar(self, prefijo: str = "") -> Iterator[Tuple[str, int]]:
+        base = self._ruta(prefijo)
+        carpeta = base if base.is_dir() else base.parent
+        for raiz, _, archivos in os.walk(carpeta):
+            for nombre in archivos:
+                ruta = Path(raiz) / nombre
+                clave = ruta.relative_to(self.raiz).as_posix()
+                if clave.startswith(prefijo):
+                    yield clave, ruta.stat().st_size
+
+
+class BackendS3:
+    """Objetos en un bucket S3 (o compatible: MinIO, moto_server) bajo `prefijo/`."""
+
+    nombre = "s3"
+
+    def __init__(
+        self,
+        bucket: str,
+        prefijo: str = "",
+        endpoint_url: Optional[str] = None,
+        region: Optional[str] = None,
+        parte_bytes: int = S3_PARTE_BYTES,
+    ):
+        try:
+            import boto3
+            from botocore.config import Config
+            from botocore.exceptions import ClientError
+        except ImportError as e:
+            raise RuntimeError("ALMACENAMIENTO=s3 requiere boto3 (pip install boto3)") from e
+
+        if not bucket:
+            raise RuntimeError("ALMACENAMIENTO=s3 requiere S3_BUCKET")
+
+        self.bucket = bucket
+        self.prefijo = f"{prefijo.strip('/')}/" if prefijo.strip("/") else ""
+        self.parte_bytes = max(S3_PARTE_MIN, parte_bytes)
+        self._ClientError = ClientError
+        self.cliente = boto3.client(
+            "s3",
+            endpoint_url=endpoint_url,
+            region_name=region,
+            config=Config(retries={"max_attempts": 5, "mode": "standard"}),
+        )
+
+    def _clave(self, clave: str) -> str:
+        return f"{self.prefijo}{clave}"
+
+    def _no_existe(self, exc) -> bool:
+        codigo = exc.response.get("Error", {}).get("Code", "")
+        return codigo in ("404", "NoSuchKey", "NotFound")
+
+    def escribir(self, clave: str) -> _Escritura:
+        return _EscrituraMultiparte(self.cliente, self.bucket, self._clave(clave), self.parte_bytes)
+
+    def subir(self, clave: str, origen) -> None:
+        with open(origen, "rb") as f, self.escribir(clave) as destino:
+            shutil.copyfileobj(f, destino, _BLOQUE)
+
+    def descargar(self, clave: str, destino) -> bool:
+        try:
+            respuesta = self.cliente.get_object(Bucket=self.bucket, Key=self._clave(clave))
+        except self._ClientError as exc:
+            if self._no_existe(exc):
+                return False
+            raise
+
+        cuerpo = respuesta["Body"]
+        try:
+            with _EscrituraLocal(Path(destino)) as salida:
+                for bloque in cuerpo.iter_chunks(_BLOQUE):
+                    salida.write(bloque)
+        finally:
+            cuerpo.close()
+        return True
+
+    def existe(self, clave: str) -> bool:
+        try:
+            self.cliente.head_object(Bucket=self.bucket, Key=self._clave(clave))
+        except self._ClientError as exc:
+            if self._no_existe(exc):
+                return False
+            raise
+        return True
+
+    def borrar(self, clave: str) -> None:
+        self.cliente.delete_object(Bucket=self.bucket, Key=self._clave(clave))
+
+    def listar(self, prefijo: str = "") -> Iterator[Tuple[str, int]]:
+        paginas = self.cliente.get_paginator("list_objects_v2").paginate(
+            Bucket=self.bucket, Prefix=self._clave(prefijo)
+        )
+        for pagina in paginas:
+            for objeto in pagina.get("Contents", []):
+                yield objeto["Key"][len(self.prefijo):], objeto["Size"]
+
+
+def crear_backend(nombre: Optional[str] = None):
+    nombre = ALMACENAMIENTO if nombre is None else nombre
+    if nombre == "local":
+        return BackendLocal()
+    if nombre == "s3":
+        return BackendS3(S3_BUCKET, S3_PREFIJO, S3_ENDPOINT_URL, S3_REGION)
+    raise RuntimeError(f"ALMACENAMIENTO desconocido: {nombre}")
+
+
+def obtener_backend():
+    global _backend
+    with _lock:
+        if _backend is None:
+            _backend = crear_backend()
+        return _backend
+
+
+def es_remoto() -> bool:
+    """True si el backend no es el propio volumen (hay que publicar/rehidratar)."""
+    backend = obtener_backend()
+    return not (backend.nombre == "local" and backend.raiz == BASE_STATIC_DIR)
+
+
+# ==============================================================
+# Operaciones sobre rutas del volumen
+# ==============================================================
+
+def clave_de(ruta) -> str:
+    """Clave del objeto: ruta relativa a BASE_STATIC_DIR en formato posix."""
+    return Path(os.path.abspath(ruta)).relative_to(os.path.abspath(BASE_STATIC_DIR)).as_posix()
+
+
+def publicar(ruta, clave: Optional[str] = None) -> None:
+    """
+    Sube un archivo del volumen al backend. `clave` permite publicar un
+    temporal con la clave de su ruta final ANTES de moverlo a su sitio: si la
+    subida falla, el archivo no aparece en disco y el siguiente intento la
+    repite. Los errores se propagan.
+    """
+    if not es_remoto():
+        return
+    clave = clave or clave_de(ruta)
+    try:
+        obtener_backend().subir(clave, ruta)
+    except Exception:
+        with _lock:
+            _stats["errores"] += 1
+        raise
+    with _lock:
+        _stats["publicados"] += 1
+        _stats["bytes_publicados"] += os.path.getsize(ruta)
+
+
+def rehidratar(ruta) -> bool:
+    """Trae del backend un archivo que falta en el volumen. False si no está."""
+    if not es_remoto():
+        return False
+    try:
+        ok = obtener_backend().descargar(clave_de(ruta), ruta)
+    except Exception as exc:
+        logger.warning(f"No se pudo rehidratar {ruta}: {exc}")
+        with _lock:
+            _stats["errores"] += 1
+        return False
+    if ok:
+        with _lock:
+            _stats["rehidratados"] += 1
+    return ok
+
+
+def retirar(ruta) -> None:
+    """Borra del backend el objeto de una ruta (el archivo local lo borra el llamador)."""
+    if not es_remoto():
+        return
+    obtener_backend().borrar(clave_de(ruta))
+    with _lock:
+        _stats["retirados"] += 1
+
+
+def retirar_carpeta(carpeta) -> int:
+    """Borra del backend todos los objetos bajo una carpeta del volumen."""
+    if not es_remoto():
+        return 0
+    backend = obtener_backend()
+    claves = [clave for clave, _ in backend.listar(f"{clave_de(carpeta)}/")]
+    for clave in claves:
+        backend.borrar(clave)
+    with _lock:
+        _stats["retirados"] += len(claves)
+    return len(claves)
+
+
+def estadisticas_almacenamiento() -> dict:
+    with _lock:
+        return {**_stats, "backend": ALMACENAMIENTO}
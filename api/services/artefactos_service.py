@@ -0,0 +1,403 @@
+# api/services/artefactos_service.py
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, Optional
+
+from api.services.almacenamiento_service import clave_de, publicar, retirar
+from api.utils.executors import ejecutar_io
+from config.db_config import get_connection
+
+# Importar rutas persistentes desde config.paths
+from config.paths import ARTEFACTOS_DIR, BASE_STATIC_DIR
+
+logger = logging.getLogger(__name__)
+
+# ==============================================================
+# Almacén de artefactos por contenido con referencias en BD
+# ==============================================================
+# Máscaras 3D, miniaturas y STL se guardan una sola vez como blobs en
+# ARTEFACTOS_DIR/<aa>/<sha256><ext>. Quién usa cada blob se registra en
+# artefacto_ref (propietario + rol → hash) y artefacto.refcount lleva la cuenta.
+#
+# Borrar un propietario solo quita sus referencias dentro de la misma
+# transacción que borra su fila: es O(1) en archivos y no deja nada a medias
+# si el proceso cae. Los blobs sin referencias los elimina el recolector en
+# segundo plano pasado ARTEFACTOS_GRACIA_S (así un blob recién escrito, cuya
+# referencia aún no se confirmó, no se borra).
+#
+# Con un backend remoto, cada blob nuevo se publica antes de aparecer en su
+# ruta final y el GC lo retira también del backend (el refcount es global).
+
+ARTEFACTOS_GRACIA_S = int(os.getenv("ARTEFACTOS_GRACIA_S", 3600))
+ARTEFACTOS_GC_INTERVALO_S = float(os.getenv("ARTEFACTOS_GC_INTERVALO_S", 600))
+ARTEFACTOS_GC_LOTE = int(os.getenv("ARTEFACTOS_GC_LOTE", 500))
+
+# Extensiones de blobs derivados: se pueden desalojar y regenerar a partir de
+# la máscara (.npy), que es la fuente
+EXTENSIONES_DERIVADAS = (".png", ".stl")
+
+_BLOQUE = 1024 * 1024
+
+_lock = threading.Lock()
+_stats = {
+    "nuevos": 0, "reutilizados": 0, "referencias_liberadas": 0,
+    "recolectados": 0, "errores_gc": 0, "regenerados": 0, "regenerados_distintos": 0,
+}
+_gc_task = None
+
+# tipo de propietario ("seg3d", "modelo3d") → función(id, rol, destino) que
+# vuelve a escribir el artefacto de ese rol
+_regeneradores = {}
+
+
+def guardar_artefacto(origen, extension: str) -> dict:
+    """
+    Guarda un blob en el almacén y devuelve {hash, extension, tamano, url, nuevo}.
+    `origen` son bytes o la ruta de un archivo temporal (ver ruta_temporal),
+    que se mueve al almacén o se borra si el contenido ya existía.
+
+    El blob queda registrado sin referencias: hay que llamar a referenciar()
+    en la transacción que crea al propietario.
+    """
+    extension = extension if extension.startswith(".") else f".{extension}"
+
+    if isinstance(origen, (bytes, bytearray, memoryview)):
+        clave = hashlib.sha256(origen).hexdigest()
+        tamano = len(origen)
+    else:
+        clave, tamano = _hash_archivo(origen)
+
+    # Primero la fila (refresca el plazo de gracia y espera a un GC en curso
+    # sobre el mismo hash); después el archivo
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            """
+            INSERT INTO artefacto (hash, extension, tamano, refcount, sin_refs_at)
+            VALUES (%s, %s, %s, 0, CURRENT_TIMESTAMP)
+            ON CONFLICT (hash) DO UPDATE SET
+              sin_refs_at = CASE WHEN artefacto.refcount <= 0
+                                 THEN CURRENT_TIMESTAMP ELSE artefacto.sin_refs_at END
+            """,
+            (clave, extension, tamano),
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+    ruta = ruta_artefacto(clave, extension)
+    nuevo = not ruta.is_file()
+
+    if nuevo:
+        ruta.parent.mkdir(parents=True, exist_ok=True)
+        if isinstance(origen, (bytes, bytearray, memoryview)):
+            tmp = ruta_temporal(extension)
+            with open(tmp, "wb") as f:
+                f.write(origen)
+        else:
+            tmp = Path(origen)
+        try:
+            publicar(tmp, clave_de(ruta))
+        except Exception:
+            tmp.unlink(missing_ok=True)
+            raise
+        os.replace(tmp, ruta)
+    elif not isinstance(origen, (bytes, bytearray, memoryview)):
+        os.unlink(origen)
+
+    with _lock:
+        _stats["nuevos" if nuevo else "reutilizados"] += 1
+
+    return {
+        "hash": clave,
+        "extension": extension,
+        "tamano": tamano,
+        "url": url_artefacto(clave, extension),
+        "nuevo": nuevo,
+    }
+
+
+def referenciar(cur, propietario: str, artefactos: Dict[str, dict]) -> None:
+    """
+    Registra que `propietario` (p. ej. "seg3d:12") usa los artefactos dados
+    por rol. Se ejecuta con el cursor del llamador: el commit de la fila del
+    propietario y el de sus referencias es el mismo.
+    """
+    for rol, artefacto in artefactos.items():
+        if artefacto is None:
+            continue
+        cur.execute(
+            "INSERT INTO artefacto_ref (propietario, rol, hash) VALUES (%s, %s, %s)",
+            (propietario, rol, artefacto["hash"]),
+        )
+        cur.execute(
+            "UPDATE artefacto SET refcount = refcount + 1, sin_refs_at = NULL WHERE hash = %s",
+            (artefacto["hash"],),
+        )
+
+
+def liberar_propietario(cur, propietario: str) -> int:
+    """
+    Quita todas las referencias de `propietario` con el cursor del llamador.
+    No toca archivos: los blobs que quedan sin referencias los borra el GC.
+    Devuelve el número de referencias quitadas (0 = propietario sin artefactos).
+    """
+    cur.execute(
+        "DELETE FROM artefacto_ref WHERE propietario = %s RETURNING hash",
+        (propietario,),
+    )
+    hashes = [r[0] for r in cur.fetchall()]
+
+    conteo = {}
+    for h in hashes:
+        conteo[h] = conteo.get(h, 0) + 1
+    for h, n in conteo.items():
+        cur.execute(
+            """
+            UPDATE artefacto
+            SET refcount = refcount - %s,
+                sin_refs_at = CASE WHEN refcount - %s <= 0 THEN CURRENT_TIMESTAMP END
+            WHERE hash = %s
+            """,
+            (n, n, h),
+        )
+
+    with _lock:
+        _stats["referencias_liberadas"] += len(hashes)
+    return len(hashes)
+
+
+def recolectar_basura(gracia_s: Optional[int] = None, lote: Optional[int] = None) -> int:
+    """
+    Borra los blobs sin referencias desde hace más de `gracia_s`, por lotes.
+    El archivo se borra antes de confirmar el DELETE de su fila: si el proceso
+    cae entre medias, la fila sigue ahí y el siguiente pase lo reintenta.
+    """
+    gracia_s = ARTEFACTOS_GRACIA_S if gracia_s is None else gracia_s
+    lote = lote or ARTEFACTOS_GC_LOTE
+    total = 0
+
+    while True:
+        conn = get_connection()
+        cur = conn.cursor()
+        try:
+            cur.execute(
+                """
+                DELETE FROM artefacto
+                WHERE hash IN (
+                    SELECT hash FROM artefacto
+                    WHERE refcount <= 0
+                      AND sin_refs_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING hash, extension
+                """,
+                (gracia_s, lote),
+            )
+            filas = cur.fetchall()
+
+            for clave, extension in filas:
+                ruta = ruta_artefacto(clave, extension)
+                try:
+                    ruta.unlink()
+                except FileNotFoundError:
+                    pass
+                retirar(ruta)
+
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            with _lock:
+                _stats["errores_gc"] += 1
+            raise
+        finally:
+            cur.close()
+            conn.close()
+
+        total += len(filas)
+        if len(filas) < lote:
+            break
+
+    _limpiar_temporales(gracia_s)
+
+    with _lock:
+        _stats["recolectados"] += total
+    return total
+
+
+def ruta_referenciada(propietario: str, rol: str) -> Optional[Path]:
+    """Ruta del blob que `propietario` usa en `rol`, o None."""
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            """
+            SELECT a.hash, a.extension
+            FROM artefacto_ref r
+            JOIN artefacto a ON a.hash = r.hash
+            WHERE r.propietario = %s AND r.rol = %s
+            """,
+            (propietario, rol),
+        )
+        row = cur.fetchone()
+    finally:
+        cur.close()
+        conn.close()
+    return ruta_artefacto(row[0], row[1]) if row else None
+
+
+# ==============================================================
+# Regeneración de blobs derivados desalojados
+# ==============================================================
+
+def registrar_regenerador(tipo: str, funcion) -> None:
+    _regeneradores[tipo] = funcion
+
+
+def regenerar_artefacto(ruta: Path) -> bool:
+    """
+    Vuelve a escribir un blob derivado a partir de su primer propietario que
+    sepa regenerarlo. Devuelve False si nadie lo referencia o nadie puede
+    reproducir exactamente los mismos bytes.
+    """
+    ruta = Path(ruta)
+    clave, extension = ruta.stem, ruta.suffix
+    if extension not in EXTENSIONES_DERIVADAS:
+        return False
+
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            "SELECT propietario, rol FROM artefacto_ref WHERE hash = %s ORDER BY creado_at",
+            (clave,),
+        )
+        filas = cur.fetchall()
+    finally:
+        cur.close()
+        conn.close()
+
+    for propietario, rol in filas:
+        tipo, _, ident = propietario.partition(":")
+        funcion = _regeneradores.get(tipo)
+        if funcion is None:
+            continue
+
+        tmp = ruta_temporal(extension)
+        try:
+            funcion(ident, rol, tmp)
+        except Exception as exc:
+            logger.warning(f"No se pudo regenerar {ruta.name} desde {propietario}/{rol}: {exc}")
+            tmp.unlink(missing_ok=True)
+            continue
+
+        if _hash_archivo(tmp)[0] != clave:
+            # La ruta es el hash del contenido: otros bytes (p. ej. otra versión
+            # del codificador PNG) no se sirven bajo ella. Se prueba el siguiente
+            # propietario y, si ninguno coincide, el archivo sigue sin existir
+            logger.warning(f"Artefacto regenerado con hash distinto, descartado: {ruta.name}")
+            tmp.unlink(missing_ok=True)
+            with _lock:
+                _stats["regenerados_distintos"] += 1
+            continue
+
+        ruta.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp, ruta)
+        with _lock:
+            _stats["regenerados"] += 1
+        return True
+
+    return False
+
+
+# ==============================================================
+# Rutas
+# ==============================================================
+
+def ruta_artefacto(clave: str, extension: str) -> Path:
+    return ARTEFACTOS_DIR / clave[:2] / f"{clave}{extension}"
+
+
+def url_artefacto(clave: str, extension: str) -> str:
+    rel = ruta_artefacto(clave, extension).relative_to(BASE_STATIC_DIR)
+    return f"/static/{rel.as_posix()}"
+
+
+def ruta_temporal(extension: str) -> Path:
+    """Archivo temporal dentro del almacén (mismo sistema de archivos → os.replace atómico)."""
+    tmp = ARTEFACTOS_DIR / "tmp"
+    tmp.mkdir(parents=True, exist_ok=True)
+    return tmp / f"{uuid.uuid4().hex}{extension}"
+
+
+def _limpiar_temporales(gracia_s: int) -> None:
+    # Temporales de escrituras que no llegaron a guardar_artefacto (proceso caído)
+    limite = time.time() - gracia_s
+    try:
+        entradas = list(os.scandir(ARTEFACTOS_DIR / "tmp"))
+    except FileNotFoundError:
+        return
+    for entrada in entradas:
+        try:
+            if entrada.stat().st_mtime < limite:
+                os.unlink(entrada.path)
+        except FileNotFoundError:
+            continue
+
+
+def _hash_archivo(ruta) -> tuple:
+    h = hashlib.sha256()
+    tamano = 0
+    with open(ruta, "rb") as f:
+        while True:
+            bloque = f.read(_BLOQUE)
+            if not bloque:
+                break
+            h.update(bloque)
+            tamano += len(bloque)
+    return h.hexdigest(), tamano
+
+
+# ==============================================================
+# Recolector en segundo plano
+# ==============================================================
+
+async def _bucle_gc():
+    while True:
+        await asyncio.sleep(ARTEFACTOS_GC_INTERVALO_S)
+        try:
+            borrados = await ejecutar_io(recolectar_basura)
+            if borrados:
+                logger.info(f"GC de artefactos: {borrados} blobs eliminados")
+        except Exception as exc:
+            logger.warning(f"GC de artefactos falló: {exc}")
+
+
+def iniciar_gc_artefactos() -> None:
+    global _gc_task
+    if _gc_task is None or _gc_task.done():
+        _gc_task = asyncio.get_running_loop().create_task(_bucle_gc())
+
+
+def detener_gc_artefactos() -> None:
+    global _gc_task
+    if _gc_task is not None:
+        _gc_task.cancel()
+        _gc_task = None
+
+
+def estadisticas_artefactos() -> dict:
+    with _lock:
+        return dict(_stats)
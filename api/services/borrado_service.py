@@ -0,0 +1,319 @@
+# api/services/borrado_service.py
+import asyncio
+import json
+import logging
+import os
+import shutil
+import threading
+from typing import List, Optional
+
+from api.services.almacenamiento_service import retirar_carpeta
+from api.services.cas_service import liberar_instancias
+from api.services.manifiesto_service import borrar_manifiesto, leer_manifiesto
+from api.services.render_service import invalidar_renders
+from api.utils.executors import ejecutar_io
+from config.db_config import get_connection
+
+# Importar rutas persistentes desde config.paths
+from config.paths import BASE_STATIC_DIR, SEGMENTATIONS_2D_DIR, SEGMENTATIONS_3D_DIR, SERIES_DIR
+
+logger = logging.getLogger(__name__)
+
+# ==============================================================
+# Borrado diferido de sesiones (lápidas + worker por lotes)
+# ==============================================================
+# Borrar una serie en la petición solo quita sus filas y deja una lápida en
+# borrado_sesion, en la misma transacción: la sesión desaparece al instante
+# y la respuesta no espera al disco. El worker en segundo plano reserva una
+# lápida (con plazo, por si el proceso cae), borra los archivos de la sesión
+# según su manifiesto por lotes de BORRADO_LOTE, anotando el progreso en la
+# fila, y al final libera las instancias del CAS, las carpetas y el manifiesto.
+#
+# Borrar es idempotente (un archivo que ya no está cuenta como borrado): si
+# algo falla la lápida queda en 'reintentando' con espera exponencial y, tras
+# BORRADO_MAX_INTENTOS, en 'fallido' con el último error. Volver a borrar la
+# serie la reencola.
+#
+# Estados: pendiente → en_curso → completado | reintentando → ... | fallido
+
+BORRADO_LOTE = int(os.getenv("BORRADO_LOTE", 200))
+BORRADO_INTERVALO_S = float(os.getenv("BORRADO_INTERVALO_S", 5))
+BORRADO_MAX_INTENTOS = int(os.getenv("BORRADO_MAX_INTENTOS", 5))
+BORRADO_RESERVA_S = int(os.getenv("BORRADO_RESERVA_S", 300))
+BORRADO_ESPERA_BASE_S = int(os.getenv("BORRADO_ESPERA_BASE_S", 30))
+
+_COLUMNAS = (
+    "session_id", "estado", "total", "borrados", "fallos", "intentos", "ultimo_error",
+    "proximo_intento", "creado_at", "actualizado_at", "completado_at",
+)
+
+_lock = threading.Lock()
+_stats = {"completados": 0, "reintentos": 0, "fallidos": 0, "archivos_borrados": 0, "errores_archivo": 0}
+_tarea = None
+_loop = None
+_evento = None
+
+
+def marcar_borrado(cur, session_id: str, user_id: int) -> None:
+    """
+    Deja la lápida de la sesión con el cursor del llamador (mismo commit que
+    el borrado de sus filas). Una lápida previa se reencola desde cero.
+    """
+    cur.execute(
+        """
+        INSERT INTO borrado_sesion (session_id, user_id)
+        VALUES (%s, %s)
+        ON CONFLICT (session_id) DO UPDATE SET
+          estado = 'pendiente', borrados = 0, fallos = 0, intentos = 0, ultimo_error = NULL,
+          proximo_intento = CURRENT_TIMESTAMP, reservado_hasta = NULL,
+          actualizado_at = CURRENT_TIMESTAMP, completado_at = NULL
+        WHERE borrado_sesion.estado <> 'en_curso'
+        """,
+        (session_id, user_id),
+    )
+
+
+def estado_borrado(session_id: str, user_id: int) -> Optional[dict]:
+    filas = _consultar("WHERE session_id = %s AND user_id = %s", (session_id, user_id))
+    return filas[0] if filas else None
+
+
+def listar_borrados(user_id: int) -> List[dict]:
+    """Borrados del usuario que no han terminado bien (en curso, reintentando o fallidos)."""
+    return _consultar("WHERE user_id = %s AND estado <> 'completado' ORDER BY creado_at DESC", (user_id,))
+
+
+def _consultar(condicion: str, params: tuple) -> List[dict]:
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute(f"SELECT {', '.join(_COLUMNAS)} FROM borrado_sesion {condicion}", params)
+        filas = cur.fetchall()
+    finally:
+        cur.close()
+        conn.close()
+
+    return [
+        {col: (v.isoformat() if hasattr(v, "isoformat") else v) for col, v in zip(_COLUMNAS, fila)}
+        for fila in filas
+    ]
+
+
+# ==============================================================
+# Worker
+# ==============================================================
+
+def procesar_pendientes(limite: Optional[int] = None) -> int:
+    """Purga lápidas listas hasta que no quede ninguna (o `limite`). Devuelve cuántas procesó."""
+    procesadas = 0
+    while limite is None or procesadas < limite:
+        reserva = _reservar()
+        if reserva is None:
+            break
+        _purgar(*reserva)
+        procesadas += 1
+    return procesadas
+
+
+def _reservar() -> Optional[tuple]:
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            """
+            UPDATE borrado_sesion
+            SET estado = 'en_curso', intentos = intentos + 1, borrados = 0, fallos = 0,
+                reservado_hasta = CURRENT_TIMESTAMP + make_interval(secs => %s),
+                actualizado_at = CURRENT_TIMESTAMP
+            WHERE session_id = (
+                SELECT session_id FROM borrado_sesion
+                WHERE (estado IN ('pendiente', 'reintentando') AND proximo_intento <= CURRENT_TIMESTAMP)
+                   OR (estado = 'en_curso' AND reservado_hasta < CURRENT_TIMESTAMP)
+                ORDER BY proximo_intento
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING session_id, intentos
+            """,
+            (BORRADO_RESERVA_S,),
+        )
+        fila = cur.fetchone()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+    return tuple(fila) if fila else None
+
+
+def _purgar(session_id: str, intentos: int) -> None:
+    serie = SERIES_DIR / session_id
+    mapping_path = serie / "mapping.json"
+    claves_cas = _claves_cas(mapping_path)
+
+    # mapping.json va al final: mientras exista, un reintento sabe qué
+    # instancias del CAS liberar
+    try:
+        rutas = [
+            BASE_STATIC_DIR / clave
+            for clave in leer_manifiesto(session_id)["archivos"]
+            if BASE_STATIC_DIR / clave != mapping_path
+        ]
+    except Exception as exc:
+        _terminar(session_id, intentos, 0, 1, f"manifiesto: {exc}")
+        return
+
+    # Antes de borrar los DICOM: los renders se localizan por su inodo
+    try:
+        invalidar_renders(session_id)
+    except Exception as exc:
+        logger.warning(f"No se pudieron borrar los renders de {session_id}: {exc}")
+
+    borrados = fallos = 0
+    error = None
+    for inicio in range(0, len(rutas), BORRADO_LOTE):
+        for ruta in rutas[inicio:inicio + BORRADO_LOTE]:
+            try:
+                os.unlink(ruta)
+            except FileNotFoundError:
+                pass
+            except OSError as exc:
+                fallos += 1
+                error = f"{ruta}: {exc}"
+                continue
+            borrados += 1
+        _progreso(session_id, len(rutas), borrados, fallos, error)
+
+    if not fallos:
+        try:
+            liberar_instancias(claves_cas)
+            for carpeta in (serie, SEGMENTATIONS_2D_DIR / session_id, SEGMENTATIONS_3D_DIR / session_id):
+                if carpeta.is_dir():
+                    shutil.rmtree(carpeta)
+            retirar_carpeta(serie)
+            retirar_carpeta(SEGMENTATIONS_2D_DIR / session_id)
+            borrar_manifiesto(session_id)
+        except Exception as exc:
+            fallos += 1
+            error = str(exc)
+
+    _terminar(session_id, intentos, borrados, fallos, error)
+
+
+def _claves_cas(mapping_path) -> list:
+    try:
+        with open(mapping_path, "r", encoding="utf-8") as f:
+            return [m.get("cas") for m in json.load(f).values() if m.get("cas")]
+    except (OSError, ValueError):
+        return []
+
+
+def _progreso(session_id: str, total: int, borrados: int, fallos: int, error: Optional[str]) -> None:
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            """
+            UPDATE borrado_sesion
+            SET total = %s, borrados = %s, fallos = %s, ultimo_error = COALESCE(%s, ultimo_error),
+                reservado_hasta = CURRENT_TIMESTAMP + make_interval(secs => %s),
+                actualizado_at = CURRENT_TIMESTAMP
+            WHERE session_id = %s
+            """,
+            (total, borrados, fallos, error, BORRADO_RESERVA_S, session_id),
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+
+def _terminar(session_id: str, intentos: int, borrados: int, fallos: int, error: Optional[str]) -> None:
+    if not fallos:
+        estado, espera = "completado", 0
+    elif intentos >= BORRADO_MAX_INTENTOS:
+        estado, espera = "fallido", 0
+    else:
+        estado, espera = "reintentando", BORRADO_ESPERA_BASE_S * 2 ** (intentos - 1)
+
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            """
+            UPDATE borrado_sesion
+            SET estado = %s, borrados = %s, fallos = %s, ultimo_error = %s,
+                proximo_intento = CURRENT_TIMESTAMP + make_interval(secs => %s),
+                reservado_hasta = NULL, actualizado_at = CURRENT_TIMESTAMP,
+                completado_at = CASE WHEN %s = 'completado' THEN CURRENT_TIMESTAMP END
+            WHERE session_id = %s
+            """,
+            (estado, borrados, fallos, error, espera, estado, session_id),
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+    with _lock:
+        _stats["archivos_borrados"] += borrados
+        _stats["errores_archivo"] += fallos
+        _stats[{"completado": "completados", "fallido": "fallidos", "reintentando": "reintentos"}[estado]] += 1
+    if estado != "completado":
+        logger.warning(f"Borrado de {session_id} {estado} (intento {intentos}): {error}")
+
+
+# ==============================================================
+# Bucle en segundo plano
+# ==============================================================
+
+async def _bucle_borrados():
+    while True:
+        try:
+            await asyncio.wait_for(_evento.wait(), BORRADO_INTERVALO_S)
+        except asyncio.TimeoutError:
+            pass
+        _evento.clear()
+        try:
+            await ejecutar_io(procesar_pendientes)
+        except Exception as exc:
+            logger.warning(f"Worker de borrados falló: {exc}")
+
+
+def despertar_borrados() -> None:
+    """Adelanta la siguiente pasada del worker (seguro desde cualquier hilo)."""
+    if _loop is not None and _evento is not None:
+        try:
+            _loop.call_soon_threadsafe(_evento.set)
+        except RuntimeError:
+            # Loop ya cerrado: la lápida la recoge la próxima pasada de otro proceso
+            pass
+
+
+def iniciar_borrados() -> None:
+    global _tarea, _loop, _evento
+    if _tarea is None or _tarea.done():
+        _loop = asyncio.get_running_loop()
+        _evento = asyncio.Event()
+        _tarea = _loop.create_task(_bucle_borrados())
+
+
+def detener_borrados() -> None:
+    global _tarea, _loop
+    if _tarea is not None:
+        _tarea.cancel()
+        _tarea = None
+        _loop = None
+
+
+def estadisticas_borrados() -> dict:
+    with _lock:
+        return dict(_stats)
@@ -0,0 +1,102 @@
+# api/services/cache_service.py
+import json
+import os
+
+import numpy as np
+import pydicom
+
+from api.services.cas_service import rehidratar_serie
+from api.utils.lru_cache import LRUCache
+
+# Importar rutas persistentes desde config.paths
+from config.paths import SERIES_DIR
+
+
+# ==============================================================
+# Caché de mapping.json por sesión (validado por mtime + tamaño)
+# ==============================================================
+
+MAPPING_CACHE_MAX = int(os.getenv("MAPPING_CACHE_MAX", 256))
+
+_mappings = LRUCache(max_items=MAPPING_CACHE_MAX)
+
+
+def cargar_mapping(session_id: str) -> dict:
+    """
+    Devuelve el mapping.json parseado de la sesión.
+    Mientras el archivo no cambie (mtime y tamaño) se sirve desde memoria,
+    sin leer disco ni parsear JSON. El dict devuelto es compartido: no mutarlo.
+    Si la serie no está en este nodo se rehidrata desde el backend de almacenamiento.
+    """
+    mapping_path = SERIES_DIR / session_id / "mapping.json"
+
+    try:
+        st = os.stat(mapping_path)
+    except FileNotFoundError:
+        _mappings.pop(session_id)
+        if not rehidratar_serie(session_id):
+            raise FileNotFoundError("mapping.json no encontrado para la serie")
+        st = os.stat(mapping_path)
+
+    firma = (st.st_mtime_ns, st.st_size)
+    entrada = _mappings.get(session_id, valido=lambda e: e[0] == firma)
+    if entrada is not None:
+        return entrada[1]
+
+    with open(mapping_path, "r", encoding="utf-8") as f:
+        mapping = json.load(f)
+
+    _mappings.put(session_id, (firma, mapping))
+    return mapping
+
+
+def invalidar_mapping(session_id: str) -> None:
+    _mappings.pop(session_id)
+
+
+# ==============================================================
+# Caché de píxeles decodificados por slice (presupuesto en bytes)
+# ==============================================================
+
+PIXEL_CACHE_MAX_BYTES = int(os.getenv("PIXEL_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+
+_pixeles = LRUCache(max_bytes=PIXEL_CACHE_MAX_BYTES)
+
+
+def leer_slice_dicom(dicom_path) -> tuple:
+    """
+    Devuelve (ds, pixel_array) de un DICOM, decodificando solo en el primer acceso.
+    Clave: inodo (los hard links del CAS comparten entrada entre sesiones) +
+    mtime y tamaño. El array es de solo lectura y `ds` no conserva PixelData
+    (solo cabecera); usar el array devuelto, no ds.pixel_array.
+    Compartida por la segmentación 2D, el render de slices y la carga del volumen 3D.
+    """
+    ruta = os.path.abspath(str(dicom_path))
+    st = os.stat(ruta)
+    clave = (st.st_dev, st.st_ino)
+    firma = (st.st_mtime_ns, st.st_size)
+
+    entrada = _pixeles.get(clave, valido=lambda e: e[0] == firma)
+    if entrada is not None:
+        return entrada[1], entrada[2]
+
+    ds = pydicom.dcmread(ruta, force=True)
+    arr = np.asarray(ds.pixel_array)
+    arr.setflags(write=False)
+
+    # Liberar los bytes codificados: solo se guarda la cabecera + array decodificado
+    del ds.PixelData
+
+    _pixeles.put(clave, (firma, ds, arr), size=arr.nbytes)
+    return ds, arr
+
+
+def leer_pixel_array(dicom_path) -> np.ndarray:
+    return leer_slice_dicom(dicom_path)[1]
+
+
+def estadisticas_caches() -> dict:
+    return {
+        "mapping": _mappings.stats(),
+        "pixeles": _pixeles.stats(),
+    }
@@ -0,0 +1,182 @@
+# api/services/cas_service.py
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+from pathlib import Path
+from typing import Callable, Iterable, Optional
+
+from api.services.almacenamiento_service import clave_de, es_remoto, obtener_backend, publicar, rehidratar
+
+# Importar rutas persistentes desde config.paths
+from config.paths import INSTANCIAS_CAS_DIR, SERIES_DIR
+
+# ==============================================================
+# Almacén por contenido (CAS) de instancias DICOM
+# ==============================================================
+# Cada instancia se guarda una sola vez en INSTANCIAS_CAS_DIR/<aa>/<clave>.dcm,
+# con clave = sha256(SOPInstanceUID + sha256(PixelData)). Los archivos de cada
+# sesión en SERIES_DIR son hard links a esa copia: volver a subir el mismo
+# estudio no escribe bytes nuevos, y todo lo derivado que se indexa por inodo
+# (caché de píxeles, renders) se comparte entre sesiones.
+#
+# Una entrada con st_nlink == 1 ya no la usa ninguna sesión y se puede borrar.
+#
+# Con un backend remoto (ver almacenamiento_service) cada instancia nueva se
+# publica antes de aparecer en el CAS local, y un nodo sin la serie la
+# reconstruye desde mapping.json (rehidratar_serie). El st_nlink es del nodo:
+# liberar_instancias solo borra la copia local, nunca el objeto remoto.
+
+_lock = threading.Lock()
+# Enlazar una instancia del CAS y liberarla se excluyen: si no, liberar_instancias
+# puede ver st_nlink == 1 justo antes de que una ingesta la enlace y borrarla
+_lock_enlaces = threading.Lock()
+_stats = {"nuevas": 0, "reutilizadas": 0, "copias_sin_link": 0, "liberadas": 0}
+
+
+def clave_instancia(ds) -> Optional[str]:
+    """Clave CAS de un dataset con cabecera y PixelData; None si no tiene SOPInstanceUID."""
+    sop = str(ds.get("SOPInstanceUID", "") or "").strip()
+    if not sop or "PixelData" not in ds:
+        return None
+
+    pixeles = hashlib.sha256(ds.PixelData).digest()
+    return hashlib.sha256(sop.encode("ascii", "replace") + b"\0" + pixeles).hexdigest()
+
+
+def guardar_instancia(
+    clave: str, datos: bytes, destino: Path, transformar: Optional[Callable[[bytes], bytes]] = None
+) -> bool:
+    """
+    Deja `destino` apuntando a la copia CAS de la instancia (creándola si no
+    existe). Devuelve True si la instancia ya estaba almacenada. Si el hard
+    link no es posible (otro sistema de archivos) se escribe una copia normal.
+
+    `transformar` (p. ej. la compresión sin pérdida) solo se aplica al crear
+    la copia: una instancia ya almacenada se enlaza tal cual.
+    """
+    ruta = ruta_cas(clave)
+    enlazada = _enlazar_existente(ruta, destino)
+    reutilizada = enlazada is not None
+
+    if not reutilizada:
+        if transformar is not None:
+            datos = transformar(datos)
+        ruta.parent.mkdir(parents=True, exist_ok=True)
+        tmp = ruta.with_name(f"{clave}.{uuid.uuid4().hex}.tmp")
+        with open(tmp, "wb") as f:
+            f.write(datos)
+        try:
+            publicar(tmp, clave_de(ruta))
+            with _lock_enlaces:
+                # link (no replace): si otra ingesta la publicó mientras tanto se
+                # usa la suya, sin cambiar el inodo que ya enlazan otras sesiones
+                try:
+                    os.link(tmp, ruta)
+                except FileExistsError:
+                    reutilizada = True
+                enlazada = _enlazar(ruta, destino)
+        finally:
+            tmp.unlink(missing_ok=True)
+
+    with _lock:
+        _stats["reutilizadas" if reutilizada else "nuevas"] += 1
+        if not enlazada:
+            _stats["copias_sin_link"] += 1
+    return reutilizada
+
+
+def liberar_instancias(claves: Iterable[str]) -> int:
+    """
+    Borra del CAS las instancias que ya no enlaza ninguna sesión. Llamar
+    después de borrar los archivos de la sesión.
+    """
+    liberadas = 0
+    for clave in set(claves):
+        ruta = ruta_cas(clave)
+        with _lock_enlaces:
+            try:
+                if os.stat(ruta).st_nlink <= 1:
+                    os.unlink(ruta)
+                    liberadas += 1
+            except FileNotFoundError:
+                continue
+
+    with _lock:
+        _stats["liberadas"] += liberadas
+    return liberadas
+
+
+def rehidratar_serie(session_id: str) -> bool:
+    """
+    Reconstruye SERIES_DIR/<session_id> desde el backend: baja mapping.json,
+    enlaza cada instancia del CAS (trayéndola si falta en este nodo) y baja
+    las que no tienen clave CAS. mapping.json se escribe lo último, así que
+    su presencia implica serie completa. False si el backend no la tiene.
+    """
+    if not es_remoto():
+        return False
+
+    carpeta = SERIES_DIR / session_id
+    mapping_path = carpeta / "mapping.json"
+    tmp = carpeta / f"mapping.json.{uuid.uuid4().hex}.tmp"
+    try:
+        if not obtener_backend().descargar(clave_de(mapping_path), tmp):
+            return False
+        with open(tmp, "r", encoding="utf-8") as f:
+            mapping = json.load(f)
+
+        faltan = 0
+        for entrada in mapping.values():
+            destino = carpeta / entrada["dicom_name"]
+            if destino.is_file():
+                continue
+            clave = entrada.get("cas")
+            if clave is None:
+                faltan += not rehidratar(destino)
+                continue
+            ruta = ruta_cas(clave)
+            if _enlazar_existente(ruta, destino) is None:
+                if not rehidratar(ruta) or _enlazar_existente(ruta, destino) is None:
+                    faltan += 1
+
+        if faltan:
+            print(f"⚠️ Serie {session_id} rehidratada con {faltan} instancias ausentes del backend")
+        os.replace(tmp, mapping_path)
+        return True
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+def _enlazar_existente(ruta: Path, destino: Path) -> Optional[bool]:
+    """_enlazar si la instancia está en el CAS local; None si no está."""
+    with _lock_enlaces:
+        if not ruta.is_file():
+            return None
+        return _enlazar(ruta, destino)
+
+
+def _enlazar(ruta: Path, destino: Path) -> bool:
+    # Hard link (o copia si no es posible) vía temporal: peticiones simultáneas
+    # sobre la misma sesión nunca ven el destino a medio escribir
+    tmp = destino.with_name(f".{destino.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        os.link(ruta, tmp)
+        enlazada = True
+    except OSError:
+        with open(ruta, "rb") as origen, open(tmp, "wb") as f:
+            shutil.copyfileobj(origen, f)
+        enlazada = False
+    os.replace(tmp, destino)
+    return enlazada
+
+
+def ruta_cas(clave: str) -> Path:
+    return INSTANCIAS_CAS_DIR / clave[:2] / f"{clave}.dcm"
+
+
+def estadisticas_cas() -> dict:
+    with _lock:
+        return dict(_stats)
@@ -0,0 +1,169 @@
+# api/services/compresion_service.py
+import argparse
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import pydicom
+from pydicom.uid import DeflatedExplicitVRLittleEndian, JPEG2000Lossless, RLELossless
+
+# Importar rutas persistentes desde config.paths
+from config.paths import SERIES_DIR
+
+# ==============================================================
+# Compresión sin pérdida de los DICOM al guardarlos (opcional)
+# ==============================================================
+# Con DICOM_COMPRESION activo, cada instancia NUEVA se re-codifica antes de
+# escribirse en el CAS:
+#   rle      RLE Lossless (codificador nativo de pydicom)
+#   j2k      JPEG 2000 Lossless (pylibjpeg-openjpeg, ya en requirements)
+#   deflate  Deflated Explicit VR Little Endian (zlib sobre todo el dataset)
+# El resultado se decodifica y se compara con los píxeles originales; si no
+# coincide, falla el codificador o no ahorra bytes, se guarda el original.
+#
+# Nunca se reescribe un archivo ya almacenado: las instancias del CAS están
+# enlazadas (hard links) desde varias sesiones y las cachés derivadas se
+# indexan por inodo + mtime.
+
+DICOM_COMPRESION = os.getenv("DICOM_COMPRESION", "").strip().lower()
+
+MODOS = {
+    "rle": RLELossless,
+    "j2k": JPEG2000Lossless,
+    "deflate": DeflatedExplicitVRLittleEndian,
+}
+
+_lock = threading.Lock()
+_stats = {"comprimidas": 0, "sin_cambio": 0, "errores": 0, "bytes_entrada": 0, "bytes_salida": 0}
+
+
+def comprimir_dicom(datos: bytes, modo: Optional[str] = None) -> bytes:
+    """Bytes del DICOM re-codificado sin pérdida, o los originales si no procede."""
+    modo = DICOM_COMPRESION if modo is None else modo
+    uid = MODOS.get(modo)
+    if uid is None:
+        return datos
+
+    try:
+        ds = pydicom.dcmread(io.BytesIO(datos), force=True)
+        sintaxis = getattr(ds.get("file_meta"), "TransferSyntaxUID", None)
+        if (
+            "PixelData" not in ds
+            or sintaxis is None
+            or sintaxis.is_compressed
+            or sintaxis.is_deflated
+        ):
+            _contar("sin_cambio", len(datos), len(datos))
+            return datos
+
+        original = np.array(ds.pixel_array)
+        if modo == "deflate":
+            ds.file_meta.TransferSyntaxUID = uid
+        else:
+            ds.compress(uid)
+
+        buffer = io.BytesIO()
+        ds.save_as(buffer, enforce_file_format=True)
+        salida = buffer.getvalue()
+
+        if not np.array_equal(pydicom.dcmread(io.BytesIO(salida), force=True).pixel_array, original):
+            raise ValueError("la decodificación no reproduce los píxeles originales")
+    except Exception as e:
+        print(f"⚠️ No se pudo comprimir ({modo}): {e}")
+        _contar("errores", len(datos), len(datos))
+        return datos
+
+    if len(salida) >= len(datos):
+        _contar("sin_cambio", len(datos), len(datos))
+        return datos
+
+    _contar("comprimidas", len(datos), len(salida))
+    return salida
+
+
+def _contar(resultado: str, entrada: int, salida: int) -> None:
+    with _lock:
+        _stats[resultado] += 1
+        _stats["bytes_entrada"] += entrada
+        _stats["bytes_salida"] += salida
+
+
+def estadisticas_compresion() -> dict:
+    with _lock:
+        ratio = _stats["bytes_salida"] / _stats["bytes_entrada"] if _stats["bytes_entrada"] else None
+        return {**_stats, "modo": DICOM_COMPRESION or None, "ratio": round(ratio, 4) if ratio else None}
+
+
+# ==============================================================
+# Benchmark: python -m api.services.compresion_service <session_id|carpeta>
+# ==============================================================
+# Copia los DICOM de una serie comprimidos con cada modo a una carpeta
+# temporal y mide tamaño total y tiempo de lectura + decodificación de la
+# serie entera (como _load_stack), sin pasar por la caché de píxeles.
+
+def _leer_serie(rutas: list) -> float:
+    inicio = time.perf_counter()
+    for ruta in rutas:
+        pydicom.dcmread(ruta, force=True).pixel_array
+    return time.perf_counter() - inicio
+
+
+def benchmark(carpeta: Path, modos: list, repeticiones: int = 3) -> dict:
+    rutas = sorted(p for p in carpeta.iterdir() if p.suffix.lower() == ".dcm")
+    if not rutas:
+        raise ValueError(f"No hay .dcm en {carpeta}")
+
+    resultados = {
+        "original": {
+            "bytes": sum(p.stat().st_size for p in rutas),
+            "lectura_s": min(_leer_serie(rutas) for _ in range(repeticiones)),
+        }
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for modo in modos:
+            destino = Path(tmp) / modo
+            destino.mkdir()
+            inicio = time.perf_counter()
+            comprimidas = []
+            for ruta in rutas:
+                salida = destino / ruta.name
+                salida.write_bytes(comprimir_dicom(ruta.read_bytes(), modo))
+                comprimidas.append(salida)
+
+            resultados[modo] = {
+                "bytes": sum(p.stat().st_size for p in comprimidas),
+                "compresion_s": time.perf_counter() - inicio,
+                "lectura_s": min(_leer_serie(comprimidas) for _ in range(repeticiones)),
+            }
+
+    base = resultados["original"]
+    for r in resultados.values():
+        r["ratio_bytes"] = round(r["bytes"] / base["bytes"], 4)
+        r["ratio_lectura"] = round(r["lectura_s"] / base["lectura_s"], 4)
+    return {"carpeta": str(carpeta), "slices": len(rutas), "resultados": resultados}
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Compara tamaño y tiempo de lectura de una serie comprimida")
+    parser.add_argument("serie", help="session_id o carpeta con .dcm")
+    parser.add_argument("--modos", default="rle,deflate,j2k", help="modos separados por coma")
+    parser.add_argument("--repeticiones", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    carpeta = Path(args.serie)
+    if not carpeta.is_dir():
+        carpeta = SERIES_DIR / args.serie
+
+    modos = [m for m in args.modos.split(",") if m in MODOS]
+    print(json.dumps(benchmark(carpeta, modos, args.repeticiones), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+# api/services/derivados_service.py
+import asyncio
+import logging
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from starlette.exceptions import HTTPException
+from starlette.responses import RedirectResponse
+from starlette.staticfiles import StaticFiles
+
+from api.services.almacenamiento_service import rehidratar
+from api.services.artefactos_service import EXTENSIONES_DERIVADAS, regenerar_artefacto
+from api.services.cas_service import rehidratar_serie
+from api.services.segmentation_services import regenerar_mascara_2d
+from api.utils.executors import ejecutar_io
+
+# Importar rutas persistentes desde config.paths
+from config.paths import (
+    ARTEFACTOS_DIR,
+    BASE_STATIC_DIR,
+    RENDER_CACHE_DIR,
+    SEGMENTATIONS_2D_DIR,
+    SERIES_DIR,
+)
+
+logger = logging.getLogger(__name__)
+
+# ==============================================================
+# Presupuesto de disco para artefactos derivados (LRU)
+# ==============================================================
+# Todo lo que hay en /data/static es fuente (DICOM, mapping, máscaras 3D .npy,
+# volumen) o derivado (PNG de slices, máscaras 2D, miniaturas 3D, STL).
+# Los derivados se pueden borrar sin perder nada: cuando el uso del volumen
+# pasa de DISCO_PRESUPUESTO_BYTES se desalojan por último acceso (mtime, que
+# se actualiza al servirlos) hasta bajar a DISCO_OBJETIVO del presupuesto.
+# Al pedir por /static uno desalojado, se regenera y se sirve.
+#
+# Los renders de slices no pasan por /static: el visor los regenera solo.
+# Las URLs antiguas /static/series/<sid>/image_N.png (PNG generados en la
+# ingesta) redirigen al render perezoso cuando el PNG no existe.
+#
+# Los reportes PDF no entran en el presupuesto: cada uno documenta el estudio
+# en la fecha de su nombre, y regenerarlo daría otro contenido con esa fecha.
+#
+# Con un backend de almacenamiento remoto, lo que falta en este nodo se trae
+# primero del backend (fuentes incluidas) y solo después se regenera.
+
+# 0 = 90 % de la capacidad del volumen
+DISCO_PRESUPUESTO_BYTES = int(os.getenv("DISCO_PRESUPUESTO_BYTES", 0))
+DISCO_OBJETIVO = 0.9
+DERIVADOS_INTERVALO_S = float(os.getenv("DERIVADOS_INTERVALO_S", 300))
+
+# Un acceso solo reescribe el mtime si el anterior es más viejo que esto
+ACCESO_RESOLUCION_S = 60
+
+# (clase, raíz, es_derivado(ruta), regenerar(ruta) -> bool | None)
+CLASES = [
+    ("render", RENDER_CACHE_DIR, lambda r: r.suffix == ".png", None),
+    ("mascara_2d", SEGMENTATIONS_2D_DIR, lambda r: r.name.endswith("_mask.png"), regenerar_mascara_2d),
+    ("artefacto", ARTEFACTOS_DIR, lambda r: r.suffix in EXTENSIONES_DERIVADAS, regenerar_artefacto),
+]
+
+_lock = threading.Lock()
+_regenerando = {}
+_stats = {"desalojados": 0, "bytes_liberados": 0, "regenerados": 0, "fallos_regeneracion": 0, "pasadas": 0}
+_tarea = None
+
+
+def clasificar(ruta) -> Optional[tuple]:
+    """Clase de un archivo derivado, o None si es fuente (o está fuera del volumen)."""
+    ruta = Path(os.path.realpath(ruta))
+    for clase in CLASES:
+        raiz = Path(os.path.realpath(clase[1]))
+        if raiz in ruta.parents and "tmp" not in ruta.relative_to(raiz).parts and clase[2](ruta):
+            return clase
+    return None
+
+
+def registrar_acceso(ruta) -> None:
+    """Marca un derivado como recién usado (actualiza su mtime, con resolución gruesa)."""
+    if clasificar(ruta) is None:
+        return
+    try:
+        if time.time() - os.stat(ruta).st_mtime > ACCESO_RESOLUCION_S:
+            os.utime(ruta)
+    except FileNotFoundError:
+        pass
+
+
+def regenerar_derivado(ruta) -> bool:
+    """
+    Regenera un derivado que ya no está en disco. Peticiones simultáneas del
+    mismo archivo esperan a una sola regeneración.
+    """
+    clase = clasificar(ruta)
+    if clase is None or clase[3] is None:
+        return False
+
+    ruta = Path(ruta)
+    with _lock:
+        evento = _regenerando.get(ruta)
+        propio = evento is None
+        if propio:
+            evento = _regenerando[ruta] = threading.Event()
+
+    if not propio:
+        evento.wait()
+        return ruta.is_file()
+
+    try:
+        if ruta.is_file():
+            return True
+        ok = clase[3](ruta)
+    except Exception as exc:
+        logger.warning(f"No se pudo regenerar {ruta}: {exc}")
+        ok = False
+    finally:
+        with _lock:
+            _regenerando.pop(ruta, None)
+        evento.set()
+
+    with _lock:
+        _stats["regenerados" if ok else "fallos_regeneracion"] += 1
+    return ok
+
+
+def presupuesto_bytes() -> int:
+    if DISCO_PRESUPUESTO_BYTES > 0:
+        return DISCO_PRESUPUESTO_BYTES
+    return int(shutil.disk_usage(BASE_STATIC_DIR).total * 0.9)
+
+
+def desalojar_derivados(presupuesto: Optional[int] = None) -> dict:
+    """
+    Si el volumen supera el presupuesto, borra derivados del más antiguo al
+    más reciente hasta liberar el exceso (más el margen de DISCO_OBJETIVO).
+    """
+    presupuesto = presupuesto or presupuesto_bytes()
+    usado = shutil.disk_usage(BASE_STATIC_DIR).used
+    resultado = {"usado": usado, "presupuesto": presupuesto, "desalojados": 0, "bytes_liberados": 0}
+    if usado <= presupuesto:
+        return resultado
+
+    exceso = usado - int(presupuesto * DISCO_OBJETIVO)
+
+    entradas = []
+    for _, raiz, es_derivado, _ in CLASES:
+        for ruta, st in _recorrer(raiz):
+            if es_derivado(ruta):
+                entradas.append((st.st_mtime, st.st_size, ruta))
+    entradas.sort()
+
+    for _, size, ruta in entradas:
+        if resultado["bytes_liberados"] >= exceso:
+            break
+        try:
+            os.remove(ruta)
+        except FileNotFoundError:
+            continue
+        resultado["desalojados"] += 1
+        resultado["bytes_liberados"] += size
+
+    with _lock:
+        _stats["desalojados"] += resultado["desalojados"]
+        _stats["bytes_liberados"] += resultado["bytes_liberados"]
+    if resultado["desalojados"]:
+        logger.info(
+            f"Desalojados {resultado['desalojados']} derivados "
+            f"({resultado['bytes_liberados']} bytes) por presupuesto de disco"
+        )
+    return resultado
+
+
+def _recorrer(raiz: Path):
+    pendientes = [str(raiz)]
+    while pendientes:
+        carpeta = pendientes.pop()
+        try:
+            entradas = os.scandir(carpeta)
+        except FileNotFoundError:
+            continue
+        with entradas:
+            for entrada in entradas:
+                try:
+                    if entrada.is_dir(follow_symlinks=False):
+                        if entrada.name != "tmp":
+                            pendientes.append(entrada.path)
+                    elif entrada.is_file(follow_symlinks=False):
+                        yield Path(entrada.path), entrada.stat()
+                except FileNotFoundError:
+                    continue
+
+
+# ==============================================================
+# /static con registro de acceso y regeneración
+# ==============================================================
+
+def rehidratar_estatico(ruta) -> bool:
+    """Trae del backend un archivo de /static; las series se traen enteras."""
+    ruta = Path(os.path.abspath(ruta))
+    if not ruta.is_relative_to(os.path.abspath(BASE_STATIC_DIR)):
+        return False
+    series = Path(os.path.abspath(SERIES_DIR))
+    if ruta.is_relative_to(series):
+        partes = ruta.relative_to(series).parts
+        return len(partes) > 1 and rehidratar_serie(partes[0]) and ruta.is_file()
+    return rehidratar(ruta)
+
+
+def url_slice_legado(ruta) -> Optional[str]:
+    """URL del render perezoso para un PNG de slice con la ruta antigua, o None."""
+    ruta = Path(os.path.abspath(ruta))
+    if ruta.parent.parent != Path(os.path.abspath(SERIES_DIR)):
+        return None
+    if not (ruta.name.startswith("image_") and ruta.suffix == ".png"):
+        return None
+    return f"/series/{ruta.parent.name}/imagenes/{ruta.name}"
+
+
+class StaticConRegeneracion(StaticFiles):
+    """StaticFiles que marca el acceso a derivados y trae o regenera los que faltan."""
+
+    async def get_response(self, path: str, scope):
+        try:
+            respuesta = await super().get_response(path, scope)
+        except HTTPException as exc:
+            if exc.status_code != 404:
+                raise
+            ruta = Path(self.directory) / path
+            if not (
+                await ejecutar_io(rehidratar_estatico, ruta)
+                or await ejecutar_io(regenerar_derivado, ruta)
+            ):
+                url = url_slice_legado(ruta)
+                if url is None:
+                    raise
+                return RedirectResponse(url, status_code=301)
+            return await super().get_response(path, scope)
+
+        ruta = getattr(respuesta, "path", None)
+        if ruta is not None:
+            await ejecutar_io(registrar_acceso, ruta)
+        return respuesta
+
+
+# ==============================================================
+# Vigilancia periódica del presupuesto
+# ==============================================================
+
+async def _bucle_presupuesto():
+    while True:
+        await asyncio.sleep(DERIVADOS_INTERVALO_S)
+        try:
+            await ejecutar_io(desalojar_derivados)
+        except Exception as exc:
+            logger.warning(f"Desalojo de derivados falló: {exc}")
+        with _lock:
+            _stats["pasadas"] += 1
+
+
+def iniciar_presupuesto_disco() -> None:
+    global _tarea
+    if _tarea is None or _tarea.done():
+        _tarea = asyncio.get_running_loop().create_task(_bucle_presupuesto())
+
+
+def detener_presupuesto_disco() -> None:
+    global _tarea
+    if _tarea is not None:
+        _tarea.cancel()
+        _tarea = None
+
+
+def estadisticas_derivados() -> dict:
+    uso = shutil.disk_usage(BASE_STATIC_DIR)
+    with _lock:
+        return {**_stats, "usado": uso.used, "presupuesto": presupuesto_bytes()}
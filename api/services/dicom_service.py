@@ -1,101 +1,307 @@
+import functools
+import hashlib
 import json
 import os
 import io
 import uuid
 import zipfile
-from typing import List
-from skimage import exposure
+from typing import Callable, List, Optional, Tuple, Union
 import pydicom
-from PIL import Image
-import numpy as np
 
 from .segmentation_services import get_or_create_archivo_dicom
+from .metadatos_service import extraer_metadatos, guardar_metadatos_serie
+from .cas_service import clave_instancia, guardar_instancia
+from .compresion_service import comprimir_dicom
+from .almacenamiento_service import publicar
+from .manifiesto_service import registrar
 
 # Importar rutas persistentes desde config.paths
 from config.paths import SERIES_DIR
 
 
-def convert_dicom_zip_to_png_paths(zip_file: bytes, user_id: int) -> dict:
+# Cada cuántos slices se reescribe mapping.json durante la ingesta, para que
+# los slices ya procesados se puedan ver antes de que termine la serie
+MAPPING_FLUSH_CADA = int(os.getenv("MAPPING_FLUSH_CADA", 10))
+
+
+def convert_dicom_zip_to_png_paths(
+    zip_file: Union[bytes, str],
+    user_id: int,
+    session_id: Optional[str] = None,
+    progreso: Optional[Callable[[dict], None]] = None,
+    nombres: Optional[List[str]] = None,
+) -> dict:
+    """
+    Registra los DICOMs de un ZIP y genera mapping.json dentro del volumen
+    persistente. Los PNG no se generan aquí: se renderizan bajo demanda en
+    /series/{session_id}/imagenes/{image_name} (ver render_service).
+
+    `zip_file` puede ser el contenido (bytes) o la ruta de un ZIP en disco.
+    `progreso`, si se indica, recibe un evento (dict) por cada slice procesado.
+    `nombres` limita la sesión a esos miembros (una serie de un ZIP con varias).
+    """
+    # 2️⃣ Leer archivo ZIP
+    with zipfile.ZipFile(_fuente_zip(zip_file)) as archive:
+
+        dcm_files = nombres if nombres is not None else _nombres_dicom(archive)
+        if not dcm_files:
+            raise ValueError("No se encontraron archivos DICOM en el ZIP.")
+
+        miembros = [(name, functools.partial(archive.read, name)) for name in dcm_files]
+        return _convertir_miembros(miembros, user_id, session_id, progreso)
+
+
+def convert_dicom_zip_to_series(zip_file: Union[bytes, str], user_id: int) -> dict:
+    """
+    Ingesta síncrona de un ZIP que puede traer varias series: una sesión por
+    SeriesInstanceUID, procesadas una tras otra dentro del trabajo de CPU de
+    la petición. La respuesta conserva los campos de una sola sesión (la
+    serie con más archivos) y añade `series` con el resultado de cada una.
+    """
+    grupos = agrupar_zip_por_serie(zip_file)
+    if not grupos:
+        raise ValueError("No se encontraron archivos DICOM en el ZIP.")
+
+    def ingerir(grupo):
+        try:
+            resultado = convert_dicom_zip_to_png_paths(zip_file, user_id, nombres=grupo["miembros"])
+            return {"series_instance_uid": grupo["series_instance_uid"], **resultado}
+        except Exception as e:
+            return {"series_instance_uid": grupo["series_instance_uid"], "error": str(e)}
+
+    series = [ingerir(grupo) for grupo in grupos]
+
+    correctas = [r for r in series if "error" not in r]
+    if not correctas:
+        raise ValueError(series[0]["error"])
+
+    return {**correctas[0], "series": series}
+
+
+def agrupar_zip_por_serie(zip_file: Union[bytes, str]) -> List[dict]:
+    """Agrupa los miembros del ZIP por SeriesInstanceUID (ver _agrupar_por_serie)."""
+    with zipfile.ZipFile(_fuente_zip(zip_file)) as archive:
+        return _agrupar_por_serie(_nombres_dicom(archive), archive.open)
+
+
+def agrupar_archivos_por_serie(archivos: List[Tuple[str, str]]) -> List[dict]:
+    """Igual que agrupar_zip_por_serie para (nombre, ruta) ya extraídos."""
+    return _agrupar_por_serie(archivos, lambda archivo: open(archivo[1], "rb"))
+
+
+def _agrupar_por_serie(items: list, abrir: Callable) -> List[dict]:
+    """
+    Pasada solo-cabecera (se detiene antes de PixelData): devuelve
+    [{"series_instance_uid", "miembros"}], de la serie con más archivos a la
+    de menos, conservando el orden original dentro de cada una. Los archivos
+    sin cabecera legible o sin UID van con la serie principal, donde la
+    ingesta los reporta como error/omitido igual que antes.
+    """
+    grupos = {}
+    sin_serie = []
+
+    for item in items:
+        try:
+            with abrir(item) as f:
+                ds = pydicom.dcmread(
+                    f, force=True, stop_before_pixels=True, specific_tags=["SeriesInstanceUID"]
+                )
+            uid = str(ds.get("SeriesInstanceUID", "") or "").strip()
+        except Exception:
+            uid = ""
+
+        if uid:
+            grupos.setdefault(uid, []).append(item)
+        else:
+            sin_serie.append(item)
+
+    ordenados = sorted(grupos.items(), key=lambda kv: -len(kv[1]))
+    if not ordenados:
+        return [{"series_instance_uid": None, "miembros": sin_serie}] if sin_serie else []
+
+    resultado = [{"series_instance_uid": uid, "miembros": miembros} for uid, miembros in ordenados]
+    if sin_serie:
+        posicion = {id(item): i for i, item in enumerate(items)}
+        principal = resultado[0]["miembros"] + sin_serie
+        resultado[0]["miembros"] = sorted(principal, key=lambda item: posicion[id(item)])
+    return resultado
+
+
+def _fuente_zip(zip_file: Union[bytes, str]):
+    return io.BytesIO(zip_file) if isinstance(zip_file, (bytes, bytearray)) else zip_file
+
+
+def _nombres_dicom(archive: zipfile.ZipFile) -> List[str]:
+    return [
+        f for f in archive.namelist()
+        if f.lower().endswith((".dcm", "")) and not f.endswith("/")
+    ]
+
+
+def convert_dicom_files_to_png_paths(
+    archivos: List[Tuple[str, str]],
+    user_id: int,
+    session_id: Optional[str] = None,
+    progreso: Optional[Callable[[dict], None]] = None,
+) -> dict:
     """
-    Convierte un archivo ZIP con múltiples DICOMs en imágenes PNG
-    y genera mapping.json dentro del volumen persistente.
+    Igual que convert_dicom_zip_to_png_paths, pero a partir de archivos ya
+    extraídos en disco: lista de (nombre original en el ZIP, ruta local).
     """
+    if not archivos:
+        raise ValueError("No se encontraron archivos DICOM en el ZIP.")
+
+    miembros = [(nombre, functools.partial(_leer_bytes, ruta)) for nombre, ruta in archivos]
+    return _convertir_miembros(miembros, user_id, session_id, progreso)
+
+
+def _comprimir_hasheando(hashes: dict, ruta, datos: bytes) -> bytes:
+    salida = comprimir_dicom(datos)
+    hashes[str(ruta)] = hashlib.sha256(salida).hexdigest()
+    return salida
+
+
+def _leer_bytes(ruta: str) -> bytes:
+    with open(ruta, "rb") as f:
+        return f.read()
+
+
+def _convertir_miembros(
+    miembros: List[Tuple[str, Callable[[], bytes]]],
+    user_id: int,
+    session_id: Optional[str],
+    progreso: Optional[Callable[[dict], None]],
+) -> dict:
 
     # 1️⃣ Crear carpeta única por sesión dentro del volumen /data/static/series
-    session_id = str(uuid.uuid4())
+    session_id = session_id or str(uuid.uuid4())
     output_dir = SERIES_DIR / session_id
     output_dir.mkdir(parents=True, exist_ok=True)
 
     dicom_mapping = {}
     image_paths = []
+    metadatos = []
+    hashes = {}
+    reutilizadas = 0
 
-    # 2️⃣ Leer archivo ZIP
-    with zipfile.ZipFile(io.BytesIO(zip_file)) as archive:
+    def notificar(tipo: str, **datos):
+        if progreso is not None:
+            progreso({"tipo": tipo, **datos})
 
-        dcm_files = [f for f in archive.namelist() if f.lower().endswith((".dcm", ""))]
-        if not dcm_files:
-            raise ValueError("No se encontraron archivos DICOM en el ZIP.")
+    total = len(miembros)
+    notificar("inicio", session_id=session_id, total=total)
 
-        for idx, dicom_name in enumerate(dcm_files):
-            try:
-                with archive.open(dicom_name) as file:
-                    dicom_bytes = file.read()
+    for idx, (dicom_name, leer) in enumerate(miembros):
+        try:
+            dicom_bytes = leer()
 
-                dicom_output_path = output_dir / os.path.basename(dicom_name)
+            dicom_output_path = output_dir / os.path.basename(dicom_name)
 
-                with open(dicom_output_path, "wb") as f:
-                    f.write(dicom_bytes)
-
-                ds = pydicom.dcmread(io.BytesIO(dicom_bytes), force=True)
-                if "PixelData" not in ds:
-                    print(f"⚠️ Archivo sin datos de imagen: {dicom_name}")
-                    continue
+            # Solo cabecera: los píxeles se decodifican al pedir el slice (render perezoso)
+            ds = pydicom.dcmread(io.BytesIO(dicom_bytes), force=True, defer_size=1024)
 
-                image = ds.pixel_array.astype(np.float32)
+            # Instancias ya subidas (mismo SOPInstanceUID y píxeles) se enlazan
+            # a la copia existente en el CAS en lugar de escribirse otra vez;
+            # las nuevas se comprimen sin pérdida si DICOM_COMPRESION está activo.
+            # El sha256 del manifiesto sale de los bytes escritos; el de las
+            # reutilizadas (no se escriben) lo calcula registrar leyendo el CAS
+            clave_cas = clave_instancia(ds)
+            reutilizada = False
+            if clave_cas is not None:
+                reutilizada = guardar_instancia(
+                    clave_cas,
+                    dicom_bytes,
+                    dicom_output_path,
+                    transformar=functools.partial(_comprimir_hasheando, hashes, dicom_output_path),
+                )
+                if reutilizada:
+                    hashes.pop(str(dicom_output_path), None)
+                reutilizadas += reutilizada
+            else:
+                with open(dicom_output_path, "wb") as f:
+                    f.write(_comprimir_hasheando(hashes, dicom_output_path, dicom_bytes))
+                publicar(dicom_output_path)
 
-                if np.max(image) > 1:
-                    image = (image - np.min(image)) / (np.max(image) - np.min(image) + 1e-6)
+            if "PixelData" not in ds:
+                print(f"⚠️ Archivo sin datos de imagen: {dicom_name}")
+                notificar("omitido", indice=idx, nombre=dicom_name, total=total)
+                continue
 
-                try:
-                    image = exposure.equalize_adapthist(image)
-                except Exception:
-                    image = np.clip(image, 0, 1)
+            png_filename = f"image_{idx}.png"
 
-                image = (image * 255).astype("uint8")
-                im = Image.fromarray(image).convert("L")
+            archivo_id = get_or_create_archivo_dicom(
+                nombrearchivo=os.path.basename(dicom_name),
+                rutaarchivo=str(dicom_output_path),
+                sistemaid=1,
+                user_id=user_id,
+            )
 
-                png_filename = f"image_{idx}.png"
-                png_path = output_dir / png_filename
-                im.save(png_path)
+            dicom_mapping[png_filename] = {
+                "dicom_name": os.path.basename(dicom_name),
+                "archivodicomid": archivo_id,
+                "cas": clave_cas,
+            }
+            metadatos.append(
+                {**extraer_metadatos(ds), "archivodicomid": archivo_id, "image_name": png_filename}
+            )
 
-                archivo_id = get_or_create_archivo_dicom(
-                    nombrearchivo=os.path.basename(dicom_name),
-                    rutaarchivo=str(dicom_output_path),
-                    sistemaid=1,
-                    user_id=user_id,
-                )
+            image_url = f"/series/{session_id}/imagenes/{png_filename}"
+            image_paths.append(image_url)
 
-                dicom_mapping[png_filename] = {
-                    "dicom_name": os.path.basename(dicom_name),
-                    "archivodicomid": archivo_id,
-                }
+            if len(dicom_mapping) % MAPPING_FLUSH_CADA == 0:
+                _escribir_mapping(output_dir, dicom_mapping)
 
-                image_paths.append(f"/static/series/{session_id}/{png_filename}")
+            notificar(
+                "slice",
+                indice=idx,
+                image_name=png_filename,
+                image=image_url,
+                reutilizada=reutilizada,
+                procesados=len(image_paths),
+                total=total,
+            )
 
-            except Exception as e:
-                print(f"⚠️ Error procesando {dicom_name}: {e}")
-                continue
+        except Exception as e:
+            print(f"⚠️ Error procesando {dicom_name}: {e}")
+            notificar("error_slice", indice=idx, nombre=dicom_name, error=str(e), total=total)
+            continue
 
     if not image_paths:
         raise ValueError("No se pudieron procesar archivos DICOM válidos.")
 
-    mapping_path = output_dir / "mapping.json"
-    with open(mapping_path, "w", encoding="utf-8") as f:
-        json.dump(dicom_mapping, f, ensure_ascii=False, indent=2)
+    _escribir_mapping(output_dir, dicom_mapping)
+    # Último: en el backend, mapping.json publicado = serie completa
+    publicar(output_dir / "mapping.json")
+
+    # Sin manifiesto se reconstruye desde disco en la primera lectura
+    try:
+        registrar(
+            session_id,
+            [output_dir / m["dicom_name"] for m in dicom_mapping.values()] + [output_dir / "mapping.json"],
+            hashes=hashes,
+        )
+    except Exception as e:
+        print(f"⚠️ No se pudo registrar el manifiesto de {session_id}: {e}")
+
+    # El índice de metadatos no bloquea la ingesta si falla
+    try:
+        guardar_metadatos_serie(session_id, user_id, metadatos)
+    except Exception as e:
+        print(f"⚠️ No se pudo indexar metadatos de {session_id}: {e}")
 
     return {
         "message": "ZIP procesado correctamente",
         "session_id": session_id,
         "image_series": image_paths,
+        "reutilizadas": reutilizadas,
         "mapping_url": f"/static/series/{session_id}/mapping.json",
     }
+
+
+def _escribir_mapping(output_dir, dicom_mapping: dict) -> None:
+    """Escribe mapping.json de forma atómica (nunca se lee a medio escribir)."""
+    mapping_path = output_dir / "mapping.json"
+    tmp_path = output_dir / "mapping.json.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(dicom_mapping, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, mapping_path)
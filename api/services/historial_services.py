@@ -1,8 +1,11 @@
 import os
 import re
-import shutil
 from typing import List, Dict
 from config.db_config import get_connection
+from api.services.borrado_service import despertar_borrados, marcar_borrado
+from api.services.cache_service import invalidar_mapping
+from api.services.manifiesto_service import contiene, leer_manifiesto, quitar
+from api.services.volumen_service import invalidar_volumen
 
 # Importamos las rutas persistentes DESDE config.paths
 from config.paths import SERIES_DIR, BASE_STATIC_DIR, SEGMENTATIONS_2D_DIR
@@ -67,18 +70,21 @@ def obtener_historial_archivos(user_id: int) -> List[Dict]:
     rows = cursor.fetchall()
 
     series_dict = {}
+    manifiestos = {}
 
     for row in rows:
         ruta_relativa = row[2]
-        ruta_absoluta = ruta_relativa
-
-        if not os.path.exists(ruta_absoluta):
-            continue
 
         session_id = extraer_session_id(ruta_relativa)
         if not session_id:
             continue
 
+        # Un manifiesto por sesión en lugar de un stat por archivo
+        if session_id not in manifiestos:
+            manifiestos[session_id] = leer_manifiesto(session_id)
+        if not _en_manifiesto(manifiestos[session_id], ruta_relativa):
+            continue
+
         if session_id not in series_dict:
             seg_count = contar_segmentaciones_por_session(conn, session_id, user_id)
 
@@ -99,7 +105,11 @@ def obtener_historial_archivos(user_id: int) -> List[Dict]:
 
 
 def eliminar_serie_por_session_id(session_id: str, user_id: int) -> None:
-    """Elimina una serie completa de /data/static."""
+    """
+    Elimina una serie: borra sus filas y deja la lápida en la misma
+    transacción. Los archivos de /data/static los borra el worker de
+    borrado_service (ver estado_borrado).
+    """
     conn = get_connection()
     cursor = conn.cursor()
 
@@ -109,22 +119,35 @@ def eliminar_serie_por_session_id(session_id: str, user_id: int) -> None:
         conn.close()
         raise ValueError("SERIE_CON_SEGMENTACIONES")
 
-    cursor.execute(
-        "DELETE FROM archivodicom WHERE rutaarchivo LIKE %s AND user_id = %s",
-        [f"%{session_id}%", user_id],
-    )
-    conn.commit()
+    try:
+        cursor.execute(
+            "DELETE FROM serie_dicom WHERE session_id = %s AND user_id = %s",
+            [session_id, user_id],
+        )
+        cursor.execute(
+            "DELETE FROM archivodicom WHERE rutaarchivo LIKE %s AND user_id = %s",
+            [f"%{session_id}%", user_id],
+        )
+        marcar_borrado(cursor, session_id, user_id)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
 
-    ruta_series = SERIES_DIR / session_id
-    if ruta_series.is_dir():
-        shutil.rmtree(ruta_series)
+    invalidar_mapping(session_id)
+    invalidar_volumen(session_id)
+    despertar_borrados()
 
-    ruta_masks = SEGMENTATIONS_DIR / session_id
-    if ruta_masks.is_dir():
-        shutil.rmtree(ruta_masks)
 
-    cursor.close()
-    conn.close()
+def _en_manifiesto(manifiesto: dict, ruta: str) -> bool:
+    try:
+        return contiene(manifiesto, ruta)
+    except ValueError:
+        # Rutas antiguas fuera de /data/static
+        return os.path.exists(ruta)
 
 
 def _basename_sin_ext(ruta: str) -> str:
@@ -154,6 +177,7 @@ def listar_segmentaciones_por_session_id(session_id: str, user_id: int) -> List[
     cur.close()
     conn.close()
 
+    manifiesto = leer_manifiesto(session_id)
     resultados = []
 
     for (
@@ -172,7 +196,7 @@ def listar_segmentaciones_por_session_id(session_id: str, user_id: int) -> List[
 
         mask_abs = SEGMENTATIONS_DIR / session_id / mask_filename
 
-        if mask_abs.is_file():
+        if contiene(manifiesto, mask_abs):
             mask_public = f"/static/segmentations/{session_id}/{mask_filename}"
         else:
             mask_public = None
@@ -228,11 +252,14 @@ def eliminar_segmentacion_por_archivo(session_id: str, archivodicomid: int, user
         )
         conn.commit()
 
-        if mask_abs.is_file():
+        # Máscara y resultado memorizado de la segmentación
+        rutas = (mask_abs, mask_abs.with_suffix(".json"))
+        for ruta in rutas:
             try:
-                mask_abs.unlink()
+                ruta.unlink()
             except Exception:
                 pass
+        quitar(session_id, rutas)
 
         cur.close()
         conn.close()
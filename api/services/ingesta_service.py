@@ -0,0 +1,316 @@
+# api/services/ingesta_service.py
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple, Union
+
+from api.services.dicom_service import (
+    convert_dicom_zip_to_png_paths,
+    convert_dicom_files_to_png_paths,
+    agrupar_zip_por_serie,
+    agrupar_archivos_por_serie,
+)
+
+# ==============================================================
+# Ingesta de series en segundo plano con progreso por eventos
+# ==============================================================
+# El registro de trabajos vive en memoria del proceso: el estado y los
+# eventos se consultan en el mismo worker que recibió la subida. Cada
+# trabajo guarda como mucho INGESTA_EVENTOS_MAX eventos (los más recientes);
+# los `seq` siguen creciendo, así que un cliente que se reconecta con un
+# Last-Event-ID ya descartado continúa desde el más antiguo que queda.
+
+INGESTA_MAX_CONCURRENTES = int(os.getenv("INGESTA_MAX_CONCURRENTES", 2))
+INGESTA_RETENCION_S = int(os.getenv("INGESTA_RETENCION_S", 3600))
+INGESTA_EVENTOS_MAX = int(os.getenv("INGESTA_EVENTOS_MAX", 2000))
+
+ingesta_pool = ThreadPoolExecutor(
+    max_workers=INGESTA_MAX_CONCURRENTES, thread_name_prefix="ingesta"
+)
+
+_trabajos = {}
+_lock = threading.Lock()
+
+ESTADOS_FINALES = ("completado", "error")
+
+
+def iniciar_ingesta_series(
+    fuente: Union[str, List[Tuple[str, str]]],
+    user_id: int,
+    limpiar: Optional[str] = None,
+) -> List[dict]:
+    """
+    Registra la ingesta y devuelve de inmediato, sin leer la fuente. En
+    segundo plano, la primera fase separa la fuente por SeriesInstanceUID
+    (pasada solo-cabecera, evento "series"): la serie de más archivos sigue
+    en la sesión devuelta y las demás se encolan como sesiones propias, en
+    paralelo en ingesta_pool. `limpiar` se borra cuando terminan todas.
+
+    Devuelve [{"session_id", "series_instance_uid", "n_archivos"}] de la
+    sesión principal; las demás aparecen en `series` de su estado.
+    """
+    session_id = _registrar_trabajo(user_id)
+    ingesta_pool.submit(_ejecutar_series, session_id, fuente, user_id, limpiar)
+    return [{"session_id": session_id, "series_instance_uid": None, "n_archivos": None}]
+
+
+def iniciar_ingesta(
+    fuente: Union[str, Tuple[str, List[str]], List[Tuple[str, str]]],
+    user_id: int,
+    limpiar=None,
+    series_instance_uid: Optional[str] = None,
+) -> str:
+    """
+    Registra la ingesta y la encola. Devuelve el session_id de inmediato;
+    los slices se procesan en segundo plano.
+
+    `fuente` es la ruta de un ZIP en disco, (ruta del ZIP, miembros a incluir)
+    o una lista de (nombre, ruta) de archivos ya extraídos. `limpiar` (archivo
+    o carpeta) se borra al terminar.
+    """
+    session_id = _registrar_trabajo(user_id, series_instance_uid)
+    ingesta_pool.submit(_ejecutar_ingesta, session_id, fuente, user_id, limpiar)
+    return session_id
+
+
+def _registrar_trabajo(user_id: int, series_instance_uid: Optional[str] = None) -> str:
+    session_id = str(uuid.uuid4())
+    ahora = time.time()
+
+    with _lock:
+        _purgar_finalizados(ahora)
+        _trabajos[session_id] = {
+            "session_id": session_id,
+            "user_id": user_id,
+            "series_instance_uid": series_instance_uid,
+            "series": None,
+            "estado": "en_cola",
+            "total": None,
+            "procesados": 0,
+            "fallidos": 0,
+            "error": None,
+            "creado": ahora,
+            "actualizado": ahora,
+            "eventos": [],
+            "eventos_descartados": 0,
+        }
+
+    _registrar_evento(session_id, {"tipo": "estado", "estado": "en_cola"})
+    return session_id
+
+
+def respuesta_ingesta(sesiones: list) -> dict:
+    """Respuesta 202 de una ingesta: campos de la serie principal + `series`."""
+    # Si la agrupación ya terminó (p. ej. al repetir un finalize), todas las series
+    conocidas = []
+    for sesion in sesiones:
+        with _lock:
+            trabajo = _trabajos.get(sesion["session_id"])
+            conocidas.extend((trabajo or {}).get("series") or [sesion])
+
+    series = [
+        {
+            **sesion,
+            "estado_url": f"/ingesta/{sesion['session_id']}",
+            "eventos_url": f"/ingesta/{sesion['session_id']}/eventos",
+            "mapping_url": f"/static/series/{sesion['session_id']}/mapping.json",
+        }
+        for sesion in conocidas
+    ]
+    principal = series[0]
+    return {
+        "message": "Ingesta iniciada",
+        "session_id": principal["session_id"],
+        "estado_url": principal["estado_url"],
+        "eventos_url": principal["eventos_url"],
+        "mapping_url": principal["mapping_url"],
+        "series": series,
+    }
+
+
+def estado_ingesta(session_id: str, user_id: int) -> Optional[dict]:
+    """Estado del trabajo. None si no existe o es de otro usuario."""
+    with _lock:
+        trabajo = _trabajos.get(session_id)
+        if trabajo is None or trabajo["user_id"] != user_id:
+            return None
+        estado = {k: v for k, v in trabajo.items() if k not in ("eventos", "eventos_descartados")}
+
+    estado["mapping_url"] = f"/static/series/{session_id}/mapping.json"
+    return estado
+
+
+def eventos_desde(session_id: str, user_id: int, desde: int = 0) -> tuple:
+    """
+    Devuelve (eventos con seq >= desde, terminado). None si el trabajo no
+    existe o es de otro usuario. Si `desde` ya se descartó, empieza por el
+    más antiguo retenido.
+    """
+    with _lock:
+        trabajo = _trabajos.get(session_id)
+        if trabajo is None or trabajo["user_id"] != user_id:
+            return None
+        inicio = max(0, desde - trabajo["eventos_descartados"])
+        return list(trabajo["eventos"][inicio:]), trabajo["estado"] in ESTADOS_FINALES
+
+
+def _ejecutar_series(session_id: str, fuente, user_id: int, limpiar: Optional[str]) -> None:
+    _registrar_evento(session_id, {"tipo": "estado", "estado": "agrupando"})
+
+    try:
+        if isinstance(fuente, str):
+            grupos = agrupar_zip_por_serie(fuente)
+        else:
+            grupos = agrupar_archivos_por_serie(fuente)
+        if not grupos:
+            raise ValueError("No se encontraron archivos DICOM en el ZIP.")
+    except Exception as e:
+        _registrar_evento(session_id, {"tipo": "estado", "estado": "error", "error": str(e)})
+        if limpiar:
+            _borrar_ruta(limpiar)
+        return
+
+    compartida = _LimpiezaCompartida(limpiar, len(grupos)) if limpiar else None
+
+    def sub_fuente(grupo):
+        return (fuente, grupo["miembros"]) if isinstance(fuente, str) else grupo["miembros"]
+
+    # La serie principal sigue en este trabajo; las demás, en sesiones nuevas
+    principal, *resto = grupos
+    series = [(session_id, principal)] + [
+        (
+            iniciar_ingesta(
+                sub_fuente(grupo),
+                user_id=user_id,
+                limpiar=compartida,
+                series_instance_uid=grupo["series_instance_uid"],
+            ),
+            grupo,
+        )
+        for grupo in resto
+    ]
+    _registrar_evento(
+        session_id,
+        {
+            "tipo": "series",
+            "series": [
+                {
+                    "session_id": sid,
+                    "series_instance_uid": grupo["series_instance_uid"],
+                    "n_archivos": len(grupo["miembros"]),
+                }
+                for sid, grupo in series
+            ],
+        },
+    )
+
+    _ejecutar_ingesta(session_id, sub_fuente(principal), user_id, compartida)
+
+
+def _ejecutar_ingesta(session_id: str, fuente, user_id: int, limpiar) -> None:
+    _registrar_evento(session_id, {"tipo": "estado", "estado": "procesando"})
+
+    try:
+        progreso = lambda evento: _registrar_evento(session_id, evento)
+        if isinstance(fuente, str):
+            resultado = convert_dicom_zip_to_png_paths(
+                fuente, user_id=user_id, session_id=session_id, progreso=progreso
+            )
+        elif isinstance(fuente, tuple):
+            zip_path, nombres = fuente
+            resultado = convert_dicom_zip_to_png_paths(
+                zip_path, user_id=user_id, session_id=session_id, progreso=progreso, nombres=nombres
+            )
+        else:
+            resultado = convert_dicom_files_to_png_paths(
+                fuente, user_id=user_id, session_id=session_id, progreso=progreso
+            )
+        _registrar_evento(
+            session_id,
+            {
+                "tipo": "estado",
+                "estado": "completado",
+                "procesados": len(resultado["image_series"]),
+                "mapping_url": resultado["mapping_url"],
+            },
+        )
+    except Exception as e:
+        _registrar_evento(session_id, {"tipo": "estado", "estado": "error", "error": str(e)})
+    finally:
+        if isinstance(limpiar, _LimpiezaCompartida):
+            limpiar.liberar()
+        elif limpiar:
+            _borrar_ruta(limpiar)
+
+
+def _registrar_evento(session_id: str, evento: dict) -> None:
+    with _lock:
+        trabajo = _trabajos.get(session_id)
+        if trabajo is None:
+            return
+
+        seq = trabajo["eventos_descartados"] + len(trabajo["eventos"])
+        evento = {"seq": seq, "ts": round(time.time(), 3), **evento}
+        trabajo["eventos"].append(evento)
+        trabajo["actualizado"] = evento["ts"]
+
+        # Se recorta por bloques para no mover la lista en cada evento
+        exceso = len(trabajo["eventos"]) - INGESTA_EVENTOS_MAX
+        if exceso > 0 and exceso >= INGESTA_EVENTOS_MAX // 10:
+            del trabajo["eventos"][:exceso]
+            trabajo["eventos_descartados"] += exceso
+
+        tipo = evento["tipo"]
+        if tipo == "inicio":
+            trabajo["total"] = evento["total"]
+        elif tipo == "slice":
+            trabajo["procesados"] = evento["procesados"]
+        elif tipo in ("error_slice", "omitido"):
+            trabajo["fallidos"] += 1
+        elif tipo == "series":
+            trabajo["series"] = evento["series"]
+            trabajo["series_instance_uid"] = evento["series"][0]["series_instance_uid"]
+        elif tipo == "estado":
+            trabajo["estado"] = evento["estado"]
+            if evento.get("error"):
+                trabajo["error"] = evento["error"]
+
+
+class _LimpiezaCompartida:
+    """Borra `ruta` cuando la última de `n` ingestas que la usan termina."""
+
+    def __init__(self, ruta: str, n: int):
+        self.ruta = ruta
+        self.pendientes = n
+        self._lock = threading.Lock()
+
+    def liberar(self) -> None:
+        with self._lock:
+            self.pendientes -= 1
+            ultimo = self.pendientes == 0
+        if ultimo:
+            _borrar_ruta(self.ruta)
+
+
+def _borrar_ruta(ruta: str) -> None:
+    try:
+        if os.path.isdir(ruta):
+            shutil.rmtree(ruta)
+        else:
+            os.remove(ruta)
+    except OSError:
+        pass
+
+
+def _purgar_finalizados(ahora: float) -> None:
+    # Llamar con _lock tomado
+    viejos = [
+        sid
+        for sid, t in _trabajos.items()
+        if t["estado"] in ESTADOS_FINALES and ahora - t["actualizado"] > INGESTA_RETENCION_S
+    ]
+    for sid in viejos:
+        del _trabajos[sid]
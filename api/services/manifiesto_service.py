@@ -0,0 +1,264 @@
+# api/services/manifiesto_service.py
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+from api.services.almacenamiento_service import clave_de, publicar, rehidratar, retirar
+from api.utils.lru_cache import LRUCache
+
+# Importar rutas persistentes desde config.paths
+from config.paths import (
+    MANIFIESTOS_DIR,
+    SEGMENTATIONS_2D_DIR,
+    SEGMENTATIONS_3D_DIR,
+    SERIES_DIR,
+)
+
+# ==============================================================
+# Manifiesto de archivos por sesión
+# ==============================================================
+# MANIFIESTOS_DIR/<session_id>.json lista los archivos propios de la sesión
+# (DICOM y mapping.json de la serie, máscaras y memos 2D, segmentaciones 3D
+# anteriores al almacén de artefactos) con tamaño, sha256 y mtime, por clave
+# relativa a /data/static:
+#
+#   {"session_id": ..., "actualizado": ..., "archivos": {"series/<sid>/x.dcm":
+#       {"tamano": 524288, "sha256": "...", "mtime": 1760000000.0}, ...}}
+#
+# Listados y borrados consultan el manifiesto en vez de hacer un stat por
+# archivo (caro en volúmenes de red): una entrada significa que el archivo es
+# parte de la sesión, aunque el presupuesto de disco lo haya desalojado y se
+# regenere al pedirlo.
+#
+# Las altas van a un diario (<session_id>.log, una línea JSON por llamada a
+# registrar) en vez de reescribir el manifiesto entero: segmentar un slice
+# suelto añade una línea. Cuando el diario pasa de MANIFIESTO_DIARIO_MAX
+# entradas, y en cada quitar, se compacta: el manifiesto se reescribe de forma
+# atómica (temporal + os.replace) con una generación nueva y las líneas de
+# generaciones anteriores se ignoran, así que un diario viejo que no se llegó
+# a borrar no resucita nada. Todo bajo un lock por sesión, y ambos archivos se
+# publican en el backend de almacenamiento. Las sesiones anteriores al
+# manifiesto lo construyen una vez recorriendo sus carpetas (sin hash: se
+# calcula cuando el archivo se vuelve a registrar).
+
+MANIFIESTO_CACHE_MAX = int(os.getenv("MANIFIESTO_CACHE_MAX", 256))
+MANIFIESTO_DIARIO_MAX = int(os.getenv("MANIFIESTO_DIARIO_MAX", 1000))
+
+_BLOQUE = 1024 * 1024
+
+_manifiestos = LRUCache(max_items=MANIFIESTO_CACHE_MAX)
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def ruta_manifiesto(session_id: str) -> Path:
+    return MANIFIESTOS_DIR / f"{session_id}.json"
+
+
+def ruta_diario(session_id: str) -> Path:
+    return MANIFIESTOS_DIR / f"{session_id}.log"
+
+
+def leer_manifiesto(session_id: str) -> dict:
+    """
+    Manifiesto de la sesión, con su diario aplicado (compartido: no mutarlo).
+    Se sirve desde memoria mientras los archivos no cambien; si no existe se
+    trae del backend o se construye a partir de lo que haya en disco.
+    """
+    return _leer(session_id)[0]
+
+
+def contiene(manifiesto: dict, ruta) -> bool:
+    return clave_de(ruta) in manifiesto["archivos"]
+
+
+def contiene_bajo(manifiesto: dict, carpeta) -> bool:
+    """True si el manifiesto tiene algún archivo dentro de `carpeta`."""
+    prefijo = f"{clave_de(carpeta)}/"
+    return any(clave.startswith(prefijo) for clave in manifiesto["archivos"])
+
+
+def registrar(session_id: str, rutas: Iterable, hashes: Optional[Dict[str, str]] = None) -> None:
+    """
+    Añade o actualiza archivos ya escritos. `hashes` (ruta → sha256) evita
+    releer los que el llamador ya hasheó. Las rutas que no existen se ignoran.
+    """
+    hashes = {str(k): v for k, v in (hashes or {}).items()}
+    entradas = {}
+    for ruta in rutas:
+        try:
+            st = os.stat(ruta)
+        except FileNotFoundError:
+            continue
+        entradas[clave_de(ruta)] = {
+            "tamano": st.st_size,
+            "sha256": hashes.get(str(ruta)) or _hash_archivo(ruta),
+            "mtime": st.st_mtime,
+        }
+    if not entradas:
+        return
+
+    with _lock_de(session_id):
+        manifiesto, pendientes = _leer(session_id)
+        # Sin generación: manifiesto anterior al diario o aún sin escribir
+        if "generacion" in manifiesto and pendientes + len(entradas) <= MANIFIESTO_DIARIO_MAX:
+            _anotar(session_id, manifiesto["generacion"], entradas)
+            return
+
+        manifiesto = _copia(manifiesto)
+        manifiesto["archivos"].update(entradas)
+        _escribir(session_id, manifiesto)
+
+
+def quitar(session_id: str, rutas: Iterable) -> dict:
+    """Quita archivos del manifiesto y devuelve el manifiesto resultante."""
+    claves = {clave_de(ruta) for ruta in rutas}
+    with _lock_de(session_id):
+        manifiesto = _copia(leer_manifiesto(session_id))
+        if claves & manifiesto["archivos"].keys():
+            for clave in claves:
+                manifiesto["archivos"].pop(clave, None)
+            _escribir(session_id, manifiesto)
+        return manifiesto
+
+
+def borrar_manifiesto(session_id: str) -> None:
+    with _lock_de(session_id):
+        _manifiestos.pop(session_id)
+        for ruta in (ruta_manifiesto(session_id), ruta_diario(session_id)):
+            ruta.unlink(missing_ok=True)
+            retirar(ruta)
+
+
+# ==============================================================
+# Internos
+# ==============================================================
+
+def _lock_de(session_id: str) -> threading.RLock:
+    with _locks_lock:
+        return _locks.setdefault(session_id, threading.RLock())
+
+
+def _copia(manifiesto: dict) -> dict:
+    return {**manifiesto, "archivos": dict(manifiesto["archivos"])}
+
+
+def _leer(session_id: str) -> tuple:
+    """(manifiesto con el diario aplicado, entradas pendientes en el diario)."""
+    ruta = ruta_manifiesto(session_id)
+    diario = ruta_diario(session_id)
+    try:
+        st = os.stat(ruta)
+    except FileNotFoundError:
+        with _lock_de(session_id):
+            if not ruta.is_file():
+                if rehidratar(ruta):
+                    rehidratar(diario)
+                else:
+                    manifiesto = _construir(session_id)
+                    # Sesión sin nada en disco: no se deja un manifiesto vacío
+                    if not manifiesto["archivos"]:
+                        return manifiesto, 0
+                    _escribir(session_id, manifiesto)
+        st = os.stat(ruta)
+
+    try:
+        st_diario = os.stat(diario)
+        firma = (st.st_mtime_ns, st.st_size, st_diario.st_mtime_ns, st_diario.st_size)
+    except FileNotFoundError:
+        firma = (st.st_mtime_ns, st.st_size)
+
+    entrada = _manifiestos.get(session_id, valido=lambda e: e[0] == firma)
+    if entrada is not None:
+        return entrada[1], entrada[2]
+
+    with open(ruta, "r", encoding="utf-8") as f:
+        manifiesto = json.load(f)
+
+    pendientes = 0
+    if len(firma) > 2:
+        manifiesto = _copia(manifiesto)
+        with open(diario, "r", encoding="utf-8") as f:
+            for linea in f:
+                try:
+                    anotacion = json.loads(linea)
+                except ValueError:
+                    continue  # línea a medio escribir
+                if anotacion.get("generacion") == manifiesto.get("generacion"):
+                    manifiesto["archivos"].update(anotacion["archivos"])
+                    pendientes += len(anotacion["archivos"])
+
+    _manifiestos.put(session_id, (firma, manifiesto, pendientes))
+    return manifiesto, pendientes
+
+
+def _anotar(session_id: str, generacion: str, entradas: dict) -> None:
+    # Una línea por llamada, en una sola escritura con O_APPEND
+    diario = ruta_diario(session_id)
+    linea = json.dumps({"generacion": generacion, "archivos": entradas}, ensure_ascii=False, separators=(",", ":"))
+    with open(diario, "a", encoding="utf-8") as f:
+        f.write(linea + "\n")
+    publicar(diario)
+
+
+def _escribir(session_id: str, manifiesto: dict) -> None:
+    # Compactación: el diario queda incorporado y una generación nueva lo invalida
+    manifiesto["session_id"] = session_id
+    manifiesto["actualizado"] = time.time()
+    manifiesto["generacion"] = uuid.uuid4().hex
+
+    ruta = ruta_manifiesto(session_id)
+    tmp = ruta.with_name(f"{ruta.name}.{uuid.uuid4().hex}.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifiesto, f, ensure_ascii=False, separators=(",", ":"))
+    try:
+        publicar(tmp, clave_de(ruta))
+    except Exception:
+        tmp.unlink(missing_ok=True)
+        raise
+    os.replace(tmp, ruta)
+
+    diario = ruta_diario(session_id)
+    if diario.is_file():
+        diario.unlink(missing_ok=True)
+        retirar(diario)
+
+
+def _construir(session_id: str) -> dict:
+    # Sesiones anteriores al manifiesto: un único recorrido de sus carpetas
+    archivos = {}
+    for carpeta in (SERIES_DIR / session_id, SEGMENTATIONS_2D_DIR / session_id, SEGMENTATIONS_3D_DIR / session_id):
+        try:
+            entradas = list(os.scandir(carpeta))
+        except FileNotFoundError:
+            continue
+        for entrada in entradas:
+            if not entrada.is_file(follow_symlinks=False) or not _es_propio(entrada.name):
+                continue
+            st = entrada.stat(follow_symlinks=False)
+            archivos[clave_de(entrada.path)] = {"tamano": st.st_size, "sha256": None, "mtime": st.st_mtime}
+    return {"session_id": session_id, "archivos": archivos}
+
+
+# Cachés derivadas de la serie que no forman parte de la sesión
+_NO_PROPIOS = ("volumen.npy", "volumen.json", "estadisticas.json")
+
+
+def _es_propio(nombre: str) -> bool:
+    return nombre not in _NO_PROPIOS and not nombre.endswith(".tmp") and not nombre.startswith(".")
+
+
+def _hash_archivo(ruta) -> str:
+    h = hashlib.sha256()
+    with open(ruta, "rb") as f:
+        while True:
+            bloque = f.read(_BLOQUE)
+            if not bloque:
+                break
+            h.update(bloque)
+    return h.hexdigest()
@@ -0,0 +1,430 @@
+# api/services/metadatos_service.py
+import argparse
+import datetime
+import json
+import logging
+import time
+from typing import Iterator, List, Optional
+
+import numpy as np
+import pydicom
+from psycopg2.extras import execute_values
+
+from api.services.cache_service import cargar_mapping
+from config.db_config import get_connection
+
+# Importar rutas persistentes desde config.paths
+from config.paths import SERIES_DIR
+
+logger = logging.getLogger(__name__)
+
+# ==============================================================
+# Índice de metadatos DICOM (serie_dicom / instancia_dicom)
+# ==============================================================
+# La ingesta extrae un conjunto fijo de campos de cabecera en la misma pasada
+# en que registra cada slice; las consultas de búsqueda y de spacing se
+# responden desde estas tablas sin abrir los DICOM. Las series ingeridas antes
+# del índice se rellenan con indexar_series_pendientes (ver main()).
+
+COLUMNAS_SERIE = [
+    "session_id", "user_id", "series_instance_uid", "study_instance_uid",
+    "patient_id", "study_date", "modality", "series_description",
+    "filas", "columnas", "pixel_spacing_y", "pixel_spacing_x",
+    "slice_thickness", "n_instancias", "creado_at",
+]
+
+COLUMNAS_INSTANCIA = [
+    "archivodicomid", "session_id", "image_name", "sop_instance_uid",
+    "instance_number", "posicion_z", "filas", "columnas",
+]
+
+# session_id a partir de rutaarchivo (.../series/<session_id>/<archivo>)
+_SQL_SESION_ARCHIVO = r"substring(rutaarchivo from '[\\/]series[\\/]([^\\/]+)[\\/]')"
+
+# Campos de serie que se toman de la primera instancia que los tenga
+_CAMPOS_SERIE = [
+    "series_instance_uid", "study_instance_uid", "patient_id", "study_date",
+    "modality", "series_description", "filas", "columnas",
+    "pixel_spacing_y", "pixel_spacing_x", "slice_thickness",
+]
+
+
+def extraer_metadatos(ds) -> dict:
+    """Campos indexados de la cabecera de un slice (sin tocar los píxeles)."""
+    spacing = _lista_float(ds.get("PixelSpacing"), 2)
+    posicion = _lista_float(ds.get("ImagePositionPatient"), 3)
+
+    return {
+        "series_instance_uid": _texto(ds.get("SeriesInstanceUID")),
+        "study_instance_uid": _texto(ds.get("StudyInstanceUID")),
+        "sop_instance_uid": _texto(ds.get("SOPInstanceUID")),
+        "patient_id": _texto(ds.get("PatientID")),
+        "study_date": _fecha(ds.get("StudyDate")),
+        "modality": (_texto(ds.get("Modality")) or "").upper() or None,
+        "series_description": _texto(ds.get("SeriesDescription")),
+        "instance_number": _entero(ds.get("InstanceNumber")),
+        "posicion_z": posicion[2] if posicion else None,
+        "filas": _entero(ds.get("Rows")),
+        "columnas": _entero(ds.get("Columns")),
+        "pixel_spacing_y": spacing[0] if spacing else None,
+        "pixel_spacing_x": spacing[1] if spacing else None,
+        "slice_thickness": _flotante(ds.get("SliceThickness")),
+    }
+
+
+def guardar_metadatos_serie(session_id: str, user_id: int, instancias: List[dict]) -> None:
+    """
+    Inserta (o reemplaza) la fila de serie y todas sus instancias en una sola
+    transacción. Cada instancia lleva archivodicomid, image_name y los campos
+    de extraer_metadatos.
+    """
+    if not instancias:
+        return
+
+    serie = {campo: None for campo in _CAMPOS_SERIE}
+    for inst in instancias:
+        for campo in _CAMPOS_SERIE:
+            if serie[campo] is None and inst.get(campo) is not None:
+                serie[campo] = inst[campo]
+
+    conn = get_connection()
+    cur = conn.cursor()
+
+    try:
+        cur.execute(
+            """
+            INSERT INTO serie_dicom
+              (session_id, user_id, series_instance_uid, study_instance_uid,
+               patient_id, study_date, modality, series_description,
+               filas, columnas, pixel_spacing_y, pixel_spacing_x,
+               slice_thickness, n_instancias)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (session_id) DO UPDATE SET
+              series_instance_uid = EXCLUDED.series_instance_uid,
+              study_instance_uid = EXCLUDED.study_instance_uid,
+              patient_id = EXCLUDED.patient_id,
+              study_date = EXCLUDED.study_date,
+              modality = EXCLUDED.modality,
+              series_description = EXCLUDED.series_description,
+              filas = EXCLUDED.filas,
+              columnas = EXCLUDED.columnas,
+              pixel_spacing_y = EXCLUDED.pixel_spacing_y,
+              pixel_spacing_x = EXCLUDED.pixel_spacing_x,
+              slice_thickness = EXCLUDED.slice_thickness,
+              n_instancias = EXCLUDED.n_instancias
+            """,
+            (session_id, user_id, *[serie[c] for c in _CAMPOS_SERIE], len(instancias)),
+        )
+
+        execute_values(
+            cur,
+            f"""
+            INSERT INTO instancia_dicom ({", ".join(COLUMNAS_INSTANCIA)})
+            VALUES %s
+            ON CONFLICT (archivodicomid) DO UPDATE SET
+              session_id = EXCLUDED.session_id,
+              image_name = EXCLUDED.image_name,
+              sop_instance_uid = EXCLUDED.sop_instance_uid,
+              instance_number = EXCLUDED.instance_number,
+              posicion_z = EXCLUDED.posicion_z,
+              filas = EXCLUDED.filas,
+              columnas = EXCLUDED.columnas
+            """,
+            [
+                (
+                    inst["archivodicomid"], session_id, inst["image_name"],
+                    inst.get("sop_instance_uid"), inst.get("instance_number"),
+                    inst.get("posicion_z"), inst.get("filas"), inst.get("columnas"),
+                )
+                for inst in {i["archivodicomid"]: i for i in instancias}.values()
+            ],
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+
+def buscar_series(
+    user_id: int,
+    modality: Optional[str] = None,
+    patient_id: Optional[str] = None,
+    study_instance_uid: Optional[str] = None,
+    fecha_desde: Optional[datetime.date] = None,
+    fecha_hasta: Optional[datetime.date] = None,
+    limit: int = 50,
+    offset: int = 0,
+) -> List[dict]:
+    filtros = ["user_id = %s"]
+    params = [user_id]
+
+    if modality:
+        filtros.append("modality = %s")
+        params.append(modality.upper())
+    if patient_id:
+        filtros.append("patient_id = %s")
+        params.append(patient_id)
+    if study_instance_uid:
+        filtros.append("study_instance_uid = %s")
+        params.append(study_instance_uid)
+    if fecha_desde:
+        filtros.append("study_date >= %s")
+        params.append(fecha_desde)
+    if fecha_hasta:
+        filtros.append("study_date <= %s")
+        params.append(fecha_hasta)
+
+    conn = get_connection()
+    cur = conn.cursor()
+
+    try:
+        cur.execute(
+            f"""
+            SELECT {", ".join(COLUMNAS_SERIE)}
+            FROM serie_dicom
+            WHERE {" AND ".join(filtros)}
+            ORDER BY study_date DESC NULLS LAST, creado_at DESC
+            LIMIT %s OFFSET %s
+            """,
+            (*params, limit, offset),
+        )
+        return [_serie_dict(r) for r in cur.fetchall()]
+    finally:
+        cur.close()
+        conn.close()
+
+
+def obtener_serie(session_id: str, user_id: int) -> Optional[dict]:
+    conn = get_connection()
+    cur = conn.cursor()
+
+    try:
+        cur.execute(
+            f"""
+            SELECT {", ".join(COLUMNAS_SERIE)}
+            FROM serie_dicom
+            WHERE session_id = %s AND user_id = %s
+            """,
+            (session_id, user_id),
+        )
+        row = cur.fetchone()
+        return _serie_dict(row) if row else None
+    finally:
+        cur.close()
+        conn.close()
+
+
+def listar_instancias(session_id: str, user_id: int) -> List[dict]:
+    conn = get_connection()
+    cur = conn.cursor()
+
+    try:
+        cur.execute(
+            f"""
+            SELECT {", ".join("i." + c for c in COLUMNAS_INSTANCIA)}
+            FROM instancia_dicom i
+            JOIN serie_dicom s ON s.session_id = i.session_id
+            WHERE i.session_id = %s AND s.user_id = %s
+            ORDER BY i.posicion_z NULLS LAST, i.instance_number NULLS LAST, i.archivodicomid
+            """,
+            (session_id, user_id),
+        )
+        return [dict(zip(COLUMNAS_INSTANCIA, r)) for r in cur.fetchall()]
+    finally:
+        cur.close()
+        conn.close()
+
+
+def geometria_serie(session_id: str) -> Optional[dict]:
+    """
+    Spacing, modalidad y posición de cada instancia desde el índice, para
+    ordenar y escalar el volumen sin releer cabeceras. None si la serie no
+    está indexada. `instancias` va por image_name: (posicion_z, instance_number).
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+
+    try:
+        cur.execute(
+            """
+            SELECT modality, pixel_spacing_y, pixel_spacing_x, slice_thickness
+            FROM serie_dicom
+            WHERE session_id = %s
+            """,
+            (session_id,),
+        )
+        row = cur.fetchone()
+        if not row:
+            return None
+
+        cur.execute(
+            "SELECT image_name, posicion_z, instance_number FROM instancia_dicom WHERE session_id = %s",
+            (session_id,),
+        )
+        instancias = {r[0]: (r[1], r[2]) for r in cur.fetchall()}
+    finally:
+        cur.close()
+        conn.close()
+
+    return {
+        "modality": row[0] or "",
+        "pixel_spacing": (row[1], row[2]) if row[1] is not None and row[2] is not None else None,
+        "slice_thickness": row[3],
+        "instancias": instancias,
+    }
+
+
+def espaciado_serie(session_id: str) -> Optional[tuple]:
+    """
+    Spacing (dz, dy, dx) en mm con los mismos criterios que la carga del
+    volumen: dz es la mediana de los saltos de posición z y, si no hay
+    posiciones, el grosor de corte. None si la serie no está indexada.
+    """
+    geometria = geometria_serie(session_id)
+    if geometria is None:
+        return None
+
+    zs = sorted(z for z, _ in geometria["instancias"].values() if z is not None)
+    if len(zs) >= 2:
+        dz = float(np.median(np.abs(np.diff(zs))))
+    else:
+        dz = geometria["slice_thickness"] or 1.0
+
+    px_y, px_x = geometria["pixel_spacing"] or (1.0, 1.0)
+    return (dz, px_y, px_x)
+
+
+# ==============================================================
+# Relleno del índice para series ingeridas antes de que existiera
+# ==============================================================
+
+def _sesiones_sin_indice() -> List[tuple]:
+    """(session_id, user_id) con filas en archivodicom pero sin serie_dicom."""
+    conn = get_connection()
+    cur = conn.cursor()
+
+    try:
+        cur.execute(
+            f"""
+            SELECT a.sesion, MIN(a.user_id)
+            FROM (SELECT {_SQL_SESION_ARCHIVO} AS sesion, user_id FROM archivodicom) a
+            WHERE a.sesion IS NOT NULL
+              AND NOT EXISTS (SELECT 1 FROM serie_dicom s WHERE s.session_id = a.sesion)
+            GROUP BY a.sesion
+            ORDER BY a.sesion
+            """
+        )
+        return cur.fetchall()
+    finally:
+        cur.close()
+        conn.close()
+
+
+def indexar_serie(session_id: str, user_id: int) -> int:
+    """Indexa una serie ya ingerida leyendo solo las cabeceras. Devuelve las instancias."""
+    instancias = []
+    for image_name, meta in cargar_mapping(session_id).items():
+        if not meta.get("dicom_name") or meta.get("archivodicomid") is None:
+            continue
+        ruta = SERIES_DIR / session_id / meta["dicom_name"]
+        try:
+            ds = pydicom.dcmread(str(ruta), force=True, stop_before_pixels=True)
+        except Exception as e:
+            logger.warning("No se pudo leer la cabecera de %s: %s", ruta, e)
+            continue
+        instancias.append(
+            {**extraer_metadatos(ds), "archivodicomid": meta["archivodicomid"], "image_name": image_name}
+        )
+
+    guardar_metadatos_serie(session_id, user_id, instancias)
+    return len(instancias)
+
+
+def indexar_series_pendientes() -> Iterator[dict]:
+    """
+    Indexa, una a una, las series sin fila en serie_dicom. Emite un resultado
+    por sesión y termina con {"tipo": "resumen", ...}. Se puede relanzar: las
+    series ya indexadas no se vuelven a leer.
+    """
+    inicio = time.time()
+    conteos = {"serie_indexada": 0, "error": 0}
+
+    for session_id, user_id in _sesiones_sin_indice():
+        try:
+            n = indexar_serie(session_id, user_id)
+            resultado = {"tipo": "serie_indexada", "session_id": session_id, "instancias": n}
+        except Exception as e:
+            resultado = {"tipo": "error", "session_id": session_id, "error": str(e)}
+        conteos[resultado["tipo"]] += 1
+        yield resultado
+
+    yield {"tipo": "resumen", "conteos": conteos, "duracion_s": round(time.time() - inicio, 3)}
+
+
+def _serie_dict(row) -> dict:
+    serie = dict(zip(COLUMNAS_SERIE, row))
+    if serie["study_date"] is not None:
+        serie["study_date"] = serie["study_date"].isoformat()
+    if serie["creado_at"] is not None:
+        serie["creado_at"] = serie["creado_at"].isoformat()
+    return serie
+
+
+# ============ Conversión de valores de cabecera ============
+
+def _texto(valor) -> Optional[str]:
+    if valor is None:
+        return None
+    texto = str(valor).strip()
+    return texto or None
+
+
+def _entero(valor) -> Optional[int]:
+    try:
+        return int(valor)
+    except (TypeError, ValueError):
+        return None
+
+
+def _flotante(valor) -> Optional[float]:
+    try:
+        return float(valor)
+    except (TypeError, ValueError):
+        return None
+
+
+def _lista_float(valor, n: int) -> Optional[list]:
+    try:
+        numeros = [float(v) for v in valor]
+    except (TypeError, ValueError):
+        return None
+    return numeros if len(numeros) == n else None
+
+
+def _fecha(valor) -> Optional[datetime.date]:
+    texto = _texto(valor)
+    if not texto:
+        return None
+    try:
+        return datetime.datetime.strptime(texto[:8], "%Y%m%d").date()
+    except ValueError:
+        return None
+
+
+# ==============================================================
+# Línea de comandos: python -m api.services.metadatos_service
+# ==============================================================
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Indexa las series ingeridas antes de serie_dicom")
+    parser.parse_args(argv)
+
+    for resultado in indexar_series_pendientes():
+        print(json.dumps(resultado, ensure_ascii=False), flush=True)
+
+
+if __name__ == "__main__":
+    main()
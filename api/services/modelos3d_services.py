@@ -1,36 +1,29 @@
+import logging
 import os
-import time
 import struct
 import numpy as np
 from skimage import measure
 
 from config.db_config import get_connection
+from api.services.artefactos_service import (
+    guardar_artefacto,
+    liberar_propietario,
+    referenciar,
+    registrar_regenerador,
+    ruta_temporal,
+)
 
 # 📌 Importar rutas persistentes desde config.paths (NO desde main.py)
 from config.paths import MODELOS3D_DIR, SEGMENTATIONS_3D_DIR
 
-# Reutilizamos helpers desde segmentación 3D
-from api.services.segmentation3d_service import _load_stack
+# Spacing guardado con la segmentación (o, en filas antiguas, el de la serie)
+from api.services.segmentation3d_service import espaciado_malla
 
-
-# -----------------------------------------------------------
-# 1) Carpeta persistente del STL
-# -----------------------------------------------------------
-def _models_dir(session_id: str) -> str:
-    """
-    /data/static/modelos3d/<session_id>/
-    """
-    base = MODELOS3D_DIR / session_id
-    base.mkdir(parents=True, exist_ok=True)
-    return str(base)
-
-
-def _public_models_dir(session_id: str) -> str:
-    return f"/static/modelos3d/{session_id}"
+logger = logging.getLogger(__name__)
 
 
 # -----------------------------------------------------------
-# 2) Escritura de STL binario
+# 1) Escritura de STL binario
 # -----------------------------------------------------------
 def _write_binary_stl(path: str, vertices: np.ndarray, faces: np.ndarray, name: bytes = b"dicom_mesh") -> None:
     vertices = np.asarray(vertices, dtype=np.float32)
@@ -51,7 +44,7 @@ def _write_binary_stl(path: str, vertices: np.ndarray, faces: np.ndarray, name:
 
 
 # -----------------------------------------------------------
-# 3) Resolver ruta absoluta de mask.npy
+# 2) Resolver ruta absoluta de mask.npy
 # -----------------------------------------------------------
 def _resolve_mask_npy_abs(session_id: str, mask_npy_public: str) -> str:
     """
@@ -70,8 +63,58 @@ def _resolve_mask_npy_abs(session_id: str, mask_npy_public: str) -> str:
     return str(SEGMENTATIONS_3D_DIR / session_id / os.path.basename(mask_npy_public))
 
 
+def _malla_desde_seg3d(session_id: str, mask_npy_public: str, spacing: tuple):
+    # Resolver ruta absoluta
+    mask_abs = _resolve_mask_npy_abs(session_id, mask_npy_public)
+
+    if not os.path.isfile(mask_abs):
+        raise FileNotFoundError(f"No existe mask.npy en {mask_abs}")
+
+    # Cargar máscara
+    mask = np.load(mask_abs) > 0
+
+    # Marching Cubes
+    verts, faces, _, _ = measure.marching_cubes(
+        mask.astype(np.uint8),
+        level=0.5,
+        spacing=spacing[::-1],
+    )
+    return verts, faces
+
+
+def _regenerar_stl_modelo(modelo_id: str, rol: str, destino) -> None:
+    """Reescribe el STL de un modelo desalojado desde su segmentación 3D."""
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            """
+            SELECT m.session_id, s.mask_npy_path,
+                   m.spacing_z_mm, m.spacing_y_mm, m.spacing_x_mm
+            FROM modelo3d m
+            JOIN segmentacion3d s ON s.id = m.seg3d_id
+            WHERE m.id = %s
+            """,
+            (int(modelo_id),),
+        )
+        row = cur.fetchone()
+    finally:
+        cur.close()
+        conn.close()
+
+    if not row:
+        raise FileNotFoundError("Modelo 3D o segmentación no encontrados")
+
+    # Mismo spacing que al exportarlo: con otro, el STL no coincide con su hash
+    verts, faces = _malla_desde_seg3d(row[0], row[1], espaciado_malla(row[0], row[2:]))
+    _write_binary_stl(str(destino), verts, faces)
+
+
+registrar_regenerador("modelo3d", _regenerar_stl_modelo)
+
+
 # -----------------------------------------------------------
-# 4) EXPORTAR STL DESDE MASCARA 3D
+# 3) EXPORTAR STL DESDE MASCARA 3D
 # -----------------------------------------------------------
 def exportar_stl_desde_seg3d(session_id: str, user_id: int, seg3d_id: int | None = None):
     conn = get_connection()
@@ -81,7 +124,7 @@ def exportar_stl_desde_seg3d(session_id: str, user_id: int, seg3d_id: int | None
     if seg3d_id is None:
         cur.execute(
             """
-            SELECT id, mask_npy_path
+            SELECT id, mask_npy_path, spacing_z_mm, spacing_y_mm, spacing_x_mm
             FROM segmentacion3d
             WHERE session_id = %s AND user_id = %s
             ORDER BY created_at DESC
@@ -92,7 +135,7 @@ def exportar_stl_desde_seg3d(session_id: str, user_id: int, seg3d_id: int | None
     else:
         cur.execute(
             """
-            SELECT id, mask_npy_path
+            SELECT id, mask_npy_path, spacing_z_mm, spacing_y_mm, spacing_x_mm
             FROM segmentacion3d
             WHERE id = %s AND session_id = %s AND user_id = %s
             """,
@@ -109,61 +152,49 @@ def exportar_stl_desde_seg3d(session_id: str, user_id: int, seg3d_id: int | None
     seg3d_id = int(row[0])
     mask_npy_public = row[1]
 
-    # Resolver ruta absoluta
-    mask_abs = _resolve_mask_npy_abs(session_id, mask_npy_public)
-
-    if not os.path.isfile(mask_abs):
-        raise FileNotFoundError(f"No existe mask.npy en {mask_abs}")
-
-    # Cargar máscara
-    mask = np.load(mask_abs) > 0
-
-    # Spacing del estudio
-    _, spacing, _ = _load_stack(session_id)
-
-    # Marching Cubes
-    verts, faces, _, _ = measure.marching_cubes(
-        mask.astype(np.uint8),
-        level=0.5,
-        spacing=spacing[::-1],
-    )
+    # Máscara + spacing (el de la segmentación) → malla
+    spacing = espaciado_malla(session_id, row[2:])
+    verts, faces = _malla_desde_seg3d(session_id, mask_npy_public, spacing)
 
     num_vertices = verts.shape[0]
     num_faces = faces.shape[0]
 
-    # Carpeta persistente del STL
-    out_dir = _models_dir(session_id)
-    timestamp = int(time.time())
-    stl_filename = f"{timestamp}_seg3d_{seg3d_id}.stl"
-    stl_abs_path = os.path.join(out_dir, stl_filename)
-
-    # Guardar STL
-    _write_binary_stl(stl_abs_path, verts, faces)
-    file_size_bytes = os.path.getsize(stl_abs_path)
-
-    stl_public_url = f"{_public_models_dir(session_id)}/{stl_filename}"
+    # STL al almacén de artefactos (el mismo STL de otra exportación se reutiliza)
+    tmp_stl = ruta_temporal(".stl")
+    _write_binary_stl(str(tmp_stl), verts, faces)
+    stl = guardar_artefacto(tmp_stl, ".stl")
+    file_size_bytes = stl["tamano"]
+    stl_public_url = stl["url"]
 
-    # Guardar en base de datos
+    # Guardar en base de datos (fila y referencia en la misma transacción)
     conn = get_connection()
     cur = conn.cursor()
 
-    cur.execute(
-        """
-        INSERT INTO modelo3d (session_id, user_id, seg3d_id, path_stl,
-                              num_vertices, num_caras, file_size_bytes)
-        VALUES (%s, %s, %s, %s, %s, %s, %s)
-        RETURNING id, created_at
-        """,
-        (
-            session_id, user_id, seg3d_id, stl_public_url,
-            num_vertices, num_faces, file_size_bytes,
-        ),
-    )
+    try:
+        cur.execute(
+            """
+            INSERT INTO modelo3d (session_id, user_id, seg3d_id, path_stl,
+                                  num_vertices, num_caras, file_size_bytes,
+                                  spacing_z_mm, spacing_y_mm, spacing_x_mm)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            RETURNING id, created_at
+            """,
+            (
+                session_id, user_id, seg3d_id, stl_public_url,
+                num_vertices, num_faces, file_size_bytes,
+                *(float(v) for v in spacing),
+            ),
+        )
 
-    row = cur.fetchone()
-    conn.commit()
-    cur.close()
-    conn.close()
+        row = cur.fetchone()
+        referenciar(cur, f"modelo3d:{row[0]}", {"stl": stl})
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
 
     modelo_id, created_at = row
 
@@ -180,7 +211,7 @@ def exportar_stl_desde_seg3d(session_id: str, user_id: int, seg3d_id: int | None
 
 
 # -----------------------------------------------------------
-# 5) LISTAR MODELOS 3D
+# 4) LISTAR MODELOS 3D
 # -----------------------------------------------------------
 def listar_modelos3d(session_id: str, user_id: int):
     conn = get_connection()
@@ -218,49 +249,57 @@ def listar_modelos3d(session_id: str, user_id: int):
 
 
 # -----------------------------------------------------------
-# 6) ELIMINAR MODELO STL
+# 5) ELIMINAR MODELO STL
 # -----------------------------------------------------------
 def borrar_modelo3d(modelo_id: int, user_id: int) -> bool:
     conn = get_connection()
     cur = conn.cursor()
 
-    cur.execute(
-        "SELECT session_id, path_stl FROM modelo3d WHERE id = %s AND user_id = %s",
-        (modelo_id, user_id),
-    )
-    row = cur.fetchone()
+    try:
+        cur.execute(
+            "SELECT session_id, path_stl FROM modelo3d WHERE id = %s AND user_id = %s",
+            (modelo_id, user_id),
+        )
+        row = cur.fetchone()
 
-    if not row:
-        return False
+        if not row:
+            return False
 
-    session_id, path_pub = row
+        # Eliminar registro y soltar el STL (lo borra el GC del almacén)
+        cur.execute(
+            "DELETE FROM modelo3d WHERE id = %s AND user_id = %s",
+            (modelo_id, user_id),
+        )
+        en_almacen = liberar_propietario(cur, f"modelo3d:{modelo_id}") > 0
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+    # Modelos anteriores al almacén: STL suelto en MODELOS3D_DIR/<session_id>/
+    if not en_almacen:
+        session_id, path_pub = row
+        _borrar_stl_legado(session_id, path_pub)
 
-    # Eliminar registro
-    cur.execute(
-        "DELETE FROM modelo3d WHERE id = %s AND user_id = %s",
-        (modelo_id, user_id),
-    )
-    conn.commit()
-    cur.close()
-    conn.close()
+    return True
 
-    # Eliminar archivo STL
-    if path_pub.startswith("/static/"):
-        rel = path_pub[len("/static/"):]
-        abs_path = MODELOS3D_DIR.parent / rel
 
-        if abs_path.is_file():
-            try:
-                abs_path.unlink()
-            except:
-                pass
+def _borrar_stl_legado(session_id: str, path_pub: str) -> None:
+    if path_pub and path_pub.startswith("/static/"):
+        abs_path = MODELOS3D_DIR.parent / path_pub[len("/static/"):]
+        try:
+            abs_path.unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"No se pudo borrar {abs_path}: {e}")
 
-    # Eliminar carpeta vacía
     folder = MODELOS3D_DIR / session_id
     try:
         if folder.is_dir() and not os.listdir(folder):
             folder.rmdir()
-    except:
-        pass
-
-    return True
+    except OSError as e:
+        logger.warning(f"No se pudo borrar {folder}: {e}")
@@ -0,0 +1,453 @@
+# api/services/reconciliacion_service.py
+import argparse
+import datetime
+import json
+import logging
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Iterator, Optional
+
+from api.services.almacenamiento_service import clave_de, es_remoto, obtener_backend, retirar, retirar_carpeta
+from api.services.artefactos_service import EXTENSIONES_DERIVADAS, liberar_propietario, ruta_artefacto
+from api.services.metadatos_service import _SQL_SESION_ARCHIVO
+from config.db_config import get_connection
+
+# Importar rutas persistentes desde config.paths
+from config.paths import (
+    ARTEFACTOS_DIR,
+    INSTANCIAS_CAS_DIR,
+    MODELOS3D_DIR,
+    RENDER_CACHE_DIR,
+    SEGMENTATIONS_2D_DIR,
+    SEGMENTATIONS_3D_DIR,
+    SERIES_DIR,
+)
+
+logger = logging.getLogger(__name__)
+
+# ==============================================================
+# Reconciliación de huérfanos entre /data/static y la BD
+# ==============================================================
+# Recorre el volumen y las tablas en streaming y emite un hallazgo por
+# huérfano (dict), terminando con un resumen. Con borrar=True además los
+# elimina (archivos uno a uno, filas de BD por lotes).
+#
+# Memoria acotada: los conjuntos que se comparan en memoria son de sesiones
+# (uno por serie, no por archivo). Blobs del almacén y filas de artefacto se
+# cruzan con un merge de dos secuencias ordenadas por hash; las instancias del
+# CAS solo necesitan su st_nlink.
+#
+# Lo modificado hace menos de RECONCILIACION_GRACIA_S se ignora: puede ser
+# una ingesta o una escritura todavía sin su fila en BD.
+#
+# Con un backend remoto, que falte algo en el disco de este nodo no es pérdida
+# si el backend lo tiene (aún no se rehidrató); lo que se borra por huérfano
+# se retira también del backend.
+
+RECONCILIACION_GRACIA_S = int(os.getenv("RECONCILIACION_GRACIA_S", 3600))
+RECONCILIACION_LOTE = int(os.getenv("RECONCILIACION_LOTE", 500))
+
+# Carpetas con una subcarpeta por session_id
+_RAICES_POR_SESION = [
+    ("series", SERIES_DIR),
+    ("segmentations2d", SEGMENTATIONS_2D_DIR),
+    ("segmentations3d", SEGMENTATIONS_3D_DIR),
+    ("modelos3d", MODELOS3D_DIR),
+    ("render_cache", RENDER_CACHE_DIR),
+]
+
+
+def reconciliar(borrar: bool = False, gracia_s: Optional[int] = None) -> Iterator[dict]:
+    """Genera los hallazgos de huérfanos y, al final, {"tipo": "resumen", ...}."""
+    gracia_s = RECONCILIACION_GRACIA_S if gracia_s is None else gracia_s
+    limite = time.time() - gracia_s
+    inicio = time.time()
+    conteos = {}
+    bytes_liberados = 0
+
+    for pasada in (
+        _carpetas_sin_sesion,
+        _sesiones_sin_archivos,
+        _blobs_huerfanos,
+        _instancias_cas_sin_enlaces,
+        _referencias_huerfanas,
+    ):
+        for hallazgo in pasada(borrar, limite):
+            conteos[hallazgo["tipo"]] = conteos.get(hallazgo["tipo"], 0) + 1
+            if hallazgo.get("borrado"):
+                bytes_liberados += hallazgo.get("bytes") or 0
+            yield hallazgo
+
+    yield {
+        "tipo": "resumen",
+        "borrar": borrar,
+        "conteos": conteos,
+        "bytes_liberados": bytes_liberados,
+        "duracion_s": round(time.time() - inicio, 3),
+    }
+
+
+# ==============================================================
+# Sesiones: carpetas en disco vs filas en BD
+# ==============================================================
+
+def _sesiones_en_bd() -> set:
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            f"""
+            SELECT DISTINCT {_SQL_SESION_ARCHIVO} FROM archivodicom
+            UNION SELECT session_id FROM serie_dicom
+            UNION SELECT session_id FROM segmentacion3d
+            UNION SELECT session_id FROM modelo3d
+            """
+        )
+        return {r[0] for r in cur.fetchall() if r[0]}
+    finally:
+        cur.close()
+        conn.close()
+
+
+def _carpetas_sin_sesion(borrar: bool, limite: float) -> Iterator[dict]:
+    sesiones = _sesiones_en_bd()
+
+    for raiz_nombre, raiz in _RAICES_POR_SESION:
+        try:
+            entradas = list(os.scandir(raiz))
+        except FileNotFoundError:
+            continue
+
+        for entrada in entradas:
+            # render_cache/inodos es la caché compartida, no una sesión
+            if not entrada.is_dir(follow_symlinks=False) or entrada.name in sesiones:
+                continue
+            if raiz == RENDER_CACHE_DIR and entrada.name == "inodos":
+                continue
+            if entrada.stat(follow_symlinks=False).st_mtime > limite:
+                continue
+
+            hallazgo = {"tipo": "carpeta_sin_sesion", "raiz": raiz_nombre, "session_id": entrada.name}
+            if borrar:
+                try:
+                    shutil.rmtree(entrada.path)
+                    retirar_carpeta(entrada.path)
+                    hallazgo["borrado"] = True
+                except OSError as exc:
+                    hallazgo["borrado"] = False
+                    hallazgo["error"] = str(exc)
+            yield hallazgo
+
+
+def _sesiones_sin_archivos(borrar: bool, limite: float) -> Iterator[dict]:
+    """
+    Sesiones cuyos DICOM (rutaarchivo bajo SERIES_DIR) ya no están en disco
+    ni en el backend. Las filas fuera de SERIES_DIR no cuentan ni se tocan.
+    Las sesiones con resultados clínicos (protesisdimension, segmentacion3d)
+    solo se informan; de las demás se borran las filas.
+    """
+    # fechacarga es una fecha: solo cuentan las cargas de días anteriores al límite
+    dia_limite = datetime.date.fromtimestamp(limite)
+
+    lote = []
+    for session_id, rutas, fechacarga in _archivos_por_sesion():
+        if fechacarga is None or fechacarga >= dia_limite:
+            continue
+        if any(os.path.exists(r) for r in rutas):
+            continue
+        if _en_backend(SERIES_DIR / session_id / "mapping.json"):
+            continue
+
+        lote.append(session_id)
+        if len(lote) >= RECONCILIACION_LOTE:
+            yield from _resolver_sesiones(lote, borrar)
+            lote = []
+
+    if lote:
+        yield from _resolver_sesiones(lote, borrar)
+
+
+def _archivos_por_sesion() -> Iterator[tuple]:
+    """(session_id, [rutaarchivo], fechacarga más reciente) de las filas bajo SERIES_DIR."""
+    conn = get_connection()
+    # Cursor con nombre: las filas llegan por bloques, agrupadas por sesión
+    cur = conn.cursor(name="reconciliacion_archivos")
+    cur.itersize = 10000
+    try:
+        cur.execute(
+            f"""
+            SELECT {_SQL_SESION_ARCHIVO} AS sesion, rutaarchivo, fechacarga
+            FROM archivodicom
+            WHERE rutaarchivo LIKE %s AND {_SQL_SESION_ARCHIVO} IS NOT NULL
+            ORDER BY sesion COLLATE "C"
+            """,
+            (_prefijo_series(),),
+        )
+        actual, rutas, fecha = None, [], None
+        for sesion, ruta, fechacarga in cur:
+            if sesion != actual:
+                if actual is not None:
+                    yield actual, rutas, fecha
+                actual, rutas, fecha = sesion, [], None
+            rutas.append(ruta)
+            if fechacarga is not None and (fecha is None or fechacarga > fecha):
+                fecha = fechacarga
+        if actual is not None:
+            yield actual, rutas, fecha
+    finally:
+        cur.close()
+        conn.close()
+
+
+def _resolver_sesiones(sesiones: list, borrar: bool) -> Iterator[dict]:
+    clinicas = _resultados_clinicos(sesiones)
+    borrables = [s for s in sesiones if s not in clinicas]
+
+    error = None
+    if borrar and borrables:
+        try:
+            _borrar_filas_de_sesiones(borrables)
+        except Exception as exc:
+            error = str(exc)
+
+    for session_id in sesiones:
+        hallazgo = {"tipo": "sesion_sin_archivos", "session_id": session_id}
+        if session_id in clinicas:
+            # Nunca se borran automáticamente: quedan para revisión manual
+            hallazgo["resultados_clinicos"] = sorted(clinicas[session_id])
+            if borrar:
+                hallazgo["borrado"] = False
+        elif borrar:
+            hallazgo["borrado"] = error is None
+            if error:
+                hallazgo["error"] = error
+        yield hallazgo
+
+
+def _resultados_clinicos(sesiones: list) -> dict:
+    """session_id → tablas con resultados clínicos de la sesión."""
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            f"""
+            SELECT DISTINCT {_SQL_SESION_ARCHIVO}, 'protesisdimension'
+            FROM archivodicom a
+            JOIN protesisdimension p ON p.archivodicomid = a.archivodicomid
+            WHERE {_SQL_SESION_ARCHIVO} = ANY(%s)
+            UNION
+            SELECT DISTINCT session_id, 'segmentacion3d' FROM segmentacion3d WHERE session_id = ANY(%s)
+            """,
+            (sesiones, sesiones),
+        )
+        clinicas = {}
+        for session_id, tabla in cur.fetchall():
+            clinicas.setdefault(session_id, set()).add(tabla)
+        return clinicas
+    finally:
+        cur.close()
+        conn.close()
+
+
+def _borrar_filas_de_sesiones(sesiones: list) -> None:
+    # Solo sesiones sin resultados clínicos (ver _resolver_sesiones); si entre
+    # tanto aparece una protesisdimension, su clave foránea aborta el lote.
+    # estudios_paciente se conserva: es historia clínica, no un derivado
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT id FROM modelo3d WHERE session_id = ANY(%s)", (sesiones,))
+        for (modelo_id,) in cur.fetchall():
+            liberar_propietario(cur, f"modelo3d:{modelo_id}")
+
+        cur.execute("DELETE FROM modelo3d WHERE session_id = ANY(%s)", (sesiones,))
+        cur.execute("DELETE FROM serie_dicom WHERE session_id = ANY(%s)", (sesiones,))
+        cur.execute(
+            f"DELETE FROM archivodicom WHERE rutaarchivo LIKE %s AND {_SQL_SESION_ARCHIVO} = ANY(%s)",
+            (_prefijo_series(), sesiones),
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+
+def _prefijo_series() -> str:
+    # Patrón LIKE de las rutas bajo SERIES_DIR (con sus comodines escapados)
+    base = os.path.abspath(SERIES_DIR).replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return base + "/%"
+
+
+# ==============================================================
+# Almacén de artefactos: merge ordenado por hash
+# ==============================================================
+
+def _blobs_en_disco() -> Iterator[tuple]:
+    """(hash, extension, ruta, stat) en orden de hash: <aa>/ ordenadas y su contenido ordenado."""
+    try:
+        prefijos = sorted(e.name for e in os.scandir(ARTEFACTOS_DIR) if e.is_dir() and e.name != "tmp")
+    except FileNotFoundError:
+        return
+
+    for prefijo in prefijos:
+        for nombre in sorted(os.listdir(ARTEFACTOS_DIR / prefijo)):
+            ruta = ARTEFACTOS_DIR / prefijo / nombre
+            try:
+                st = os.stat(ruta)
+            except FileNotFoundError:
+                continue
+            yield ruta.stem, ruta.suffix, ruta, st
+
+
+def _blobs_en_bd(conn) -> Iterator[tuple]:
+    # Cursor con nombre (del lado del servidor): las filas llegan por bloques
+    cur = conn.cursor(name="reconciliacion_artefactos")
+    cur.itersize = 10000
+    try:
+        cur.execute('SELECT hash, extension FROM artefacto ORDER BY hash COLLATE "C"')
+        for fila in cur:
+            yield fila
+    finally:
+        cur.close()
+
+
+def _blobs_huerfanos(borrar: bool, limite: float) -> Iterator[dict]:
+    conn = get_connection()
+    try:
+        filas = _blobs_en_bd(conn)
+        fila = next(filas, None)
+
+        for clave, extension, ruta, st in _blobs_en_disco():
+            while fila is not None and fila[0] < clave:
+                yield from _registro_sin_blob(fila)
+                fila = next(filas, None)
+
+            if fila is not None and fila[0] == clave:
+                fila = next(filas, None)
+                continue
+
+            if st.st_mtime > limite:
+                continue
+            hallazgo = {"tipo": "blob_sin_registro", "ruta": str(ruta), "bytes": st.st_size}
+            if borrar:
+                hallazgo["borrado"] = _borrar_archivo(ruta, hallazgo)
+                if hallazgo["borrado"]:
+                    retirar(ruta)
+            yield hallazgo
+
+        while fila is not None:
+            yield from _registro_sin_blob(fila)
+            fila = next(filas, None)
+    finally:
+        conn.close()
+
+
+def _registro_sin_blob(fila) -> Iterator[dict]:
+    # Un derivado sin archivo es un desalojo normal (se regenera al pedirlo);
+    # una fuente sin archivo es pérdida de datos y solo se informa
+    if fila[1] not in EXTENSIONES_DERIVADAS and not _en_backend(ruta_artefacto(fila[0], fila[1])):
+        yield {"tipo": "registro_sin_blob", "hash": fila[0], "extension": fila[1]}
+
+
+# ==============================================================
+# CAS de instancias y referencias a propietarios borrados
+# ==============================================================
+
+def _instancias_cas_sin_enlaces(borrar: bool, limite: float) -> Iterator[dict]:
+    pendientes = [str(INSTANCIAS_CAS_DIR)]
+    while pendientes:
+        try:
+            entradas = os.scandir(pendientes.pop())
+        except FileNotFoundError:
+            continue
+        with entradas:
+            for entrada in entradas:
+                if entrada.is_dir(follow_symlinks=False):
+                    pendientes.append(entrada.path)
+                    continue
+                try:
+                    st = entrada.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                if st.st_nlink > 1 or st.st_mtime > limite:
+                    continue
+
+                hallazgo = {"tipo": "instancia_cas_sin_enlaces", "ruta": entrada.path, "bytes": st.st_size}
+                if borrar:
+                    hallazgo["borrado"] = _borrar_archivo(Path(entrada.path), hallazgo)
+                yield hallazgo
+
+
+def _referencias_huerfanas(borrar: bool, limite: float) -> Iterator[dict]:
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            """
+            SELECT DISTINCT r.propietario
+            FROM artefacto_ref r
+            WHERE (r.propietario LIKE 'seg3d:%' AND NOT EXISTS (
+                       SELECT 1 FROM segmentacion3d s
+                       WHERE 'seg3d:' || s.id = r.propietario))
+               OR (r.propietario LIKE 'modelo3d:%' AND NOT EXISTS (
+                       SELECT 1 FROM modelo3d m
+                       WHERE 'modelo3d:' || m.id = r.propietario))
+            """
+        )
+        propietarios = [r[0] for r in cur.fetchall()]
+
+        for i in range(0, len(propietarios), RECONCILIACION_LOTE):
+            lote = propietarios[i:i + RECONCILIACION_LOTE]
+            if borrar:
+                for propietario in lote:
+                    liberar_propietario(cur, propietario)
+                conn.commit()
+            for propietario in lote:
+                hallazgo = {"tipo": "referencia_huerfana", "propietario": propietario}
+                if borrar:
+                    hallazgo["borrado"] = True
+                yield hallazgo
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+
+def _en_backend(ruta: Path) -> bool:
+    return es_remoto() and obtener_backend().existe(clave_de(ruta))
+
+
+def _borrar_archivo(ruta: Path, hallazgo: dict) -> bool:
+    try:
+        ruta.unlink()
+        return True
+    except FileNotFoundError:
+        return True
+    except OSError as exc:
+        hallazgo["error"] = str(exc)
+        return False
+
+
+# ==============================================================
+# Línea de comandos: python -m api.services.reconciliacion_service
+# ==============================================================
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Informa (o borra) huérfanos entre /data/static y la BD")
+    parser.add_argument("--borrar", action="store_true", help="elimina los huérfanos encontrados")
+    parser.add_argument("--gracia", type=int, default=None, help="segundos de gracia (por defecto RECONCILIACION_GRACIA_S)")
+    args = parser.parse_args(argv)
+
+    for hallazgo in reconciliar(borrar=args.borrar, gracia_s=args.gracia):
+        print(json.dumps(hallazgo, ensure_ascii=False), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,421 @@
+# api/services/render_service.py
+import io
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+from skimage import exposure
+
+from api.services.cache_service import cargar_mapping, leer_slice_dicom
+
+# Importar rutas persistentes desde config.paths
+from config.paths import SERIES_DIR, RENDER_CACHE_DIR
+
+# ==============================================================
+# Render perezoso de slices (PNG CLAHE) con caché en disco acotada
+# ==============================================================
+# La ingesta ya no genera PNGs: cada slice se renderiza la primera vez que
+# se pide y queda en RENDER_CACHE_DIR/inodos/. La clave es el inodo del DICOM
+# (+ mtime): las sesiones que enlazan la misma instancia del CAS comparten el
+# render. La caché se acota por bytes; al superarse se borran los PNG usados
+# hace más tiempo.
+#
+# El desalojo no recorre el directorio: un índice en memoria (ruta → bytes,
+# del uso más antiguo al más reciente) se construye con un único recorrido
+# (orden por mtime, que se actualiza en cada acierto) y se mantiene en cada
+# render y acierto. Otros procesos y el presupuesto de disco también escriben
+# y borran aquí, así que se vuelve a sincronizar con el disco cada
+# RENDER_CACHE_RESINCRONIZAR_S.
+
+RENDER_CACHE_MAX_BYTES = int(os.getenv("RENDER_CACHE_MAX_BYTES", 2 * 1024 * 1024 * 1024))
+RENDER_CACHE_RESINCRONIZAR_S = float(os.getenv("RENDER_CACHE_RESINCRONIZAR_S", 600))
+
+# Tras desalojar, la caché queda en este porcentaje del presupuesto, para no
+# desalojar en cada render
+RENDER_CACHE_OBJETIVO = 0.9
+
+_lock = threading.Lock()
+_renders_en_curso = {}
+_indice = OrderedDict()
+_indice_at = None
+_stats = {"bytes": 0, "hits": 0, "misses": 0, "renders": 0, "evictions": 0, "legacy": 0}
+
+
+def ruta_slice_cacheada(session_id: str, image_name: str) -> Optional[Path]:
+    """
+    Devuelve la ruta del PNG si ya existe (render previo o PNG antiguo
+    generado en la ingesta), o None si hay que renderizarlo.
+    """
+    # Series ingeridas antes del render perezoso: el PNG vive junto al DICOM
+    legacy = SERIES_DIR / session_id / image_name
+    if legacy.is_file():
+        with _lock:
+            _stats["legacy"] += 1
+        return legacy
+
+    destino = _ruta_render(session_id, image_name)
+    if destino is None:
+        return None
+
+    try:
+        os.utime(destino)
+    except FileNotFoundError:
+        return None
+
+    with _lock:
+        _stats["hits"] += 1
+        if str(destino) in _indice:
+            _indice.move_to_end(str(destino))
+    return destino
+
+
+def renderizar_slice(session_id: str, image_name: str) -> Path:
+    """
+    Renderiza el slice (si no está ya en caché) y devuelve la ruta del PNG.
+    Peticiones simultáneas del mismo slice esperan a un único render.
+    """
+    ruta = ruta_slice_cacheada(session_id, image_name)
+    if ruta is not None:
+        return ruta
+
+    destino = _ruta_render(session_id, image_name)
+    if destino is None:
+        raise FileNotFoundError("imagen no encontrada en mapping")
+
+    with _lock:
+        evento = _renders_en_curso.get(destino)
+        propio = evento is None
+        if propio:
+            evento = _renders_en_curso[destino] = threading.Event()
+            _stats["misses"] += 1
+
+    if not propio:
+        evento.wait()
+        if destino.is_file():
+            return destino
+        return renderizar_slice(session_id, image_name)
+
+    try:
+        mapping = cargar_mapping(session_id)
+        dicom_path = SERIES_DIR / session_id / mapping[image_name]["dicom_name"]
+        _, arr = leer_slice_dicom(dicom_path)
+
+        png = renderizar_png_clahe(arr)
+
+        destino.parent.mkdir(parents=True, exist_ok=True)
+        tmp = destino.with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            f.write(png)
+        os.replace(tmp, destino)
+
+        _registrar_render(destino, len(png))
+        return destino
+    finally:
+        with _lock:
+            _renders_en_curso.pop(destino, None)
+        evento.set()
+
+
+def renderizar_png_clahe(arr: np.ndarray) -> bytes:
+    """Normaliza, aplica CLAHE y codifica a PNG en escala de grises."""
+    image = arr.astype(np.float32)
+
+    if np.max(image) > 1:
+        image = (image - np.min(image)) / (np.max(image) - np.min(image) + 1e-6)
+
+    try:
+        image = exposure.equalize_adapthist(image)
+    except Exception:
+        image = np.clip(image, 0, 1)
+
+    image = (image * 255).astype("uint8")
+    buffer = io.BytesIO()
+    Image.fromarray(image).convert("L").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def invalidar_renders(session_id: str) -> int:
+    """
+    Borra los renders de los slices de la sesión que no comparte ninguna otra.
+    Llamar ANTES de borrar los DICOM: la clave del render es su inodo. Los de
+    instancias del CAS enlazadas desde otras series se quedan (los desaloja el
+    LRU cuando dejen de usarse). Devuelve cuántos borró.
+    """
+    try:
+        mapping = cargar_mapping(session_id)
+    except FileNotFoundError:
+        return 0
+
+    borrados = 0
+    for entrada in mapping.values():
+        try:
+            st = os.stat(SERIES_DIR / session_id / entrada["dicom_name"])
+        except FileNotFoundError:
+            continue
+        # Enlaces propios: el de la serie y, si viene del CAS, el del almacén
+        if st.st_nlink > (2 if entrada.get("cas") else 1):
+            continue
+
+        ruta = _ruta_por_stat(st)
+        with _lock:
+            _stats["bytes"] -= _indice.pop(str(ruta), 0)
+        try:
+            os.remove(ruta)
+            borrados += 1
+        except FileNotFoundError:
+            pass
+    return borrados
+
+
+def estadisticas_render() -> dict:
+    with _lock:
+        total = _stats["hits"] + _stats["misses"]
+        return {
+            **_stats,
+            "max_bytes": RENDER_CACHE_MAX_BYTES,
+            "hit_ratio": round(_stats["hits"] / total, 4) if total else None,
+        }
+
+
+def _ruta_render(session_id: str, image_name: str) -> Optional[Path]:
+    try:
+        mapping = cargar_mapping(session_id)
+    except FileNotFoundError:
+        return None
+    entrada = mapping.get(image_name)
+    if entrada is None:
+        return None
+
+    # Clave por inodo + versión del DICOM: si se reemplaza, el PNG viejo deja
+    # de usarse y acaba desalojado
+    try:
+        st = os.stat(SERIES_DIR / session_id / entrada["dicom_name"])
+    except FileNotFoundError:
+        return None
+    return _ruta_por_stat(st)
+
+
+def _ruta_por_stat(st: os.stat_result) -> Path:
+    return RENDER_CACHE_DIR / "inodos" / f"{st.st_ino & 0xFF:02x}" / (
+        f"{st.st_dev:x}-{st.st_ino:x}-{st.st_mtime_ns:x}.png"
+    )
+
+
+def _registrar_render(ruta: Path, size: int) -> None:
+    _sincronizar_indice()
+    with _lock:
+        _stats["bytes"] += size - _indice.pop(str(ruta), 0)
+        _indice[str(ruta)] = size
+        _stats["renders"] += 1
+        excedido = _stats["bytes"] > RENDER_CACHE_MAX_BYTES
+
+    if excedido:
+        _desalojar()
+
+
+def _sincronizar_indice() -> None:
+    """Reconstruye el índice desde disco si no existe o toca resincronizar."""
+    global _indice_at
+    with _lock:
+        ahora = time.monotonic()
+        if _indice_at is not None and ahora - _indice_at < RENDER_CACHE_RESINCRONIZAR_S:
+            return
+        # Se marca antes de recorrer: un solo hilo recorre el directorio
+        _indice_at = ahora
+
+    entradas = []
+    for raiz, _, archivos in os.walk(RENDER_CACHE_DIR):
+        for nombre in archivos:
+            ruta = os.path.join(raiz, nombre)
+            try:
+                st = os.stat(ruta)
+            except FileNotFoundError:
+                continue
+            entradas.append((st.st_mtime, ruta, st.st_size))
+    entradas.sort()
+
+    # Lo que el índice tiene y el recorrido no vio: borrado, o registrado
+    # mientras se recorría (en ese caso es lo más reciente)
+    vistos = {ruta for _, ruta, _ in entradas}
+    with _lock:
+        faltantes = [(r, t) for r, t in _indice.items() if r not in vistos]
+    recientes = [(r, t) for r, t in faltantes if os.path.exists(r)]
+
+    with _lock:
+        _indice.clear()
+        for _, ruta, size in entradas:
+            _indice[ruta] = size
+        for ruta, size in recientes:
+            _indice[ruta] = size
+        _stats["bytes"] = sum(_indice.values())
+
+
+def _desalojar() -> None:
+    objetivo = RENDER_CACHE_MAX_BYTES * RENDER_CACHE_OBJETIVO
+    victimas = []
+    with _lock:
+        while _indice and _stats["bytes"] > objetivo:
+            ruta, size = _indice.popitem(last=False)
+            _stats["bytes"] -= size
+            victimas.append(ruta)
+
+    borrados = 0
+    for ruta in victimas:
+        try:
+            os.remove(ruta)
+        except FileNotFoundError:
+            continue
+        borrados += 1
+
+    with _lock:
+        _stats["evictions"] += borrados
+
+
+# ==============================================================
+# Atlas de miniaturas (sprite sheets) por sesión
+# ==============================================================
+# Todas las miniaturas de la serie empaquetadas en una o pocas imágenes, más
+# un índice JSON con la posición de cada slice: el visor precarga la serie
+# entera en un par de peticiones. Se generan una vez por sesión y tamaño en
+# SERIES_DIR/<session_id>/atlas/<lado>/ y se regeneran si cambia mapping.json.
+
+ATLAS_LADO_MAX_PX = 4096
+ATLAS_CALIDAD_JPEG = int(os.getenv("ATLAS_CALIDAD_JPEG", 85))
+
+# Un lock por (sesión, lado) mientras alguien lo usa; no se acumulan
+_atlas_locks = weakref.WeakValueDictionary()
+
+
+def obtener_atlas(session_id: str, lado: int = 128) -> dict:
+    """Devuelve el índice del atlas (generándolo si no existe o está desactualizado)."""
+    if not (32 <= lado <= 512):
+        raise ValueError("lado debe estar entre 32 y 512")
+
+    mapping_path = SERIES_DIR / session_id / "mapping.json"
+    try:
+        st = os.stat(mapping_path)
+    except FileNotFoundError:
+        raise FileNotFoundError("mapping.json no encontrado para la serie")
+    firma = [st.st_mtime_ns, st.st_size]
+
+    carpeta = SERIES_DIR / session_id / "atlas" / str(lado)
+    indice = _leer_indice_atlas(carpeta)
+    if indice is not None and indice["firma_mapping"] == firma:
+        return indice
+
+    with _lock:
+        lock = _atlas_locks.get((session_id, lado))
+        if lock is None:
+            lock = _atlas_locks[(session_id, lado)] = threading.Lock()
+
+    with lock:
+        indice = _leer_indice_atlas(carpeta)
+        if indice is not None and indice["firma_mapping"] == firma:
+            return indice
+        return _generar_atlas(session_id, lado, carpeta, firma)
+
+
+def miniatura_clahe(arr: np.ndarray, lado: int) -> np.ndarray:
+    """
+    Miniatura uint8 que cabe en lado x lado. Se reduce antes de aplicar
+    CLAHE: mucho más barato que renderizar a resolución completa.
+    """
+    image = arr.astype(np.float32)
+    image = (image - np.min(image)) / (np.max(image) - np.min(image) + 1e-6)
+
+    escala = lado / max(image.shape)
+    if escala < 1:
+        tam = (max(1, round(image.shape[1] * escala)), max(1, round(image.shape[0] * escala)))
+        image = np.asarray(Image.fromarray(image, mode="F").resize(tam, Image.BILINEAR))
+
+    try:
+        image = exposure.equalize_adapthist(np.clip(image, 0, 1))
+    except Exception:
+        image = np.clip(image, 0, 1)
+
+    return (image * 255).astype("uint8")
+
+
+def _generar_atlas(session_id: str, lado: int, carpeta: Path, firma: list) -> dict:
+    mapping = cargar_mapping(session_id)
+    nombres = sorted(mapping, key=_orden_imagen)
+    if not nombres:
+        raise ValueError("La serie no tiene slices")
+
+    # Hojas lo más cuadradas posible, sin pasar de ATLAS_LADO_MAX_PX por lado
+    # (límite habitual de tamaño de textura en el navegador)
+    max_celdas = ATLAS_LADO_MAX_PX // lado
+    columnas = min(max_celdas, int(np.ceil(np.sqrt(len(nombres)))))
+    por_atlas = columnas * max_celdas
+
+    tmp_dir = carpeta.with_name(f"{lado}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+
+    tiles = {}
+    urls = []
+    for k in range(0, len(nombres), por_atlas):
+        grupo = nombres[k:k + por_atlas]
+        filas = -(-len(grupo) // columnas)
+        hoja = Image.new("L", (min(len(grupo), columnas) * lado, filas * lado))
+        n_atlas = len(urls)
+
+        for i, nombre in enumerate(grupo):
+            try:
+                _, arr = leer_slice_dicom(SERIES_DIR / session_id / mapping[nombre]["dicom_name"])
+                mini = miniatura_clahe(arr, lado)
+            except Exception as e:
+                print(f"⚠️ Slice omitido en atlas {nombre}: {e}")
+                continue
+
+            x, y = (i % columnas) * lado, (i // columnas) * lado
+            hoja.paste(Image.fromarray(mini), (x, y))
+            tiles[nombre] = {"atlas": n_atlas, "x": x, "y": y, "w": mini.shape[1], "h": mini.shape[0]}
+
+        archivo = f"atlas_{n_atlas}.jpg"
+        hoja.save(tmp_dir / archivo, format="JPEG", quality=ATLAS_CALIDAD_JPEG)
+        urls.append(f"/static/series/{session_id}/atlas/{lado}/{archivo}")
+
+    indice = {
+        "session_id": session_id,
+        "lado": lado,
+        "columnas": columnas,
+        "atlas": urls,
+        "orden": [n for n in nombres if n in tiles],
+        "tiles": tiles,
+        "firma_mapping": firma,
+    }
+    with open(tmp_dir / "index.json", "w", encoding="utf-8") as f:
+        json.dump(indice, f, ensure_ascii=False)
+
+    # Reemplazo de la carpeta completa: nunca se mezclan hojas de dos versiones
+    viejo = carpeta.with_name(f"{lado}.old")
+    shutil.rmtree(viejo, ignore_errors=True)
+    if carpeta.exists():
+        os.replace(carpeta, viejo)
+    os.replace(tmp_dir, carpeta)
+    shutil.rmtree(viejo, ignore_errors=True)
+
+    return indice
+
+
+def _leer_indice_atlas(carpeta: Path) -> Optional[dict]:
+    try:
+        with open(carpeta / "index.json", "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _orden_imagen(nombre: str):
+    m = re.search(r"(\d+)", nombre)
+    return (int(m.group(1)) if m else -1, nombre)
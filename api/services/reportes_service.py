@@ -15,6 +15,7 @@ from datetime import datetime
 from pathlib import Path
 import os
 
+from api.services.almacenamiento_service import publicar
 from config.db_config import get_connection
 
 # 📌 Importar rutas persistentes desde config.paths
@@ -309,6 +310,7 @@ def generar_reporte_estudio(session_id: str, user_id: int) -> str:
 
     # ================== GENERAR PDF ==================
     doc.build(elements)
+    publicar(pdf_path)
 
     # Ruta pública para frontend
     return f"/static/reportes/{pdf_filename}"
@@ -1,12 +1,21 @@
 # api/services/segmentation3d_service.py
+import logging
 import os
-import json
-import time
-import uuid
 import numpy as np
 import pydicom
 from skimage import measure, morphology, io
 from config.db_config import get_connection
+from api.services.artefactos_service import (
+    guardar_artefacto,
+    liberar_propietario,
+    referenciar,
+    registrar_regenerador,
+    ruta_referenciada,
+    ruta_temporal,
+)
+from api.services.cache_service import cargar_mapping, leer_slice_dicom
+from api.services.manifiesto_service import contiene_bajo, quitar
+from api.services.metadatos_service import espaciado_serie, extraer_metadatos, geometria_serie
 from skimage.filters import threshold_otsu
 from skimage.morphology import binary_closing, ball
 from typing import Optional
@@ -15,6 +24,8 @@ from scipy.ndimage import binary_fill_holes, median_filter
 # 🔥 Importamos rutas PERSISTENTES reales del volumen
 from config.paths import SERIES_DIR, SEGMENTATIONS_3D_DIR
 
+logger = logging.getLogger(__name__)
+
 
 # ==============================================================
 # RUTAS — SIN RENOMBRAR NADA, SOLO AJUSTADAS A VOLUMENES
@@ -41,7 +52,7 @@ def _seg3d_dir(session_id: str):
 
 
 # ==============================================================
-# Helpers extra — TODO igual, no se tocó nada
+# Helpers
 # ==============================================================
 
 def _interpolar_slice(arr1: np.ndarray, arr2: np.ndarray) -> np.ndarray:
@@ -74,46 +85,43 @@ def _save_ascii_stl(verts: np.ndarray, faces: np.ndarray, filepath: str, solid_n
 
 
 # ==============================================================
-# Carga del volumen 3D — TODO igual
+# Carga del volumen 3D
 # ==============================================================
 
 def _load_stack(session_id: str):
     base = _serie_dir(session_id)
-    mapping_path = os.path.join(base, "mapping.json")
-    if not os.path.isfile(mapping_path):
-        raise FileNotFoundError("mapping.json no encontrado para la serie")
+    mapping = cargar_mapping(session_id)
 
-    with open(mapping_path, "r", encoding="utf-8") as f:
-        mapping = json.load(f)
+    # Orden y spacing desde el índice de metadatos; solo se leen las cabeceras
+    # de los slices que no estén indexados (series previas al índice)
+    try:
+        geometria = geometria_serie(session_id)
+    except Exception as e:
+        logger.warning("Índice de metadatos no disponible para %s: %s", session_id, e)
+        geometria = None
+    indexadas = geometria["instancias"] if geometria else {}
 
-    entries = []
-    for _, meta in mapping.items():
+    enriched = []
+    for image_name, meta in mapping.items():
         dcm_name = meta.get("dicom_name")
         if not dcm_name:
             continue
         p = os.path.join(base, dcm_name)
-        if os.path.isfile(p):
-            entries.append(p)
+        if not os.path.isfile(p):
+            continue
 
-    if not entries:
-        raise ValueError("No se encontraron DICOM válidos en la serie")
+        if image_name in indexadas:
+            z, inst = indexadas[image_name]
+            enriched.append((p, geometria["modality"], z, inst))
+            continue
 
-    enriched = []
-    for p in entries:
-        ds = pydicom.dcmread(p, force=True, stop_before_pixels=True)
-        modality = str(getattr(ds, "Modality", "")).upper()
-
-        z = None
-        ipp = getattr(ds, "ImagePositionPatient", None)
-        if isinstance(ipp, (list, tuple)) and len(ipp) == 3:
-            try:
-                z = float(ipp[2])
-            except:
-                z = None
-
-        inst = getattr(ds, "InstanceNumber", None)
-        inst = int(inst) if inst is not None else None
-        enriched.append((p, modality, z, inst))
+        # Mismos campos que guarda el índice (ImagePositionPatient llega como
+        # MultiValue de pydicom, no como list)
+        m = extraer_metadatos(pydicom.dcmread(p, force=True, stop_before_pixels=True))
+        enriched.append((p, m["modality"] or "", m["posicion_z"], m["instance_number"]))
+
+    if not enriched:
+        raise ValueError("No se encontraron DICOM válidos en la serie")
 
     # ordenar por Z
     def _sort_key(t):
@@ -131,10 +139,8 @@ def _load_stack(session_id: str):
     z_values_all = []
 
     for p, modality, z, _ in enriched:
-        ds = pydicom.dcmread(p, force=True)
-
         try:
-            arr = ds.pixel_array
+            ds, arr = leer_slice_dicom(p)
         except:
             continue
 
@@ -170,12 +176,17 @@ def _load_stack(session_id: str):
     ds0 = slices[0][1]
 
     px_y, px_x = 1.0, 1.0
-    try:
-        px_y, px_x = [float(v) for v in ds0.PixelSpacing]
-    except:
-        pass
+    if geometria and geometria["pixel_spacing"]:
+        px_y, px_x = geometria["pixel_spacing"]
+    else:
+        try:
+            px_y, px_x = [float(v) for v in ds0.PixelSpacing]
+        except:
+            pass
 
     slice_thk = getattr(ds0, "SliceThickness", 1.0)
+    if geometria and geometria["slice_thickness"] is not None:
+        slice_thk = geometria["slice_thickness"]
     try:
         slice_thk = float(slice_thk)
     except:
@@ -201,9 +212,53 @@ def _load_stack(session_id: str):
 
 
 # ==============================================================
-# SEGMENTACIÓN 3D — TODO IGUAL SIN CAMBIAR UNA LÍNEA
+# Segmentación 3D
 # ==============================================================
 
+def _volumen_a_umbralizar(vol, estadisticas) -> tuple:
+    """
+    (volumen float32 a umbralizar, sus estadísticas). Los volúmenes grandes
+    pasan por un filtro de mediana 3x3x3 y sus umbrales se calculan sobre el
+    volumen filtrado; si no, valen las estadísticas guardadas de la serie
+    (`estadisticas()`), que son las del mismo volumen.
+    """
+    vol = np.asarray(vol)
+    if vol.size > 2_000_000:
+        try:
+            # Sobre el dtype guardado: la mediana de int16 da los mismos
+            # valores que en float32 y las estadísticas salen por histograma
+            filtrado = median_filter(vol, size=3)
+        except Exception:
+            filtrado = None
+        if filtrado is not None:
+            from api.services.volumen_service import calcular_estadisticas
+
+            return filtrado.astype(np.float32), calcular_estadisticas(filtrado)
+
+    return vol.astype(np.float32), estadisticas()
+
+
+def _mascara_umbral(vol: np.ndarray, modality: str, stats: dict, preset: Optional[str]) -> np.ndarray:
+    # Percentiles y Otsu de `stats` en lugar de recalcularlos sobre el volumen
+    if stats["n"] == 0:
+        return np.zeros_like(vol, dtype=bool)
+
+    pct = stats["percentiles"]
+    if modality == "CT":
+        if preset == "ct_bone":
+            return (vol >= 250) & (vol <= 4000)
+        lo, hi = pct["40"], pct["99"]
+        return (vol > lo) & (vol < hi)
+
+    lo, hi = pct["2"], pct["98"]
+    thr = stats["otsu"].get("p2_p98")
+    if thr is None:
+        vclip = np.clip(vol, lo, hi)
+        vclip = (vclip - lo) / (hi - lo + 1e-6)
+        return vclip > threshold_otsu(vclip)
+    return np.clip(vol, lo, hi) > thr
+
+
 def segmentar_serie_3d(
     session_id: str,
     user_id: int,
@@ -214,37 +269,15 @@ def segmentar_serie_3d(
     close_radius_mm: float = 1.5,
 ) -> dict:
 
-    vol, spacing, modality = _load_stack(session_id)
-    base_out = _seg3d_dir(session_id)
+    # Volumen y estadísticas persistidos por serie (se calculan una sola vez)
+    from api.services.volumen_service import cargar_volumen, estadisticas_serie
 
-    if vol.size > 2_000_000:
-        try:
-            vol = median_filter(vol, size=3)
-        except:
-            pass
-
-    mask = None
+    vol_mm, meta = cargar_volumen(session_id)
+    spacing = tuple(meta["spacing"])
+    modality = meta["modality"]
 
-    # (NO SE CAMBIA NADA)
-    v = vol[np.isfinite(vol)]
-    if modality == "CT":
-        if v.size == 0:
-            mask = np.zeros_like(vol, dtype=bool)
-        else:
-            if preset == "ct_bone":
-                mask = (vol >= 250) & (vol <= 4000)
-            else:
-                lo, hi = np.percentile(v, [40, 99])
-                mask = (vol > lo) & (vol < hi)
-    else:
-        if v.size == 0:
-            mask = np.zeros_like(vol, dtype=bool)
-        else:
-            lo, hi = np.percentile(v, [2, 98])
-            vclip = np.clip(vol, lo, hi)
-            vclip = (vclip - lo) / (hi - lo + 1e-6)
-            thr = threshold_otsu(vclip)
-            mask = vclip > thr
+    vol, stats = _volumen_a_umbralizar(vol_mm, lambda: estadisticas_serie(session_id))
+    mask = _mascara_umbral(vol, modality, stats, preset)
 
     if mask is None or mask.ndim != 3:
         raise ValueError("Máscara 3D inválida")
@@ -272,33 +305,22 @@ def segmentar_serie_3d(
     voxels = int(mask.sum())
     volume_mm3 = float(voxels * voxel_mm3)
 
-    uid = f"{int(time.time()*1e6)}_{uuid.uuid4().hex[:8]}"
+    # Máscara, miniaturas y STL van al almacén de artefactos (deduplicados);
+    # se escriben a temporales y guardar_artefacto los mueve por hash
+    tmp_mask = ruta_temporal(".npy")
+    np.save(tmp_mask, mask.astype(np.uint8))
+    artefactos = {"mask": guardar_artefacto(tmp_mask, ".npy")}
 
-    def _pub(name: str):
-        return f"/static/segmentations3d/{session_id}/{name}"
-
-    mask_name = f"{uid}_mask.npy"
-    ax_name   = f"{uid}_axial.png"
-    sg_name   = f"{uid}_sagittal.png"
-    cr_name   = f"{uid}_coronal.png"
-
-    np.save(os.path.join(base_out, mask_name), mask.astype(np.uint8))
-
-    zc = mask.shape[0] // 2
-    yc = mask.shape[1] // 2
-    xc = mask.shape[2] // 2
-
-    io.imsave(os.path.join(base_out, ax_name), (mask[zc].astype(np.uint8) * 255))
-    io.imsave(os.path.join(base_out, sg_name), (mask[:, :, xc].astype(np.uint8) * 255))
-    io.imsave(os.path.join(base_out, cr_name), (mask[:, yc].astype(np.uint8) * 255))
+    for rol, corte in _cortes_miniatura(mask).items():
+        tmp_thumb = ruta_temporal(".png")
+        _escribir_miniatura(corte, tmp_thumb)
+        artefactos[rol] = guardar_artefacto(tmp_thumb, ".png")
 
     surface_mm2 = None
     stl_url = None
 
     try:
-        verts, faces, _, _ = measure.marching_cubes(
-            mask.astype(np.uint8), level=0.5, spacing=tuple(spacing[::-1])
-        )
+        verts, faces = _malla(mask, spacing)
 
         tri_verts = verts[faces]
         v1 = tri_verts[:, 1, :] - tri_verts[:, 0, :]
@@ -306,44 +328,52 @@ def segmentar_serie_3d(
         cross = np.linalg.norm(np.cross(v1, v2), axis=1)
         surface_mm2 = float(np.sum(0.5 * cross))
 
-        stl_name = f"{uid}_head.stl"
-        stl_path = os.path.join(base_out, stl_name)
-        _save_ascii_stl(verts, faces, stl_path, solid_name=f"seg3d_{uid}")
-        stl_url = _pub(stl_name)
+        tmp_stl = ruta_temporal(".stl")
+        _save_ascii_stl(verts, faces, str(tmp_stl))
+        artefactos["stl"] = guardar_artefacto(tmp_stl, ".stl")
+        stl_url = artefactos["stl"]["url"]
 
     except Exception as e:
         print(f"Error STL: {e}")
 
     conn = get_connection()
     cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO segmentacion3d
-          (session_id, user_id, n_slices, volume_mm3, surface_mm2,
-           bbox_x_mm, bbox_y_mm, bbox_z_mm, mask_npy_path,
-           thumb_axial, thumb_sagittal, thumb_coronal)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        RETURNING id
-        """,
-        (
-            session_id,
-            int(user_id),
-            int(mask.shape[0]),
-            float(volume_mm3),
-            (float(surface_mm2) if surface_mm2 is not None else None),
-            mask.shape[2] * spacing[2],
-            mask.shape[1] * spacing[1],
-            mask.shape[0] * spacing[0],
-            _pub(mask_name),
-            _pub(ax_name),
-            _pub(sg_name),
-            _pub(cr_name),
-        ),
-    )
-    seg3d_id = int(cur.fetchone()[0])
-    conn.commit()
-    cur.close()
-    conn.close()
+    try:
+        cur.execute(
+            """
+            INSERT INTO segmentacion3d
+              (session_id, user_id, n_slices, volume_mm3, surface_mm2,
+               bbox_x_mm, bbox_y_mm, bbox_z_mm, mask_npy_path,
+               thumb_axial, thumb_sagittal, thumb_coronal,
+               spacing_z_mm, spacing_y_mm, spacing_x_mm)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            RETURNING id
+            """,
+            (
+                session_id,
+                int(user_id),
+                int(mask.shape[0]),
+                float(volume_mm3),
+                (float(surface_mm2) if surface_mm2 is not None else None),
+                mask.shape[2] * spacing[2],
+                mask.shape[1] * spacing[1],
+                mask.shape[0] * spacing[0],
+                artefactos["mask"]["url"],
+                artefactos["axial"]["url"],
+                artefactos["sagittal"]["url"],
+                artefactos["coronal"]["url"],
+                *(float(v) for v in spacing),
+            ),
+        )
+        seg3d_id = int(cur.fetchone()[0])
+        referenciar(cur, f"seg3d:{seg3d_id}", artefactos)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
 
     return {
         "message": "Segmentación 3D creada",
@@ -351,9 +381,9 @@ def segmentar_serie_3d(
         "volume_mm3": float(volume_mm3),
         "surface_mm2": (float(surface_mm2) if surface_mm2 else None),
         "thumbs": {
-            "axial": _pub(ax_name),
-            "sagittal": _pub(sg_name),
-            "coronal": _pub(cr_name),
+            "axial": artefactos["axial"]["url"],
+            "sagittal": artefactos["sagittal"]["url"],
+            "coronal": artefactos["coronal"]["url"],
         },
         "bbox": {
             "x_mm": mask.shape[2] * spacing[2],
@@ -367,6 +397,89 @@ def segmentar_serie_3d(
     }
 
 
+# ==============================================================
+# Miniaturas y malla (compartidas con la regeneración de artefactos)
+# ==============================================================
+
+def _cortes_miniatura(mask: np.ndarray) -> dict:
+    zc = mask.shape[0] // 2
+    yc = mask.shape[1] // 2
+    xc = mask.shape[2] // 2
+    return {
+        "axial": mask[zc],
+        "sagittal": mask[:, :, xc],
+        "coronal": mask[:, yc],
+    }
+
+
+def _escribir_miniatura(corte: np.ndarray, ruta) -> None:
+    io.imsave(str(ruta), corte.astype(np.uint8) * 255, check_contrast=False)
+
+
+def _malla(mask: np.ndarray, spacing):
+    verts, faces, _, _ = measure.marching_cubes(
+        mask.astype(np.uint8), level=0.5, spacing=tuple(spacing[::-1])
+    )
+    return verts, faces
+
+
+def espaciado_malla(session_id: str, guardado=None) -> tuple:
+    """
+    Spacing (dz, dy, dx) de la malla de una segmentación o modelo: el guardado
+    con la fila al crearla. Las filas anteriores no lo tienen: se usa el del
+    índice de metadatos y, si la serie no está indexada, el del volumen
+    persistido.
+    """
+    if guardado is not None and all(v is not None for v in guardado):
+        return tuple(float(v) for v in guardado)
+
+    try:
+        spacing = espaciado_serie(session_id)
+    except Exception as e:
+        logger.warning("Índice de metadatos no disponible para %s: %s", session_id, e)
+        spacing = None
+    if spacing is None:
+        from api.services.volumen_service import cargar_volumen
+
+        spacing = cargar_volumen(session_id)[1]["spacing"]
+    return tuple(spacing)
+
+
+def _regenerar_artefacto_seg3d(seg3d_id: str, rol: str, destino) -> None:
+    """Reescribe una miniatura o el STL de una segmentación desde su máscara."""
+    ruta_mask = ruta_referenciada(f"seg3d:{seg3d_id}", "mask")
+    if ruta_mask is None:
+        raise FileNotFoundError("La segmentación no tiene máscara en el almacén")
+    mask = np.load(ruta_mask) > 0
+
+    if rol == "stl":
+        conn = get_connection()
+        cur = conn.cursor()
+        try:
+            cur.execute(
+                """
+                SELECT session_id, spacing_z_mm, spacing_y_mm, spacing_x_mm
+                FROM segmentacion3d WHERE id = %s
+                """,
+                (int(seg3d_id),),
+            )
+            row = cur.fetchone()
+        finally:
+            cur.close()
+            conn.close()
+        if not row:
+            raise FileNotFoundError("Segmentación 3D no encontrada")
+
+        # Mismo spacing que al crearla: con otro, el STL no coincide con su hash
+        verts, faces = _malla(mask, espaciado_malla(row[0], row[1:]))
+        _save_ascii_stl(verts, faces, str(destino))
+    else:
+        _escribir_miniatura(_cortes_miniatura(mask)[rol], destino)
+
+
+registrar_regenerador("seg3d", _regenerar_artefacto_seg3d)
+
+
 # ==============================================================
 # LISTAR Y BORRAR — EXACTO COMO LO TENÍAS
 # ==============================================================
@@ -411,46 +524,56 @@ def listar_segmentaciones_3d(session_id: str, user_id: int):
 
 
 def borrar_segmentacion_3d(seg3d_id: int, user_id: int) -> bool:
+    """
+    Borra la fila y suelta sus artefactos en la misma transacción; los blobs
+    sin referencias los elimina el GC del almacén. Las segmentaciones
+    anteriores al almacén (archivos sueltos por sesión) se borran aquí.
+    """
     conn = get_connection()
     cur = conn.cursor()
-    cur.execute(
-        "SELECT session_id, mask_npy_path, thumb_axial, thumb_sagittal, thumb_coronal FROM segmentacion3d WHERE id = %s AND user_id = %s",
-        (seg3d_id, user_id),
-    )
-    row = cur.fetchone()
-    if not row:
+    try:
+        cur.execute(
+            "SELECT session_id, mask_npy_path, thumb_axial, thumb_sagittal, thumb_coronal FROM segmentacion3d WHERE id = %s AND user_id = %s",
+            (seg3d_id, user_id),
+        )
+        row = cur.fetchone()
+        if not row:
+            return False
+
+        cur.execute("DELETE FROM segmentacion3d WHERE id = %s AND user_id = %s", (seg3d_id, user_id))
+        en_almacen = liberar_propietario(cur, f"seg3d:{seg3d_id}") > 0
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
         cur.close()
         conn.close()
-        return False
 
-    session_id, npy_pub, ax_pub, sg_pub, cr_pub = row
-    base = _seg3d_dir(session_id)
+    if not en_almacen:
+        session_id, *publicas = row
+        _borrar_legado(session_id, publicas)
+
+    return True
 
-    cur.execute("DELETE FROM segmentacion3d WHERE id = %s AND user_id = %s", (seg3d_id, user_id))
-    conn.commit()
-    cur.close()
-    conn.close()
 
-    def rm(pub_path):
-        if not pub_path:
-            return
-        fname = os.path.basename(pub_path)
-        p = os.path.join(base, fname)
-        if os.path.isfile(p):
-            try:
-                os.remove(p)
-            except:
-                pass
-
-    rm(npy_pub)
-    rm(ax_pub)
-    rm(sg_pub)
-    rm(cr_pub)
+def _borrar_legado(session_id: str, publicas) -> None:
+    base = SEGMENTATIONS_3D_DIR / session_id
+    rutas = [base / os.path.basename(pub_path) for pub_path in publicas if pub_path]
+    for ruta in rutas:
+        try:
+            ruta.unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"No se pudo borrar {ruta}: {e}")
 
+    # El manifiesto dice si quedan archivos en la carpeta (sin listdir)
+    if contiene_bajo(quitar(session_id, rutas), base):
+        return
     try:
-        if os.path.isdir(base) and not os.listdir(base):
-            os.rmdir(base)
-    except:
+        base.rmdir()
+    except FileNotFoundError:
         pass
-
-    return True
+    except OSError as e:
+        logger.warning(f"No se pudo borrar {base}: {e}")
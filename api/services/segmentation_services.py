@@ -1,118 +1,527 @@
 import datetime
+import json
 import os
+from pathlib import Path
+from typing import List, Optional
+
 import numpy as np
-import pydicom
-from skimage import measure, morphology, io
-from skimage.measure import regionprops
+from scipy import ndimage as ndi
+from skimage import io
+from psycopg2.extras import execute_values
 
 from config.db_config import get_connection
+from api.services.almacenamiento_service import publicar
+from api.services.cache_service import cargar_mapping, leer_slice_dicom
+from api.services.manifiesto_service import registrar
+from api.utils.executors import io_pool
 
 # 📌 Importar rutas persistentes SIN usar api.main
-from config.paths import SEGMENTATIONS_2D_DIR
+from config.paths import SERIES_DIR, SEGMENTATIONS_2D_DIR
+
+# Slices por llamada al kernel vectorizado (acota la memoria de las etiquetas)
+LOTE_KERNEL_2D = int(os.getenv("SEG2D_LOTE_KERNEL", 64))
+
+# Parámetros por defecto de la segmentación 2D. Subir VERSION_ALGORITMO_2D
+# cuando cambie el algoritmo invalida los resultados memorizados.
+UMBRAL_2D = 400
+MIN_SIZE_2D = 500
+VERSION_ALGORITMO_2D = 1
 
 
 def segmentar_dicom(
     dicom_path: str,
     archivodicomid: int,
     user_id: int,
-    session_id: str = None
+    session_id: str = None,
+    umbral: int = UMBRAL_2D,
+    min_size: int = MIN_SIZE_2D,
 ) -> dict:
     """
     Segmentación 2D sobre un archivo DICOM individual.
     Guarda la máscara en /data/static/segmentations/<session_id>/
+    Si el slice ya se segmentó con los mismos parámetros, devuelve el resultado guardado.
     """
 
     # ========== 1) Determinar session_id a partir de la ruta ==========
     if session_id is None:
-        parts = dicom_path.replace("\\", "/").split("/")
-        if "series" in parts:
-            idx = parts.index("series")
-            session_id = parts[idx + 1]
-        else:
-            session_id = "default"
+        session_id = _session_id_desde_ruta(dicom_path)
 
     # ========== 2) Carpeta persistente para almacenar la máscara ==========
     output_dir = SEGMENTATIONS_2D_DIR / session_id
     output_dir.mkdir(parents=True, exist_ok=True)
 
     try:
-        # ========== 3) Leer el DICOM ==========
-        ds = pydicom.dcmread(dicom_path)
-        imagen = ds.pixel_array.astype(np.int16)
-
-        # ========== 4) Segmentación ==========
-        umbral = 400
-        mascara = imagen > umbral
-        mascara = morphology.remove_small_objects(mascara, min_size=500)
-
-        etiquetas = measure.label(mascara)
-        props = regionprops(etiquetas)
-
-        if props:
-            lbl = max(props, key=lambda r: r.area).label
-            segmento = etiquetas == lbl
-        else:
-            segmento = np.zeros_like(imagen)
-
-        binaria = segmento.astype(np.uint8) * 255
-
-        # ========== 5) Guardar máscara persistente ==========
-        base = os.path.splitext(os.path.basename(dicom_path))[0]
-        rel_filename = f"{base}_mask.png"
-        absolute_mask_path = output_dir / rel_filename
-
-        io.imsave(str(absolute_mask_path), binaria)
-
-        # ========== 6) Calcular medidas ==========
-        px_y, px_x = ds.PixelSpacing
-        slice_thk = getattr(ds, "SliceThickness", 1.0)
-
-        if props:
-            r = max(props, key=lambda r: r.area)
-            minr, minc, maxr, maxc = r.bbox
-            largo_px = maxr - minr
-            ancho_px = maxc - minc
-            area_px = r.area
-            perim_px = r.perimeter
-
-            dimensiones = {
-                "Longitud (mm)": round(largo_px * px_y, 2),
-                "Ancho (mm)": round(ancho_px * px_x, 2),
-                "Altura (mm)": round(slice_thk, 2),
-                "Área (mm²)": round(area_px * px_x * px_y, 2),
-                "Perímetro (px)": round(perim_px, 2),
-                "Volumen (mm³)": round(area_px * px_x * px_y * slice_thk, 2),
-            }
+        parametros = _parametros_2d(umbral, min_size)
 
-            # Guardar en BD
-            datos_bd = {
-                "archivodicomid": archivodicomid,
-                "altura": dimensiones["Altura (mm)"],
-                "volumen": dimensiones["Volumen (mm³)"],
-                "longitud": dimensiones["Longitud (mm)"],
-                "ancho": dimensiones["Ancho (mm)"],
-                "tipoprotesis": "Cráneo",
-                "unidad": "mm³",
-                "user_id": user_id,
-            }
-            guardar_protesis_dimension(datos_bd)
+        # ========== 3) ¿Ya segmentado con estos parámetros? ==========
+        resultado = _leer_memo(dicom_path, output_dir, archivodicomid, parametros)
+        reutilizada = resultado is not None
+
+        if not reutilizada:
+            resultado = _segmentar_slice(dicom_path, output_dir, umbral, min_size)
 
-        else:
-            dimensiones = {"error": "No se detectó región válida."}
+            # ========== 6) Guardar en BD (upsert) ==========
+            guardado = True
+            if resultado["datos_bd"] is not None:
+                datos_bd = dict(resultado["datos_bd"], archivodicomid=archivodicomid, user_id=user_id)
+                guardado = guardar_protesis_dimension(datos_bd)
+
+            if guardado:
+                _guardar_memo(dicom_path, output_dir, archivodicomid, parametros, resultado)
+            registrar(
+                session_id,
+                [output_dir / resultado["mask_filename"], _memo_path(dicom_path, output_dir)],
+            )
 
         # ========== 7) Ruta pública ==========
-        public_mask_path = f"/static/segmentations/{session_id}/{rel_filename}"
+        public_mask_path = f"/static/segmentations/{session_id}/{resultado['mask_filename']}"
 
         return {
             "mensaje": "Segmentación exitosa",
             "mask_path": public_mask_path,
-            "dimensiones": dimensiones,
+            "dimensiones": resultado["dimensiones"],
+            "reutilizada": reutilizada,
         }
 
     except Exception as e:
         return {"error": str(e)}
 
 
+def segmentar_serie_2d(
+    session_id: str,
+    user_id: int,
+    image_names: Optional[List[str]] = None,
+    umbral: int = UMBRAL_2D,
+    min_size: int = MIN_SIZE_2D,
+) -> dict:
+    """
+    Segmentación 2D por lotes de una serie completa (o de una lista de slices).
+    Lee mapping.json una sola vez, segmenta los slices con el kernel
+    vectorizado, escribe todas las máscaras e inserta todas las medidas en UNA
+    transacción. Los slices ya segmentados con los mismos parámetros no se
+    recalculan.
+
+    Pensada para correr en el pool de CPU (ejecutar_cpu): las lecturas de DICOM
+    y las escrituras de máscaras se reparten en el pool de I/O compartido, sin
+    crear hilos propios por petición.
+    """
+    series_path = SERIES_DIR / session_id
+    mapping = cargar_mapping(session_id)
+    parametros = _parametros_2d(umbral, min_size)
+
+    if image_names is None:
+        image_names = list(mapping.keys())
+
+    output_dir = SEGMENTATIONS_2D_DIR / session_id
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    errores = []
+    tareas = []
+    for image_name in image_names:
+        meta = mapping.get(image_name)
+        if meta is None:
+            errores.append({"image_name": image_name, "error": "imagen no encontrada en mapping"})
+            continue
+        tareas.append((image_name, meta, str(series_path / meta["dicom_name"])))
+
+    # 0) Resultados ya memorizados (mismo slice y parámetros)
+    resultados = [
+        _leer_memo(dicom_path, output_dir, meta["archivodicomid"], parametros)
+        for _, meta, dicom_path in tareas
+    ]
+    reutilizadas = [r is not None for r in resultados]
+    pendientes = [i for i, r in enumerate(resultados) if r is None]
+
+    # 1) Lectura y decodificación de los DICOM en paralelo (pool de I/O)
+    leidos = []
+    futuros = {i: io_pool.submit(_leer_slice, tareas[i][2]) for i in pendientes}
+    for i, futuro in futuros.items():
+        try:
+            ds, imagen = futuro.result()
+        except Exception as e:
+            errores.append({"image_name": tareas[i][0], "error": str(e)})
+            continue
+        leidos.append((i, ds, imagen))
+
+    # 2) Kernel vectorizado por bloques de slices con la misma forma
+    grupos = {}
+    for item in leidos:
+        grupos.setdefault(item[2].shape, []).append(item)
+
+    escrituras = []
+    for grupo in grupos.values():
+        for inicio in range(0, len(grupo), LOTE_KERNEL_2D):
+            bloque = grupo[inicio:inicio + LOTE_KERNEL_2D]
+            seg = segmentar_stack_2d(
+                np.stack([imagen for _, _, imagen in bloque]), umbral=umbral, min_size=min_size
+            )
+
+            for j, (i, ds, _) in enumerate(bloque):
+                mask_filename = _mask_filename(tareas[i][2])
+                binaria = seg["mascaras"][j].astype(np.uint8) * 255
+                escrituras.append(
+                    (i, io_pool.submit(_escribir_mascara, output_dir / mask_filename, binaria))
+                )
+                resultados[i] = {
+                    "mask_filename": mask_filename,
+                    **_medidas_slice(ds, seg, j),
+                }
+
+    # 3) Esperar las escrituras de máscaras
+    for i, futuro in escrituras:
+        try:
+            futuro.result()
+        except Exception as e:
+            errores.append({"image_name": tareas[i][0], "error": str(e)})
+            resultados[i] = None
+
+    salida = []
+    filas_bd = []
+    nuevas = []
+    for i, ((image_name, meta, dicom_path), resultado) in enumerate(zip(tareas, resultados)):
+        if resultado is None:
+            continue
+
+        if not reutilizadas[i]:
+            nuevas.append((dicom_path, meta["archivodicomid"], resultado))
+            if resultado["datos_bd"] is not None:
+                filas_bd.append(
+                    dict(resultado["datos_bd"], archivodicomid=meta["archivodicomid"], user_id=user_id)
+                )
+
+        salida.append(
+            {
+                "image_name": image_name,
+                "archivodicomid": meta["archivodicomid"],
+                "mask_path": f"/static/segmentations/{session_id}/{resultado['mask_filename']}",
+                "dimensiones": resultado["dimensiones"],
+                "reutilizada": reutilizadas[i],
+            }
+        )
+
+    guardar_protesis_dimensiones(filas_bd)
+
+    # Solo se memoriza lo que ya quedó persistido en BD
+    for dicom_path, archivodicomid, resultado in nuevas:
+        _guardar_memo(dicom_path, output_dir, archivodicomid, parametros, resultado)
+
+    registrar(
+        session_id,
+        [
+            ruta
+            for dicom_path, _, resultado in nuevas
+            for ruta in (output_dir / resultado["mask_filename"], _memo_path(dicom_path, output_dir))
+        ],
+    )
+
+    return {
+        "mensaje": "Segmentación por lotes completada",
+        "session_id": session_id,
+        "total": len(image_names),
+        "segmentadas": len(salida),
+        "reutilizadas": sum(reutilizadas),
+        "resultados": salida,
+        "errores": errores,
+    }
+
+
+# ==============================================================
+# Kernel vectorizado de segmentación 2D sobre un stack de slices
+# ==============================================================
+
+# Estructuras 3D con conectividad SOLO dentro del plano (z no conecta)
+_ESTRUCTURA_4 = np.zeros((3, 3, 3), dtype=bool)
+_ESTRUCTURA_4[1] = ndi.generate_binary_structure(2, 1)
+
+_ESTRUCTURA_8 = np.zeros((3, 3, 3), dtype=bool)
+_ESTRUCTURA_8[1] = ndi.generate_binary_structure(2, 2)
+
+# Mismo esquema de pesos que skimage.measure.perimeter (vecindad 4)
+_PESOS_PERIMETRO = np.zeros(50, dtype=np.float64)
+_PESOS_PERIMETRO[[5, 7, 15, 17, 25, 27]] = 1
+_PESOS_PERIMETRO[[21, 33]] = np.sqrt(2)
+_PESOS_PERIMETRO[[13, 23]] = (1 + np.sqrt(2)) / 2
+
+
+def segmentar_stack_2d(
+    stack: np.ndarray, umbral: int = UMBRAL_2D, min_size: int = MIN_SIZE_2D
+) -> dict:
+    """
+    Segmenta todos los slices de un stack (n, alto, ancho) de una vez.
+    Equivale, slice a slice, a umbral + remove_small_objects + label +
+    mayor región de regionprops, pero con un único etiquetado 3D cuya
+    conectividad no cruza entre slices.
+
+    Devuelve arrays por slice: mascaras, valido, area, bbox y perimetro.
+    """
+    stack = np.asarray(stack)
+    if stack.ndim == 2:
+        stack = stack[np.newaxis]
+    n = stack.shape[0]
+
+    # 1) Umbral + eliminación de objetos pequeños (conectividad 4, como skimage)
+    mascara = stack > umbral
+    etiquetas, _ = ndi.label(mascara, structure=_ESTRUCTURA_4)
+    conservar = np.bincount(etiquetas.ravel()) >= min_size
+    conservar[0] = False
+    mascara = conservar[etiquetas]
+
+    # 2) Etiquetado (conectividad 8) de todos los slices en una sola llamada
+    etiquetas, n_etiquetas = ndi.label(mascara, structure=_ESTRUCTURA_8)
+    areas = np.bincount(etiquetas.ravel(), minlength=n_etiquetas + 1)
+
+    # ndimage numera en orden raster y ninguna etiqueta cruza de slice, así que
+    # las etiquetas de cada slice forman un rango creciente: basta el máximo por slice
+    max_por_slice = np.maximum.accumulate(etiquetas.reshape(n, -1).max(axis=1))
+    ids = np.arange(1, n_etiquetas + 1)
+    z_etiqueta = np.searchsorted(max_por_slice, ids)
+
+    # 3) Mayor componente por slice (empates -> etiqueta menor, igual que max())
+    orden = np.lexsort((ids, -areas[1:], z_etiqueta))
+    z_ordenado, primeros = np.unique(z_etiqueta[orden], return_index=True)
+    ganadoras = ids[orden[primeros]]
+
+    valido = np.zeros(n, dtype=bool)
+    valido[z_ordenado] = True
+    area = np.zeros(n, dtype=np.int64)
+    area[z_ordenado] = areas[ganadoras]
+
+    seleccion = np.zeros(n_etiquetas + 1, dtype=bool)
+    seleccion[ganadoras] = True
+    mascaras = seleccion[etiquetas]
+
+    # 4) Bounding boxes en bloque a partir de las proyecciones
+    filas = mascaras.any(axis=2)
+    columnas = mascaras.any(axis=1)
+    bbox = np.stack(
+        [
+            filas.argmax(axis=1),
+            columnas.argmax(axis=1),
+            filas.shape[1] - filas[:, ::-1].argmax(axis=1),
+            columnas.shape[1] - columnas[:, ::-1].argmax(axis=1),
+        ],
+        axis=1,
+    )
+    bbox[~valido] = 0
+
+    # 5) Perímetro en bloque: histograma de patrones de borde por slice,
+    #    calculado solo dentro de la caja que envuelve todas las regiones
+    perimetro = np.zeros(n, dtype=np.float64)
+    if valido.any():
+        r0, c0 = bbox[valido, 0].min(), bbox[valido, 1].min()
+        r1, c1 = bbox[valido, 2].max(), bbox[valido, 3].max()
+        p = np.pad(mascaras[:, r0:r1, c0:c1], ((0, 0), (2, 2), (2, 2)))
+
+        # Erosión con cruz (vecindad 4) y borde = región - erosión
+        centro = p[:, 1:-1, 1:-1]
+        erosion = centro & p[:, :-2, 1:-1] & p[:, 2:, 1:-1] & p[:, 1:-1, :-2] & p[:, 1:-1, 2:]
+        borde = np.pad((centro & ~erosion).view(np.uint8), ((0, 0), (1, 1), (1, 1)))
+
+        # Correlación con [[10, 2, 10], [2, 1, 2], [10, 2, 10]] mediante vistas desplazadas
+        patrones = borde[:, 1:-1, 1:-1].copy()
+        patrones += 2 * (borde[:, :-2, 1:-1] + borde[:, 2:, 1:-1] + borde[:, 1:-1, :-2] + borde[:, 1:-1, 2:])
+        patrones += 10 * (borde[:, :-2, :-2] + borde[:, :-2, 2:] + borde[:, 2:, :-2] + borde[:, 2:, 2:])
+
+        z_borde, fila, col = np.nonzero(patrones)
+        histograma = np.bincount(
+            z_borde * 50 + patrones[z_borde, fila, col], minlength=n * 50
+        ).reshape(n, 50)
+        perimetro = histograma @ _PESOS_PERIMETRO
+
+    return {
+        "mascaras": mascaras,
+        "valido": valido,
+        "area": area,
+        "bbox": bbox,
+        "perimetro": perimetro,
+    }
+
+
+# ==============================================================
+# Helpers de segmentación 2D (sin acceso a BD)
+# ==============================================================
+
+def _session_id_desde_ruta(dicom_path: str) -> str:
+    parts = dicom_path.replace("\\", "/").split("/")
+    if "series" in parts:
+        idx = parts.index("series")
+        return parts[idx + 1]
+    return "default"
+
+
+def _mask_filename(dicom_path: str) -> str:
+    base = os.path.splitext(os.path.basename(dicom_path))[0]
+    return f"{base}_mask.png"
+
+
+def _parametros_2d(umbral: int, min_size: int) -> dict:
+    return {"umbral": int(umbral), "min_size": int(min_size), "version": VERSION_ALGORITMO_2D}
+
+
+def _memo_path(dicom_path: str, output_dir):
+    base = os.path.splitext(os.path.basename(dicom_path))[0]
+    return output_dir / f"{base}_mask.json"
+
+
+def _firma_archivo(path: str) -> list:
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size]
+
+
+def _leer_memo(dicom_path: str, output_dir, archivodicomid: int, parametros: dict) -> Optional[dict]:
+    """
+    Resultado guardado de una segmentación previa de este slice, o None si no hay,
+    si cambió algún parámetro, si cambió el DICOM o si ya no existe la máscara.
+    """
+    memo_path = _memo_path(dicom_path, output_dir)
+    try:
+        with open(memo_path, "r", encoding="utf-8") as f:
+            memo = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if (
+        memo.get("archivodicomid") != int(archivodicomid)
+        or memo.get("parametros") != parametros
+        or memo.get("dicom") != _firma_archivo(dicom_path)
+        or not (output_dir / memo.get("mask_filename", "")).is_file()
+    ):
+        return None
+
+    return {
+        "mask_filename": memo["mask_filename"],
+        "dimensiones": memo["dimensiones"],
+        "datos_bd": memo["datos_bd"],
+    }
+
+
+def _guardar_memo(dicom_path: str, output_dir, archivodicomid: int, parametros: dict, resultado: dict) -> None:
+    memo_path = _memo_path(dicom_path, output_dir)
+    memo = {
+        "archivodicomid": int(archivodicomid),
+        "parametros": parametros,
+        "dicom": _firma_archivo(dicom_path),
+        "mask_filename": resultado["mask_filename"],
+        "dimensiones": resultado["dimensiones"],
+        "datos_bd": resultado["datos_bd"],
+    }
+
+    # Escritura atómica: nunca queda un memo a medias
+    tmp_path = memo_path.with_suffix(".json.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(memo, f, ensure_ascii=False)
+    os.replace(tmp_path, memo_path)
+
+
+def _leer_slice(dicom_path: str):
+    ds, arr = leer_slice_dicom(dicom_path)
+    return ds, arr.astype(np.int16)
+
+
+def _medidas_slice(ds, seg: dict, i: int) -> dict:
+    """Dimensiones en mm del slice i de un resultado de segmentar_stack_2d."""
+    if not seg["valido"][i]:
+        return {"dimensiones": {"error": "No se detectó región válida."}, "datos_bd": None}
+
+    px_y, px_x = ds.PixelSpacing
+    slice_thk = getattr(ds, "SliceThickness", 1.0)
+
+    minr, minc, maxr, maxc = (int(v) for v in seg["bbox"][i])
+    largo_px = maxr - minr
+    ancho_px = maxc - minc
+    area_px = int(seg["area"][i])
+    perim_px = float(seg["perimetro"][i])
+
+    dimensiones = {
+        "Longitud (mm)": round(largo_px * px_y, 2),
+        "Ancho (mm)": round(ancho_px * px_x, 2),
+        "Altura (mm)": round(slice_thk, 2),
+        "Área (mm²)": round(area_px * px_x * px_y, 2),
+        "Perímetro (px)": round(perim_px, 2),
+        "Volumen (mm³)": round(area_px * px_x * px_y * slice_thk, 2),
+    }
+
+    datos_bd = {
+        "altura": dimensiones["Altura (mm)"],
+        "volumen": dimensiones["Volumen (mm³)"],
+        "longitud": dimensiones["Longitud (mm)"],
+        "ancho": dimensiones["Ancho (mm)"],
+        "tipoprotesis": "Cráneo",
+        "unidad": "mm³",
+    }
+
+    return {"dimensiones": dimensiones, "datos_bd": datos_bd}
+
+
+def _segmentar_slice(
+    dicom_path: str, output_dir, umbral: int = UMBRAL_2D, min_size: int = MIN_SIZE_2D
+) -> dict:
+    """
+    Segmenta un slice, guarda <base>_mask.png en output_dir y calcula las medidas.
+    Devuelve las dimensiones y los datos a persistir (sin archivodicomid ni user_id).
+    """
+    # ========== 3) Leer el DICOM ==========
+    ds, imagen = _leer_slice(dicom_path)
+
+    # ========== 4) Segmentación ==========
+    seg = segmentar_stack_2d(imagen[np.newaxis], umbral=umbral, min_size=min_size)
+    binaria = seg["mascaras"][0].astype(np.uint8) * 255
+
+    # ========== 5) Guardar máscara persistente ==========
+    rel_filename = _mask_filename(dicom_path)
+    absolute_mask_path = output_dir / rel_filename
+
+    _escribir_mascara(absolute_mask_path, binaria)
+
+    # ========== 6) Calcular medidas ==========
+    return {"mask_filename": rel_filename, **_medidas_slice(ds, seg, 0)}
+
+
+def _escribir_mascara(ruta, binaria: np.ndarray) -> None:
+    # La máscara se publica en el backend; el memo .json no, porque lleva la
+    # firma (mtime) del DICOM de este nodo y en otro no serviría
+    io.imsave(str(ruta), binaria)
+    publicar(ruta)
+
+
+def regenerar_mascara_2d(mask_path) -> bool:
+    """
+    Reescribe una máscara 2D desalojada a partir de su resultado memorizado
+    (mismos parámetros, mismo DICOM). Sin memo válido devuelve False y la
+    próxima segmentación la recalcula.
+    """
+    mask_path = Path(mask_path)
+    session_id = mask_path.parent.name
+    try:
+        with open(mask_path.with_suffix(".json"), "r", encoding="utf-8") as f:
+            memo = json.load(f)
+        mapping = cargar_mapping(session_id)
+    except (OSError, ValueError):
+        return False
+
+    base = mask_path.name[: -len("_mask.png")]
+    dicom_name = next(
+        (m["dicom_name"] for m in mapping.values() if os.path.splitext(m["dicom_name"])[0] == base),
+        None,
+    )
+    if dicom_name is None:
+        return False
+
+    dicom_path = str(SERIES_DIR / session_id / dicom_name)
+    parametros = memo.get("parametros") or {}
+    if parametros.get("version") != VERSION_ALGORITMO_2D or memo.get("dicom") != _firma_archivo(dicom_path):
+        return False
+
+    _, imagen = _leer_slice(dicom_path)
+    seg = segmentar_stack_2d(imagen[np.newaxis], umbral=parametros["umbral"], min_size=parametros["min_size"])
+
+    tmp_path = mask_path.with_name(f"{mask_path.stem}.tmp.png")
+    io.imsave(str(tmp_path), seg["mascaras"][0].astype(np.uint8) * 255)
+    os.replace(tmp_path, mask_path)
+    registrar(session_id, [mask_path])
+    return True
+
+
 def guardar_protesis_dimension(data: dict) -> bool:
     try:
         conn = get_connection()
@@ -123,6 +532,13 @@ def guardar_protesis_dimension(data: dict) -> bool:
             INSERT INTO ProtesisDimension
               (archivodicomid, altura, volumen, longitud, ancho, tipoprotesis, unidad, user_id)
             VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (archivodicomid, user_id) DO UPDATE SET
+              altura = EXCLUDED.altura,
+              volumen = EXCLUDED.volumen,
+              longitud = EXCLUDED.longitud,
+              ancho = EXCLUDED.ancho,
+              tipoprotesis = EXCLUDED.tipoprotesis,
+              unidad = EXCLUDED.unidad
             """,
             (
                 int(data["archivodicomid"]),
@@ -146,6 +562,55 @@ def guardar_protesis_dimension(data: dict) -> bool:
         return False
 
 
+def guardar_protesis_dimensiones(filas: List[dict]) -> int:
+    """Upsert de varias filas de ProtesisDimension en una sola transacción."""
+    # Una fila por (slice, usuario): ON CONFLICT no admite la misma clave dos veces
+    filas = list({(int(d["archivodicomid"]), int(d["user_id"])): d for d in filas}.values())
+    if not filas:
+        return 0
+
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    try:
+        execute_values(
+            cursor,
+            """
+            INSERT INTO ProtesisDimension
+              (archivodicomid, altura, volumen, longitud, ancho, tipoprotesis, unidad, user_id)
+            VALUES %s
+            ON CONFLICT (archivodicomid, user_id) DO UPDATE SET
+              altura = EXCLUDED.altura,
+              volumen = EXCLUDED.volumen,
+              longitud = EXCLUDED.longitud,
+              ancho = EXCLUDED.ancho,
+              tipoprotesis = EXCLUDED.tipoprotesis,
+              unidad = EXCLUDED.unidad
+            """,
+            [
+                (
+                    int(d["archivodicomid"]),
+                    float(d["altura"]),
+                    float(d["volumen"]),
+                    float(d["longitud"]),
+                    float(d["ancho"]),
+                    str(d["tipoprotesis"]),
+                    str(d["unidad"]),
+                    int(d["user_id"]),
+                )
+                for d in filas
+            ],
+        )
+        conn.commit()
+        return len(filas)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+
+
 def get_or_create_archivo_dicom(
     nombrearchivo: str, rutaarchivo: str, sistemaid: int = 1, user_id: int = None
 ) -> int:
@@ -0,0 +1,365 @@
+# api/services/upload_service.py
+import contextlib
+import functools
+import json
+import os
+import shutil
+import struct
+import threading
+import time
+import uuid
+import zipfile
+import zlib
+from pathlib import Path
+from typing import Optional
+
+from api.services.ingesta_service import iniciar_ingesta_series
+
+# Importar rutas persistentes desde config.paths
+from config.paths import UPLOADS_DIR
+
+# ==============================================================
+# Subida por chunks reanudable (init → PUT por offset → finalize)
+# ==============================================================
+# Cada subida vive en UPLOADS_DIR/<upload_id>/:
+#   datos.zip.part   bytes recibidos (siempre un prefijo contiguo del ZIP)
+#   estado.json      offset confirmado, cursor de extracción y miembros extraídos
+#   miembros/        archivos del ZIP ya completos, extraídos mientras llegan chunks
+#
+# El offset confirmado solo avanza tras escribir el chunk, así que un cliente
+# que pierde la conexión consulta GET /uploads/{id} y reanuda desde `recibido`.
+
+UPLOAD_CHUNK_MAX_BYTES = int(os.getenv("UPLOAD_CHUNK_MAX_BYTES", 64 * 1024 * 1024))
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", 8 * 1024 * 1024 * 1024))
+UPLOAD_RETENCION_S = int(os.getenv("UPLOAD_RETENCION_S", 24 * 3600))
+# Total descomprimido de una subida; por encima se rechaza (ZIP bomb)
+UPLOAD_MAX_DESCOMPRIMIDO_BYTES = int(os.getenv("UPLOAD_MAX_DESCOMPRIMIDO_BYTES", 4 * UPLOAD_MAX_BYTES))
+
+# Bloque de lectura/escritura al extraer miembros
+BLOQUE_EXTRACCION = 1024 * 1024
+
+_FIRMA_LOCAL = b"PK\x03\x04"
+_CABECERA_LOCAL = struct.Struct("<HHHHHIIIHH")
+
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+class OffsetIncorrecto(ValueError):
+    """El chunk no empieza donde termina lo ya recibido."""
+
+    def __init__(self, esperado: int):
+        super().__init__(f"Offset incorrecto, se esperaba {esperado}")
+        self.esperado = esperado
+
+
+def crear_upload(filename: str, total_size: int, user_id: int) -> dict:
+    if not filename.lower().endswith(".zip"):
+        raise ValueError("Debe subir un ZIP")
+    if total_size <= 0 or total_size > UPLOAD_MAX_BYTES:
+        raise ValueError(f"Tamaño inválido (máximo {UPLOAD_MAX_BYTES} bytes)")
+
+    purgar_uploads()
+
+    upload_id = uuid.uuid4().hex
+    carpeta = UPLOADS_DIR / upload_id
+    (carpeta / "miembros").mkdir(parents=True)
+    (carpeta / "datos.zip.part").touch()
+
+    ahora = time.time()
+    estado = {
+        "upload_id": upload_id,
+        "filename": filename,
+        "total_size": total_size,
+        "user_id": user_id,
+        "recibido": 0,
+        "cursor_zip": 0,
+        "extraccion_incremental": True,
+        "miembros": [],
+        "descomprimido": 0,
+        "session_id": None,
+        "sesiones": [],
+        "creado": ahora,
+        "actualizado": ahora,
+    }
+    _guardar_estado(carpeta, estado)
+    return estado
+
+
+def obtener_upload(upload_id: str, user_id: int) -> dict:
+    carpeta = _carpeta(upload_id)
+    estado = _leer_estado(carpeta)
+    if estado is None or estado["user_id"] != user_id:
+        raise FileNotFoundError("Subida no encontrada")
+    return estado
+
+
+def escribir_chunk(upload_id: str, user_id: int, offset: int, datos: bytes) -> dict:
+    """
+    Escribe un chunk en `offset` y extrae los miembros del ZIP que ya estén
+    completos. Solo acepta el chunk que continúa lo recibido (OffsetIncorrecto
+    si no), lo que hace seguro reintentar un PUT cuya respuesta se perdió.
+    """
+    if len(datos) > UPLOAD_CHUNK_MAX_BYTES:
+        raise ValueError(f"Chunk demasiado grande (máximo {UPLOAD_CHUNK_MAX_BYTES} bytes)")
+
+    carpeta = _carpeta(upload_id)
+    with _lock_de(upload_id):
+        estado = obtener_upload(upload_id, user_id)
+
+        if estado["session_id"] is not None:
+            raise ValueError("La subida ya fue finalizada")
+        if offset != estado["recibido"]:
+            raise OffsetIncorrecto(estado["recibido"])
+        if offset + len(datos) > estado["total_size"]:
+            raise ValueError("El chunk excede el tamaño declarado")
+
+        # Sobrescribir desde offset: si un intento anterior dejó bytes sin
+        # confirmar tras `recibido`, se descartan con el truncate
+        with open(carpeta / "datos.zip.part", "r+b") as f:
+            f.seek(offset)
+            f.write(datos)
+            f.truncate()
+
+        estado["recibido"] = offset + len(datos)
+        _extraer_completos(carpeta, estado)
+        estado["actualizado"] = time.time()
+        _guardar_estado(carpeta, estado)
+        return estado
+
+
+def finalizar_upload(upload_id: str, user_id: int) -> dict:
+    """
+    Valida el ZIP completo, extrae lo que falte y lanza la ingesta en segundo
+    plano sobre los archivos ya extraídos (una sesión por serie). Repetir la
+    llamada devuelve las mismas sesiones.
+    """
+    carpeta = _carpeta(upload_id)
+    with _lock_de(upload_id):
+        estado = obtener_upload(upload_id, user_id)
+        if estado["session_id"] is not None:
+            return estado
+
+        if estado["recibido"] != estado["total_size"]:
+            raise OffsetIncorrecto(estado["recibido"])
+
+        part = carpeta / "datos.zip.part"
+        try:
+            archivos = _completar_extraccion(carpeta, part, estado)
+        except zipfile.BadZipFile:
+            raise ValueError("El archivo recibido no es un ZIP válido")
+
+        if not archivos:
+            raise ValueError("No se encontraron archivos DICOM en el ZIP.")
+
+        estado["sesiones"] = iniciar_ingesta_series(
+            archivos, user_id=user_id, limpiar=str(carpeta / "miembros")
+        )
+        estado["session_id"] = estado["sesiones"][0]["session_id"]
+        estado["actualizado"] = time.time()
+        _guardar_estado(carpeta, estado)
+
+        # Solo con la ingesta aceptada y registrada deja de hacer falta el ZIP:
+        # si algo falla antes, repetir finalize vuelve a partir de él
+        part.unlink(missing_ok=True)
+        return estado
+
+
+def purgar_uploads(ahora: Optional[float] = None) -> int:
+    """Borra subidas abandonadas o finalizadas hace más de UPLOAD_RETENCION_S."""
+    ahora = ahora or time.time()
+    borradas = 0
+
+    for carpeta in UPLOADS_DIR.iterdir():
+        if not carpeta.is_dir():
+            continue
+        try:
+            actualizado = os.stat(carpeta / "estado.json").st_mtime
+        except FileNotFoundError:
+            actualizado = os.stat(carpeta).st_mtime
+        if ahora - actualizado <= UPLOAD_RETENCION_S:
+            continue
+
+        shutil.rmtree(carpeta, ignore_errors=True)
+        with _locks_lock:
+            _locks.pop(carpeta.name, None)
+        borradas += 1
+
+    return borradas
+
+
+# ==============================================================
+# Extracción incremental de miembros completos
+# ==============================================================
+
+def _extraer_completos(carpeta: Path, estado: dict) -> None:
+    """
+    Recorre las cabeceras locales del ZIP desde `cursor_zip` y extrae cada
+    miembro cuyo contenido ya llegó entero. Si aparece algo que no se puede
+    resolver sin el directorio central (tamaños en data descriptor, ZIP64,
+    cifrado, compresión distinta de stored/deflate), se deja para finalize.
+    """
+    if not estado["extraccion_incremental"]:
+        return
+
+    with open(carpeta / "datos.zip.part", "rb") as f:
+        while True:
+            cursor = estado["cursor_zip"]
+            if cursor + 30 > estado["recibido"]:
+                return
+
+            f.seek(cursor)
+            cabecera = f.read(30)
+            if cabecera[:4] != _FIRMA_LOCAL:
+                # Directorio central (o formato no soportado): fin de la pasada
+                estado["extraccion_incremental"] = False
+                return
+
+            (_, flags, metodo, _, _, crc, comprimido, _, largo_nombre, largo_extra) = (
+                _CABECERA_LOCAL.unpack(cabecera[4:])
+            )
+            if flags & 0x09 or metodo not in (0, 8) or comprimido == 0xFFFFFFFF:
+                estado["extraccion_incremental"] = False
+                return
+
+            fin = cursor + 30 + largo_nombre + largo_extra + comprimido
+            if fin > estado["recibido"]:
+                return
+
+            nombre = f.read(largo_nombre).decode("utf-8" if flags & 0x800 else "cp437")
+            f.seek(largo_extra, os.SEEK_CUR)
+
+            ruta = None if nombre.endswith("/") else _ruta_miembro(carpeta, estado, nombre)
+            try:
+                crc_leido, n = _volcar(_bloques_miembro(f, comprimido, metodo), ruta, estado)
+            except zlib.error:
+                crc_leido = None
+            if crc_leido != crc:
+                if ruta is not None:
+                    ruta.unlink(missing_ok=True)
+                estado["extraccion_incremental"] = False
+                return
+
+            estado["descomprimido"] = estado.get("descomprimido", 0) + n
+            if ruta is not None:
+                estado["miembros"].append({"nombre": nombre, "ruta": str(ruta)})
+
+            estado["cursor_zip"] = fin
+
+
+def _bloques_miembro(f, comprimido: int, metodo: int):
+    """
+    Contenido de un miembro stored/deflate que empieza en la posición actual
+    de `f`, por bloques de como mucho BLOQUE_EXTRACCION bytes descomprimidos.
+    """
+    d = zlib.decompressobj(-15) if metodo == 8 else None
+    pendiente = comprimido
+    while True:
+        if d is not None and d.unconsumed_tail:
+            yield d.decompress(d.unconsumed_tail, BLOQUE_EXTRACCION)
+        elif pendiente:
+            entrada = f.read(min(BLOQUE_EXTRACCION, pendiente))
+            if not entrada:
+                return
+            pendiente -= len(entrada)
+            yield d.decompress(entrada, BLOQUE_EXTRACCION) if d is not None else entrada
+        else:
+            if d is not None:
+                yield d.flush()
+            return
+
+
+def _volcar(bloques, ruta: Optional[Path], estado: dict) -> tuple:
+    """
+    Escribe los bloques en `ruta` (None: solo se leen) y devuelve
+    (crc32, bytes). Si el total descomprimido de la subida pasa de
+    UPLOAD_MAX_DESCOMPRIMIDO_BYTES borra `ruta` y lanza ValueError.
+    """
+    disponible = UPLOAD_MAX_DESCOMPRIMIDO_BYTES - estado.get("descomprimido", 0)
+    crc = n = 0
+    try:
+        with open(ruta, "wb") if ruta is not None else contextlib.nullcontext() as destino:
+            for bloque in bloques:
+                n += len(bloque)
+                if n > disponible:
+                    raise ValueError(
+                        f"El ZIP descomprimido excede el máximo ({UPLOAD_MAX_DESCOMPRIMIDO_BYTES} bytes)"
+                    )
+                crc = zlib.crc32(bloque, crc)
+                if destino is not None:
+                    destino.write(bloque)
+    except Exception:
+        if ruta is not None:
+            ruta.unlink(missing_ok=True)
+        raise
+    return crc, n
+
+
+def _completar_extraccion(carpeta: Path, part: Path, estado: dict) -> list:
+    """
+    Con el ZIP completo, extrae los miembros que la pasada incremental no
+    alcanzó y devuelve [(nombre, ruta)] en el orden del directorio central.
+    """
+    extraidos = {}
+    for m in estado["miembros"]:
+        extraidos.setdefault(m["nombre"], []).append(m["ruta"])
+
+    archivos = []
+    with zipfile.ZipFile(part) as archive:
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+
+            rutas = extraidos.get(info.filename)
+            if rutas:
+                archivos.append((info.filename, rutas.pop(0)))
+                continue
+
+            ruta = _ruta_miembro(carpeta, estado, info.filename)
+            with archive.open(info) as origen:
+                bloques = iter(functools.partial(origen.read, BLOQUE_EXTRACCION), b"")
+                _, n = _volcar(bloques, ruta, estado)
+            estado["descomprimido"] = estado.get("descomprimido", 0) + n
+            estado["miembros"].append({"nombre": info.filename, "ruta": str(ruta)})
+            archivos.append((info.filename, str(ruta)))
+
+    return archivos
+
+
+def _ruta_miembro(carpeta: Path, estado: dict, nombre: str) -> Path:
+    # Prefijo por orden: evita choques entre miembros con el mismo basename
+    # y cualquier ruta del ZIP fuera de la carpeta (../)
+    base = os.path.basename(nombre) or "miembro"
+    return carpeta / "miembros" / f"{len(estado['miembros']):06d}_{base}"
+
+
+# ==============================================================
+# Estado en disco
+# ==============================================================
+
+def _carpeta(upload_id: str) -> Path:
+    try:
+        upload_id = uuid.UUID(upload_id).hex
+    except ValueError:
+        raise FileNotFoundError("Subida no encontrada")
+    return UPLOADS_DIR / upload_id
+
+
+def _lock_de(upload_id: str) -> threading.Lock:
+    with _locks_lock:
+        return _locks.setdefault(uuid.UUID(upload_id).hex, threading.Lock())
+
+
+def _leer_estado(carpeta: Path) -> Optional[dict]:
+    try:
+        with open(carpeta / "estado.json", "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _guardar_estado(carpeta: Path, estado: dict) -> None:
+    tmp = carpeta / "estado.json.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(estado, f, ensure_ascii=False)
+    os.replace(tmp, carpeta / "estado.json")
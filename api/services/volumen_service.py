@@ -0,0 +1,539 @@
+# api/services/volumen_service.py
+import io
+import json
+import os
+import threading
+from typing import Optional, Tuple
+
+import numpy as np
+import scipy.ndimage as ndi
+from PIL import Image
+from skimage.filters import threshold_otsu
+
+from api.services.cas_service import rehidratar_serie
+from api.services.segmentation3d_service import _load_stack
+from api.utils.lru_cache import LRUCache
+
+# Importar rutas persistentes desde config.paths
+from config.paths import SERIES_DIR
+
+# ==============================================================
+# Volumen HU persistido y mapeado en memoria por sesión
+# ==============================================================
+# _load_stack decodifica y ordena todos los slices; su resultado se guarda
+# una vez en SERIES_DIR/<session_id>/volumen.npy (+ volumen.json con el
+# spacing) y después se abre con mmap: cada petición solo lee las páginas
+# del slice o plano que necesita. Si mapping.json cambia (p. ej. la ingesta
+# sigue añadiendo slices) el volumen se reconstruye.
+
+VOLUMEN_NPY = "volumen.npy"
+VOLUMEN_JSON = "volumen.json"
+ESTADISTICAS_JSON = "estadisticas.json"
+
+VOLUMEN_CACHE_MAX = int(os.getenv("VOLUMEN_CACHE_MAX", 32))
+
+_volumenes = LRUCache(max_items=VOLUMEN_CACHE_MAX)
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def cargar_volumen(session_id: str) -> Tuple[np.ndarray, dict]:
+    """
+    Devuelve (volumen de solo lectura z,y,x en HU, meta). El volumen es un
+    np.memmap compartido; meta incluye shape, spacing (z,y,x), modality y dtype.
+    """
+    firma = _firma_mapping(session_id)
+
+    entrada = _volumenes.get(session_id, valido=lambda e: e[0] == firma)
+    if entrada is not None:
+        return entrada[1], entrada[2]
+
+    with _lock_de(session_id):
+        entrada = _volumenes.get(session_id, valido=lambda e: e[0] == firma)
+        if entrada is not None:
+            return entrada[1], entrada[2]
+
+        base = SERIES_DIR / session_id
+        meta = _leer_meta(base)
+        if meta is None or meta.get("firma_mapping") != list(firma):
+            meta = _construir_volumen(session_id, firma)
+
+        vol = np.load(base / VOLUMEN_NPY, mmap_mode="r")
+        _volumenes.put(session_id, (firma, vol, meta))
+        return vol, meta
+
+
+def datos_volumen_en_disco(session_id: str) -> dict:
+    """
+    Ubicación de los bytes crudos del volumen dentro de volumen.npy (C-order,
+    z,y,x), para servirlos sin cargarlos en memoria.
+    """
+    vol, meta = cargar_volumen(session_id)
+    dtype = np.dtype(meta["dtype"])
+    return {
+        "ruta": vol.filename,
+        "offset": int(vol.offset),
+        "nbytes": int(vol.nbytes),
+        "etag": "{:x}-{:x}".format(*meta["firma_mapping"]),
+        "cabecera": {
+            "shape": meta["shape"],
+            "spacing": meta["spacing"],
+            "dtype": dtype.name,
+            "byte_order": "little" if dtype.byteorder in ("<", "=", "|") else "big",
+            "orden": "zyx",
+            "modality": meta["modality"],
+            # El volumen ya está en HU: valor_hu = valor * slope + intercept
+            "rescale": {"slope": 1.0, "intercept": 0.0},
+            "min": meta["min"],
+            "max": meta["max"],
+            "nbytes": int(vol.nbytes),
+        },
+    }
+
+
+def invalidar_volumen(session_id: str) -> None:
+    _volumenes.pop(session_id)
+    _tiles.pop_where(lambda k: k[0] == session_id)
+    _proyecciones.pop_where(lambda k: k[0] == session_id)
+    _estadisticas.pop(session_id)
+
+
+def estadisticas_volumen() -> dict:
+    return {
+        "volumenes": _volumenes.stats(),
+        "tiles": _tiles.stats(),
+        "proyecciones": _proyecciones.stats(),
+    }
+
+
+def _construir_volumen(session_id: str, firma: tuple) -> dict:
+    vol, spacing, modality = _load_stack(session_id)
+
+    # En CT los HU son enteros: int16 ocupa la mitad que float32
+    if (
+        np.all(np.isfinite(vol))
+        and vol.min() >= np.iinfo(np.int16).min
+        and vol.max() <= np.iinfo(np.int16).max
+        and np.array_equal(vol, np.round(vol))
+    ):
+        vol = vol.astype(np.int16)
+    else:
+        vol = vol.astype(np.float32)
+
+    base = SERIES_DIR / session_id
+    tmp = base / (VOLUMEN_NPY + ".tmp")
+    with open(tmp, "wb") as f:
+        np.save(f, np.ascontiguousarray(vol))
+    os.replace(tmp, base / VOLUMEN_NPY)
+
+    meta = {
+        "shape": list(vol.shape),
+        "spacing": [float(s) for s in spacing],
+        "modality": modality,
+        "dtype": str(vol.dtype),
+        "min": float(vol.min()),
+        "max": float(vol.max()),
+        "firma_mapping": list(firma),
+    }
+    tmp = base / (VOLUMEN_JSON + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(tmp, base / VOLUMEN_JSON)
+
+    return meta
+
+
+def _leer_meta(base) -> Optional[dict]:
+    if not (base / VOLUMEN_NPY).is_file():
+        return None
+    try:
+        with open(base / VOLUMEN_JSON, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _firma_mapping(session_id: str) -> tuple:
+    try:
+        st = os.stat(SERIES_DIR / session_id / "mapping.json")
+    except FileNotFoundError:
+        if not rehidratar_serie(session_id):
+            raise FileNotFoundError("mapping.json no encontrado para la serie")
+        st = os.stat(SERIES_DIR / session_id / "mapping.json")
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _lock_de(session_id: str) -> threading.RLock:
+    with _locks_lock:
+        return _locks.setdefault(session_id, threading.RLock())
+
+
+# ==============================================================
+# Render de slices con ventana (window/level) y caché de tiles
+# ==============================================================
+
+# (centro, ancho) en HU
+PRESETS_VENTANA = {
+    "hueso": (400, 1800),
+    "cerebro": (40, 80),
+    "tejido_blando": (40, 400),
+    "pulmon": (-600, 1500),
+}
+
+TILE_CACHE_MAX_BYTES = int(os.getenv("TILE_CACHE_MAX_BYTES", 128 * 1024 * 1024))
+TAMANO_MAX = 2048
+
+_tiles = LRUCache(max_bytes=TILE_CACHE_MAX_BYTES)
+_luts = LRUCache(max_items=64)
+
+# Valor int16 de cada posible patrón de 16 bits: un slice int16 visto como
+# uint16 indexa la LUT directamente, sin convertir ni restar offsets
+_VALORES_INT16 = np.arange(65536, dtype=np.uint16).view(np.int16).astype(np.float32)
+
+
+EJES = ("axial", "coronal", "sagital")
+
+
+def renderizar_slice_ventana(
+    session_id: str,
+    indice: int,
+    centro: float,
+    ancho: float,
+    tamano: Optional[int] = None,
+) -> bytes:
+    """PNG (escala de grises) del slice axial `indice` con la ventana dada."""
+    return renderizar_plano(session_id, "axial", indice, centro, ancho, tamano)
+
+
+def renderizar_plano(
+    session_id: str,
+    eje: str,
+    indice: int,
+    centro: float,
+    ancho: float,
+    tamano: Optional[int] = None,
+) -> bytes:
+    """
+    PNG del plano `indice` a lo largo de `eje` (axial, coronal o sagital),
+    remuestreado a píxel isotrópico y con la ventana dada.
+    """
+    if ancho <= 0:
+        raise ValueError("El ancho de ventana debe ser positivo")
+    if tamano is not None and not (16 <= tamano <= TAMANO_MAX):
+        raise ValueError(f"tamano debe estar entre 16 y {TAMANO_MAX}")
+
+    firma = _firma_mapping(session_id)
+    clave = (session_id, firma, eje, int(indice), float(centro), float(ancho), tamano)
+    png = _tiles.get(clave)
+    if png is not None:
+        return png
+
+    plano = extraer_plano(session_id, eje, indice)
+    png = codificar_png(aplicar_ventana(plano, centro, ancho), tamano)
+    _tiles.put(clave, png, size=len(png))
+    return png
+
+
+def extraer_plano(session_id: str, eje: str, indice: int) -> np.ndarray:
+    """
+    Plano 2D del volumen (HU) con píxeles cuadrados. Con el volumen mapeado
+    en memoria solo se leen las páginas que cruza el plano.
+
+    Orientación: axial (filas=y, columnas=x); coronal (filas=z, columnas=x) y
+    sagital (filas=z, columnas=y), con z creciente hacia arriba.
+    """
+    if eje not in EJES:
+        raise ValueError(f"Eje inválido, use uno de {', '.join(EJES)}")
+
+    vol, meta = cargar_volumen(session_id)
+    n = vol.shape[EJES.index(eje)]
+    if not (0 <= indice < n):
+        raise IndexError(f"Índice fuera de rango (0..{n - 1})")
+
+    eje_np = EJES.index(eje)
+    plano = np.take(vol, indice, axis=eje_np) if eje_np else vol[indice]
+    return _orientar(np.asarray(plano), eje, meta["spacing"])
+
+
+def _orientar(plano: np.ndarray, eje: str, spacing) -> np.ndarray:
+    """Pone z hacia arriba en coronal/sagital y deja el plano con píxel isotrópico."""
+    dz, dy, dx = spacing
+    if eje == "axial":
+        return _isotropico(plano, dy, dx)
+    if eje == "coronal":
+        return _isotropico(plano[::-1], dz, dx)
+    return _isotropico(plano[::-1], dz, dy)
+
+
+def _isotropico(plano: np.ndarray, sf: float, sc: float) -> np.ndarray:
+    # Se remuestrea al spacing más fino de los dos ejes del plano
+    if sf <= 0 or sc <= 0 or np.isclose(sf, sc):
+        return plano
+    paso = min(sf, sc)
+    zoom = (sf / paso, sc / paso)
+    out = ndi.zoom(plano.astype(np.float32), zoom, order=1)
+    if plano.dtype == np.int16:
+        out = np.round(out).astype(np.int16)
+    return out
+
+
+def aplicar_ventana(plano: np.ndarray, centro: float, ancho: float) -> np.ndarray:
+    """Mapea HU a uint8 con la ventana (centro, ancho)."""
+    if plano.dtype == np.int16:
+        lut = _lut_int16(float(centro), float(ancho))
+        return lut[plano.view(np.uint16)]
+
+    bajo = centro - ancho / 2.0
+    out = (plano.astype(np.float32) - bajo) * (255.0 / ancho)
+    return np.clip(out, 0, 255).astype(np.uint8)
+
+
+def codificar_png(imagen: np.ndarray, tamano: Optional[int] = None) -> bytes:
+    im = Image.fromarray(np.ascontiguousarray(imagen), mode="L")
+    if tamano is not None and max(im.size) != tamano:
+        escala = tamano / max(im.size)
+        im = im.resize(
+            (max(1, round(im.width * escala)), max(1, round(im.height * escala))),
+            Image.BILINEAR,
+        )
+    buffer = io.BytesIO()
+    # Compresión baja: prima la latencia sobre el tamaño
+    im.save(buffer, format="PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+def _lut_int16(centro: float, ancho: float) -> np.ndarray:
+    clave = (centro, ancho)
+    lut = _luts.get(clave)
+    if lut is None:
+        bajo = centro - ancho / 2.0
+        lut = np.clip((_VALORES_INT16 - bajo) * (255.0 / ancho), 0, 255).astype(np.uint8)
+        _luts.put(clave, lut)
+    return lut
+
+
+# ==============================================================
+# Proyecciones (MIP, MinIP, media) con slab opcional
+# ==============================================================
+
+PROYECCIONES = {
+    "mip": np.max,
+    "minip": np.min,
+    "media": np.mean,
+}
+
+PROYECCION_CACHE_MAX_BYTES = int(os.getenv("PROYECCION_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+
+_proyecciones = LRUCache(max_bytes=PROYECCION_CACHE_MAX_BYTES)
+
+
+def calcular_proyeccion(
+    session_id: str,
+    tipo: str,
+    eje: str,
+    desde: Optional[int] = None,
+    hasta: Optional[int] = None,
+) -> np.ndarray:
+    """
+    Proyección `tipo` (mip, minip, media) del volumen a lo largo de `eje`,
+    limitada al slab [desde, hasta) si se indica. Devuelve el plano en HU con
+    la misma orientación que extraer_plano. Se cachea por sesión, tipo, eje y slab.
+    """
+    if tipo not in PROYECCIONES:
+        raise ValueError(f"Proyección inválida, use una de {', '.join(PROYECCIONES)}")
+    if eje not in EJES:
+        raise ValueError(f"Eje inválido, use uno de {', '.join(EJES)}")
+
+    firma = _firma_mapping(session_id)
+    vol, meta = cargar_volumen(session_id)
+
+    eje_np = EJES.index(eje)
+    n = vol.shape[eje_np]
+    desde = 0 if desde is None else desde
+    hasta = n if hasta is None else hasta
+    if not (0 <= desde < hasta <= n):
+        raise IndexError(f"Slab fuera de rango (0 <= desde < hasta <= {n})")
+
+    clave = (session_id, firma, tipo, eje, desde, hasta)
+    plano = _proyecciones.get(clave)
+    if plano is not None:
+        return plano
+
+    slab = vol[(slice(None),) * eje_np + (slice(desde, hasta),)]
+    if tipo == "media":
+        plano = slab.mean(axis=eje_np, dtype=np.float32)
+    else:
+        plano = PROYECCIONES[tipo](slab, axis=eje_np)
+
+    plano = _orientar(np.asarray(plano), eje, meta["spacing"])
+    plano.setflags(write=False)
+    _proyecciones.put(clave, plano, size=plano.nbytes)
+    return plano
+
+
+def renderizar_proyeccion(
+    session_id: str,
+    tipo: str,
+    eje: str,
+    centro: float,
+    ancho: float,
+    desde: Optional[int] = None,
+    hasta: Optional[int] = None,
+    tamano: Optional[int] = None,
+) -> bytes:
+    if ancho <= 0:
+        raise ValueError("El ancho de ventana debe ser positivo")
+    if tamano is not None and not (16 <= tamano <= TAMANO_MAX):
+        raise ValueError(f"tamano debe estar entre 16 y {TAMANO_MAX}")
+
+    firma = _firma_mapping(session_id)
+    clave = (session_id, firma, tipo, eje, desde, hasta, float(centro), float(ancho), tamano)
+    png = _tiles.get(clave)
+    if png is not None:
+        return png
+
+    plano = calcular_proyeccion(session_id, tipo, eje, desde, hasta)
+    png = codificar_png(aplicar_ventana(plano, centro, ancho), tamano)
+    _tiles.put(clave, png, size=len(png))
+    return png
+
+
+# ==============================================================
+# Histograma y estadísticas de intensidad por serie
+# ==============================================================
+# Se calculan una vez sobre el volumen persistido y se guardan en
+# SERIES_DIR/<session_id>/estadisticas.json. La segmentación 3D toma de aquí
+# sus umbrales (percentiles y Otsu) en lugar de recorrer el volumen otra vez.
+
+PERCENTILES = (0.5, 1, 2, 5, 10, 25, 40, 50, 60, 75, 90, 95, 98, 99, 99.5)
+HISTOGRAMA_BINS_MAX = 512
+
+# Vóxeles por bloque al construir el histograma de un volumen int16
+HISTOGRAMA_BLOQUE_ELEMENTOS = 4 * 1024 * 1024
+
+_estadisticas = LRUCache(max_items=VOLUMEN_CACHE_MAX)
+
+
+def estadisticas_serie(session_id: str) -> dict:
+    """
+    Devuelve n, min, max, media, std, percentiles (claves "40", "99", ...),
+    histograma (inicio, ancho_bin, conteos) y umbrales Otsu de la serie.
+    """
+    firma = _firma_mapping(session_id)
+
+    stats = _estadisticas.get(session_id, valido=lambda e: e["firma_mapping"] == list(firma))
+    if stats is not None:
+        return stats
+
+    ruta = SERIES_DIR / session_id / ESTADISTICAS_JSON
+    try:
+        with open(ruta, "r", encoding="utf-8") as f:
+            stats = json.load(f)
+    except (FileNotFoundError, ValueError):
+        stats = None
+
+    if stats is None or stats.get("firma_mapping") != list(firma):
+        with _lock_de(session_id):
+            vol, meta = cargar_volumen(session_id)
+            stats = calcular_estadisticas(vol)
+            stats["firma_mapping"] = meta["firma_mapping"]
+
+            tmp = ruta.with_suffix(".tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(stats, f)
+            os.replace(tmp, ruta)
+
+    _estadisticas.put(session_id, stats)
+    return stats
+
+
+def calcular_estadisticas(vol: np.ndarray) -> dict:
+    """
+    Estadísticas de intensidad de un volumen. Con int16 todo sale de un
+    histograma de 1 HU por bin (una pasada con bincount); los percentiles son
+    exactos y coinciden con np.percentile (interpolación lineal).
+    """
+    if vol.dtype == np.int16:
+        valores, conteos = _histograma_int16(vol)
+    else:
+        finitos = np.asarray(vol)[np.isfinite(vol)]
+        valores, conteos = np.unique(finitos, return_counts=True)
+
+    n = int(conteos.sum())
+    if n == 0:
+        return {"n": 0, "min": None, "max": None, "media": None, "std": None,
+                "percentiles": {}, "histograma": None, "otsu": {}}
+
+    valores64 = valores.astype(np.float64)
+    media = float(np.dot(valores64, conteos) / n)
+    std = float(np.sqrt(max(np.dot((valores64 - media) ** 2, conteos) / n, 0.0)))
+    acumulado = np.cumsum(conteos)
+
+    percentiles = {
+        f"{p:g}": _percentil(valores64, acumulado, n, p) for p in PERCENTILES
+    }
+
+    return {
+        "n": n,
+        "min": float(valores64[0]),
+        "max": float(valores64[-1]),
+        "media": media,
+        "std": std,
+        "percentiles": percentiles,
+        "histograma": _histograma_compacto(valores64, conteos),
+        "otsu": {
+            # Igual que la ruta MR de segmentar_serie_3d: Otsu (256 bins)
+            # sobre el volumen recortado a [p2, p98], expresado en HU
+            "p2_p98": _otsu_recortado(valores64, conteos, percentiles["2"], percentiles["98"]),
+        },
+    }
+
+
+def _histograma_int16(vol: np.ndarray):
+    # Por bloques de slices y reinterpretando los bits como uint16 (sin copia):
+    # bincount solo convierte un bloque a intp, no el volumen entero, que
+    # puede ser el volumen.npy mapeado en memoria
+    vol = np.asarray(vol)
+    planos = vol.reshape(vol.shape[0], -1) if vol.ndim > 1 else vol.reshape(1, -1)
+    por_bloque = max(1, HISTOGRAMA_BLOQUE_ELEMENTOS // max(1, planos.shape[1]))
+
+    conteos = np.zeros(65536, dtype=np.int64)
+    for z0 in range(0, planos.shape[0], por_bloque):
+        bloque = np.ascontiguousarray(planos[z0:z0 + por_bloque])
+        conteos += np.bincount(bloque.view(np.uint16).ravel(), minlength=65536)
+
+    # Los bins 32768..65535 son los negativos: orden con signo = -32768..32767
+    conteos = np.concatenate([conteos[32768:], conteos[:32768]])
+    valores = np.nonzero(conteos)[0]
+    return valores - 32768, conteos[valores]
+
+
+def _percentil(valores: np.ndarray, acumulado: np.ndarray, n: int, p: float) -> float:
+    # Rango (0-based) interpolado como np.percentile(method="linear")
+    rango = (n - 1) * p / 100.0
+    bajo = int(np.floor(rango))
+    alto = min(bajo + 1, n - 1)
+    v_bajo = valores[np.searchsorted(acumulado, bajo, side="right")]
+    v_alto = valores[np.searchsorted(acumulado, alto, side="right")]
+    return float(v_bajo + (v_alto - v_bajo) * (rango - bajo))
+
+
+def _histograma_compacto(valores: np.ndarray, conteos: np.ndarray) -> dict:
+    minimo, maximo = valores[0], valores[-1]
+    ancho = max(1.0, float(np.ceil((maximo - minimo + 1) / HISTOGRAMA_BINS_MAX)))
+    n_bins = int((maximo - minimo) // ancho) + 1
+    idx = ((valores - minimo) // ancho).astype(np.int64)
+    compacto = np.bincount(idx, weights=conteos, minlength=n_bins).astype(np.int64)
+    return {"inicio": float(minimo), "ancho_bin": ancho, "conteos": compacto.tolist()}
+
+
+def _otsu_recortado(valores: np.ndarray, conteos: np.ndarray, lo: float, hi: float) -> Optional[float]:
+    if hi <= lo:
+        return None
+    recortados = np.clip(valores, lo, hi)
+    hist, bordes = np.histogram(recortados, bins=256, range=(lo, hi), weights=conteos)
+    centros = (bordes[:-1] + bordes[1:]) / 2.0
+    try:
+        return float(threshold_otsu(hist=(hist, centros)))
+    except Exception:
+        return None
@@ -0,0 +1,116 @@
+# api/utils/executors.py
+import asyncio
+import functools
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# ============================================================
+#      POOLS DEDICADOS (CPU e I/O) FUERA DEL EVENT LOOP
+# ============================================================
+# CPU: CLAHE, decodificación, segmentación, PNG (numpy/skimage liberan el GIL).
+# I/O: psycopg2, lectura/escritura de archivos, cabeceras DICOM.
+
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", os.cpu_count() or 1))
+IO_WORKERS = int(os.getenv("IO_WORKERS", 16))
+
+# Trabajos admitidos a la vez por pool (en ejecución + en cola); el resto espera
+# en el event loop sin bloquearlo, en lugar de crecer la cola sin límite.
+CPU_MAX_PENDIENTES = int(os.getenv("CPU_MAX_PENDIENTES", CPU_WORKERS * 4))
+IO_MAX_PENDIENTES = int(os.getenv("IO_MAX_PENDIENTES", IO_WORKERS * 4))
+
+cpu_pool = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix="cpu")
+io_pool = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+
+_semaforos = {}
+_admitidos = {"cpu": 0, "io": 0}
+
+
+def _semaforo(nombre: str, limite: int) -> asyncio.Semaphore:
+    # Los semáforos de asyncio pertenecen al loop en que se crean
+    loop = asyncio.get_running_loop()
+    clave = (nombre, id(loop))
+    if clave not in _semaforos:
+        _semaforos[clave] = asyncio.Semaphore(limite)
+    return _semaforos[clave]
+
+
+async def _ejecutar(nombre: str, pool: ThreadPoolExecutor, limite: int, func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    async with _semaforo(nombre, limite):
+        _admitidos[nombre] += 1
+        try:
+            return await loop.run_in_executor(pool, functools.partial(func, *args, **kwargs))
+        finally:
+            _admitidos[nombre] -= 1
+
+
+async def ejecutar_cpu(func, *args, **kwargs):
+    """Ejecuta trabajo CPU-bound en el pool de CPU y espera el resultado."""
+    return await _ejecutar("cpu", cpu_pool, CPU_MAX_PENDIENTES, func, *args, **kwargs)
+
+
+async def ejecutar_io(func, *args, **kwargs):
+    """Ejecuta trabajo bloqueante de I/O (BD, disco) en el pool de I/O."""
+    return await _ejecutar("io", io_pool, IO_MAX_PENDIENTES, func, *args, **kwargs)
+
+
+# ============================================================
+#      MEDICIÓN DEL RETRASO (LAG) DEL EVENT LOOP
+# ============================================================
+
+LAG_INTERVALO_S = float(os.getenv("EVENT_LOOP_LAG_INTERVALO", 0.5))
+LAG_ALERTA_MS = float(os.getenv("EVENT_LOOP_LAG_ALERTA_MS", 250))
+
+_lag = {"ultimo_ms": 0.0, "max_ms": 0.0, "promedio_ms": 0.0, "muestras": 0}
+_monitor_task = None
+
+
+async def _monitorear_event_loop():
+    loop = asyncio.get_running_loop()
+    while True:
+        inicio = loop.time()
+        await asyncio.sleep(LAG_INTERVALO_S)
+        lag_ms = max(0.0, (loop.time() - inicio - LAG_INTERVALO_S) * 1000)
+
+        _lag["ultimo_ms"] = round(lag_ms, 2)
+        _lag["max_ms"] = round(max(_lag["max_ms"], lag_ms), 2)
+        # Media móvil exponencial
+        _lag["promedio_ms"] = round(0.9 * _lag["promedio_ms"] + 0.1 * lag_ms, 2)
+        _lag["muestras"] += 1
+
+        if lag_ms > LAG_ALERTA_MS:
+            logger.warning(f"Event loop bloqueado {lag_ms:.0f} ms")
+
+
+def iniciar_monitor_event_loop() -> None:
+    global _monitor_task
+    if _monitor_task is None or _monitor_task.done():
+        _monitor_task = asyncio.get_running_loop().create_task(_monitorear_event_loop())
+
+
+def detener_monitor_event_loop() -> None:
+    global _monitor_task
+    if _monitor_task is not None:
+        _monitor_task.cancel()
+        _monitor_task = None
+
+
+def estadisticas_executors() -> dict:
+    return {
+        "event_loop_lag": dict(_lag),
+        "cpu": {
+            "workers": CPU_WORKERS,
+            "max_pendientes": CPU_MAX_PENDIENTES,
+            "admitidos": _admitidos["cpu"],
+            "en_cola": cpu_pool._work_queue.qsize(),
+        },
+        "io": {
+            "workers": IO_WORKERS,
+            "max_pendientes": IO_MAX_PENDIENTES,
+            "admitidos": _admitidos["io"],
+            "en_cola": io_pool._work_queue.qsize(),
+        },
+    }
@@ -0,0 +1,95 @@
+# api/utils/lru_cache.py
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+class LRUCache:
+    """
+    Caché LRU en memoria, segura entre hilos.
+    Se acota por número de entradas (max_items), por bytes (max_bytes) o ambos.
+    Lleva contadores de aciertos/fallos para exponerlos como métricas.
+    """
+
+    def __init__(self, max_items: Optional[int] = None, max_bytes: Optional[int] = None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._datos: "OrderedDict[Hashable, tuple[Any, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, valido: Optional[Callable[[Any], bool]] = None) -> Any:
+        """
+        Devuelve el valor o None. Si se pasa `valido` y el valor guardado ya no
+        es válido (p. ej. cambió el mtime del archivo), se descarta y cuenta como fallo.
+        """
+        with self._lock:
+            entrada = self._datos.get(key)
+            if entrada is not None and (valido is None or valido(entrada[0])):
+                self._datos.move_to_end(key)
+                self.hits += 1
+                return entrada[0]
+
+            if entrada is not None:
+                self._quitar(key)
+            self.misses += 1
+            return None
+
+    def put(self, key: Hashable, value: Any, size: int = 0) -> None:
+        with self._lock:
+            if key in self._datos:
+                self._quitar(key)
+
+            # Un valor más grande que todo el presupuesto no se guarda
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+
+            self._datos[key] = (value, size)
+            self.bytes += size
+
+            while self._datos and (
+                (self.max_items is not None and len(self._datos) > self.max_items)
+                or (self.max_bytes is not None and self.bytes > self.max_bytes)
+            ):
+                viejo, _ = next(iter(self._datos.items()))
+                self._quitar(viejo)
+                self.evictions += 1
+
+    def pop(self, key: Hashable) -> None:
+        with self._lock:
+            if key in self._datos:
+                self._quitar(key)
+
+    def pop_where(self, condicion: Callable[[Hashable], bool]) -> int:
+        """Elimina todas las entradas cuya clave cumpla la condición."""
+        with self._lock:
+            claves = [k for k in self._datos if condicion(k)]
+            for k in claves:
+                self._quitar(k)
+            return len(claves)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._datos.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._datos),
+                "bytes": self.bytes,
+                "max_items": self.max_items,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / total, 4) if total else None,
+            }
+
+    def _quitar(self, key: Hashable) -> None:
+        _, size = self._datos.pop(key)
+        self.bytes -= size
@@ -0,0 +1,195 @@
+# config/db_schema.py
+import logging
+
+from config.db_config import get_connection
+
+logger = logging.getLogger(__name__)
+
+# ============================================================
+#      MIGRACIONES (se aplican una sola vez, en orden)
+# ============================================================
+# Cada entrada: (nombre, [sentencias SQL]). Para cambiar el esquema se
+# añade una migración nueva al final; nunca se edita una ya aplicada.
+
+_MIGRACIONES = [
+    (
+        "001_protesisdimension_unica_por_slice",
+        [
+            # Quitar duplicados (mismo slice y usuario) dejando una fila por
+            # par. La tabla no tiene clave propia ni fecha, así que se conserva
+            # la última en orden físico (ctid): no indica cuál es la más
+            # reciente, pero es estable dentro de la sentencia y siempre existe.
+            """
+            DELETE FROM protesisdimension a
+            USING protesisdimension b
+            WHERE a.archivodicomid = b.archivodicomid
+              AND a.user_id = b.user_id
+              AND a.ctid < b.ctid
+            """,
+            """
+            CREATE UNIQUE INDEX IF NOT EXISTS ux_protesisdimension_archivo_user
+            ON protesisdimension (archivodicomid, user_id)
+            """,
+        ],
+    ),
+    (
+        "002_indice_metadatos_dicom",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS serie_dicom (
+                session_id VARCHAR(64) PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                series_instance_uid VARCHAR(128),
+                study_instance_uid VARCHAR(128),
+                patient_id VARCHAR(128),
+                study_date DATE,
+                modality VARCHAR(16),
+                series_description TEXT,
+                filas INTEGER,
+                columnas INTEGER,
+                pixel_spacing_y DOUBLE PRECISION,
+                pixel_spacing_x DOUBLE PRECISION,
+                slice_thickness DOUBLE PRECISION,
+                n_instancias INTEGER NOT NULL DEFAULT 0,
+                creado_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS ix_serie_dicom_user_modality ON serie_dicom (user_id, modality)",
+            "CREATE INDEX IF NOT EXISTS ix_serie_dicom_user_fecha ON serie_dicom (user_id, study_date)",
+            "CREATE INDEX IF NOT EXISTS ix_serie_dicom_patient ON serie_dicom (patient_id)",
+            "CREATE INDEX IF NOT EXISTS ix_serie_dicom_study ON serie_dicom (study_instance_uid)",
+            """
+            CREATE TABLE IF NOT EXISTS instancia_dicom (
+                archivodicomid INTEGER PRIMARY KEY
+                    REFERENCES archivodicom (archivodicomid) ON DELETE CASCADE,
+                session_id VARCHAR(64) NOT NULL
+                    REFERENCES serie_dicom (session_id) ON DELETE CASCADE,
+                image_name VARCHAR(64) NOT NULL,
+                sop_instance_uid VARCHAR(128),
+                instance_number INTEGER,
+                posicion_z DOUBLE PRECISION,
+                filas INTEGER,
+                columnas INTEGER
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS ix_instancia_dicom_session ON instancia_dicom (session_id, posicion_z)",
+            "CREATE INDEX IF NOT EXISTS ix_instancia_dicom_sop ON instancia_dicom (sop_instance_uid)",
+        ],
+    ),
+    (
+        "003_almacen_artefactos",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS artefacto (
+                hash CHAR(64) PRIMARY KEY,
+                extension VARCHAR(16) NOT NULL,
+                tamano BIGINT NOT NULL,
+                refcount INTEGER NOT NULL DEFAULT 0,
+                sin_refs_at TIMESTAMP,
+                creado_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS ix_artefacto_sin_refs
+            ON artefacto (sin_refs_at) WHERE refcount <= 0
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS artefacto_ref (
+                propietario VARCHAR(64) NOT NULL,
+                rol VARCHAR(32) NOT NULL,
+                hash CHAR(64) NOT NULL REFERENCES artefacto (hash),
+                creado_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (propietario, rol)
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS ix_artefacto_ref_hash ON artefacto_ref (hash)",
+        ],
+    ),
+    (
+        "004_borrado_sesion",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS borrado_sesion (
+                session_id VARCHAR(64) PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                estado VARCHAR(16) NOT NULL DEFAULT 'pendiente',
+                total INTEGER,
+                borrados INTEGER NOT NULL DEFAULT 0,
+                fallos INTEGER NOT NULL DEFAULT 0,
+                intentos INTEGER NOT NULL DEFAULT 0,
+                ultimo_error TEXT,
+                proximo_intento TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                reservado_hasta TIMESTAMP,
+                creado_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                actualizado_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                completado_at TIMESTAMP
+            )
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS ix_borrado_sesion_pendientes
+            ON borrado_sesion (proximo_intento) WHERE estado <> 'completado'
+            """,
+            "CREATE INDEX IF NOT EXISTS ix_borrado_sesion_user ON borrado_sesion (user_id, creado_at)",
+        ],
+    ),
+    (
+        # Spacing con el que se generó cada malla: al regenerar un STL
+        # desalojado hay que usar el mismo para que coincida con su hash.
+        # Las filas anteriores quedan en NULL (se usa el de la serie).
+        "005_spacing_mallas",
+        [
+            """
+            ALTER TABLE segmentacion3d
+                ADD COLUMN IF NOT EXISTS spacing_z_mm DOUBLE PRECISION,
+                ADD COLUMN IF NOT EXISTS spacing_y_mm DOUBLE PRECISION,
+                ADD COLUMN IF NOT EXISTS spacing_x_mm DOUBLE PRECISION
+            """,
+            """
+            ALTER TABLE modelo3d
+                ADD COLUMN IF NOT EXISTS spacing_z_mm DOUBLE PRECISION,
+                ADD COLUMN IF NOT EXISTS spacing_y_mm DOUBLE PRECISION,
+                ADD COLUMN IF NOT EXISTS spacing_x_mm DOUBLE PRECISION
+            """,
+        ],
+    ),
+]
+
+
+def asegurar_esquema() -> list:
+    """Aplica las migraciones pendientes. Devuelve los nombres aplicados."""
+    conn = get_connection()
+    cur = conn.cursor()
+    aplicadas = []
+
+    try:
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS schema_migraciones (
+                nombre VARCHAR(128) PRIMARY KEY,
+                aplicada_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+        conn.commit()
+
+        cur.execute("SELECT nombre FROM schema_migraciones")
+        hechas = {r[0] for r in cur.fetchall()}
+
+        for nombre, sentencias in _MIGRACIONES:
+            if nombre in hechas:
+                continue
+            for sql in sentencias:
+                cur.execute(sql)
+            cur.execute("INSERT INTO schema_migraciones (nombre) VALUES (%s)", (nombre,))
+            conn.commit()
+            aplicadas.append(nombre)
+            logger.info(f"Migración aplicada: {nombre}")
+
+        return aplicadas
+
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
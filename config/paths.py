@@ -34,3 +34,25 @@ MODELOS3D_DIR.mkdir(parents=True, exist_ok=True)
 # /data/static/reportes
 REPORTES_DIR = BASE_STATIC_DIR / "reportes"
 REPORTES_DIR.mkdir(parents=True, exist_ok=True)
+
+# /data/uploads  (staging de subidas por chunks reanudables). Va FUERA de
+# /data/static: ZIPs a medio subir y miembros extraídos no deben poder
+# descargarse por /static.
+UPLOADS_DIR = BASE_STATIC_DIR.parent / "uploads"
+UPLOADS_DIR.mkdir(parents=True, exist_ok=True)
+
+# /data/static/render_cache  (PNGs de slices renderizados bajo demanda)
+RENDER_CACHE_DIR = BASE_STATIC_DIR / "render_cache"
+RENDER_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+# /data/static/cas/instancias  (DICOM deduplicados por contenido; las series los enlazan)
+INSTANCIAS_CAS_DIR = BASE_STATIC_DIR / "cas" / "instancias"
+INSTANCIAS_CAS_DIR.mkdir(parents=True, exist_ok=True)
+
+# /data/static/cas/artefactos  (máscaras 3D, miniaturas y STL por contenido, con refcount en BD)
+ARTEFACTOS_DIR = BASE_STATIC_DIR / "cas" / "artefactos"
+ARTEFACTOS_DIR.mkdir(parents=True, exist_ok=True)
+
+# /data/static/manifiestos  (un <session_id>.json por sesión: archivos con tamaño, hash y fecha)
+MANIFIESTOS_DIR = BASE_STATIC_DIR / "manifiestos"
+MANIFIESTOS_DIR.mkdir(parents=True, exist_ok=True)
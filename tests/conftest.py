@@ -1,6 +1,5 @@
 import pytest
 from unittest import mock  # Agrega esta línea para importar mock
-from modules.processing.segmentacion import segmentar_craneo_desde_gui
 
 @pytest.fixture
 def dicom_path():
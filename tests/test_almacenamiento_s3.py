@@ -0,0 +1,145 @@
+import json
+import os
+
+import pytest
+
+pytest.importorskip("boto3")
+moto = pytest.importorskip("moto", reason="las pruebas del backend S3 usan moto")
+
+from api.services import almacenamiento_service, cas_service
+from api.services.almacenamiento_service import S3_PARTE_MIN, BackendS3
+
+BUCKET = "dicom-pruebas"
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    for var, valor in (
+        ("AWS_ACCESS_KEY_ID", "x"),
+        ("AWS_SECRET_ACCESS_KEY", "x"),
+        ("AWS_DEFAULT_REGION", "us-east-1"),
+    ):
+        monkeypatch.setenv(var, valor)
+
+    with moto.mock_aws():
+        backend = BackendS3(BUCKET, prefijo="nodo", region="us-east-1", parte_bytes=S3_PARTE_MIN)
+        backend.cliente.create_bucket(Bucket=BUCKET)
+        yield backend
+
+
+@pytest.fixture
+def volumen(backend, tmp_path, monkeypatch):
+    # El volumen de este nodo en tmp_path, publicando en el bucket de moto
+    base = tmp_path / "static"
+    monkeypatch.setattr(almacenamiento_service, "BASE_STATIC_DIR", base)
+    monkeypatch.setattr(almacenamiento_service, "_backend", backend)
+    monkeypatch.setattr(cas_service, "SERIES_DIR", base / "series")
+    monkeypatch.setattr(cas_service, "INSTANCIAS_CAS_DIR", base / "cas" / "instancias")
+    return base
+
+
+def _escribir(backend, clave, datos, trozo=1024 * 1024):
+    with backend.escribir(clave) as destino:
+        for i in range(0, len(datos), trozo):
+            destino.write(datos[i:i + trozo])
+
+
+def test_escribir_leer_existe_borrar(backend, tmp_path):
+    _escribir(backend, "series/s1/mapping.json", b"{}")
+
+    assert backend.existe("series/s1/mapping.json")
+    assert not backend.existe("series/s1/otro.json")
+    # La clave del bucket lleva el prefijo del backend
+    assert backend.cliente.head_object(Bucket=BUCKET, Key="nodo/series/s1/mapping.json")
+    assert list(backend.listar("series/")) == [("series/s1/mapping.json", 2)]
+
+    destino = tmp_path / "bajado" / "mapping.json"
+    assert backend.descargar("series/s1/mapping.json", destino)
+    assert destino.read_bytes() == b"{}"
+
+    backend.borrar("series/s1/mapping.json")
+    assert not backend.existe("series/s1/mapping.json")
+    assert not backend.descargar("series/s1/mapping.json", tmp_path / "no.json")
+    assert not (tmp_path / "no.json").exists()
+
+
+def test_subir_archivo(backend, tmp_path):
+    origen = tmp_path / "a.dcm"
+    origen.write_bytes(b"DICM" * 100)
+
+    backend.subir("series/s1/a.dcm", origen)
+    assert backend.cliente.get_object(Bucket=BUCKET, Key="nodo/series/s1/a.dcm")["Body"].read() == b"DICM" * 100
+
+
+def test_escritura_multiparte(backend, tmp_path):
+    datos = os.urandom(2 * S3_PARTE_MIN + 123)
+    _escribir(backend, "artefactos/grande.npy", datos)
+
+    # ETag de una subida multiparte: "<md5>-<n partes>"
+    cabecera = backend.cliente.head_object(Bucket=BUCKET, Key="nodo/artefactos/grande.npy")
+    assert cabecera["ETag"].strip('"').endswith("-3")
+    assert cabecera["ContentLength"] == len(datos)
+
+    destino = tmp_path / "grande.npy"
+    assert backend.descargar("artefactos/grande.npy", destino)
+    assert destino.read_bytes() == datos
+
+
+def test_escritura_multiparte_abortada(backend):
+    with pytest.raises(RuntimeError):
+        with backend.escribir("artefactos/roto.npy") as destino:
+            destino.write(os.urandom(S3_PARTE_MIN + 1))
+            raise RuntimeError("fallo a mitad")
+
+    assert not backend.existe("artefactos/roto.npy")
+    assert backend.cliente.list_multipart_uploads(Bucket=BUCKET).get("Uploads", []) == []
+
+
+def test_publicar_rehidratar_retirar(volumen):
+    ruta = volumen / "segmentations2d" / "s1" / "image_0_mask.png"
+    ruta.parent.mkdir(parents=True)
+    ruta.write_bytes(b"png")
+
+    assert almacenamiento_service.es_remoto()
+    almacenamiento_service.publicar(ruta)
+    ruta.unlink()
+
+    assert almacenamiento_service.rehidratar(ruta)
+    assert ruta.read_bytes() == b"png"
+    assert not almacenamiento_service.rehidratar(volumen / "segmentations2d" / "s1" / "otra.png")
+
+    almacenamiento_service.retirar(ruta)
+    ruta.unlink()
+    assert not almacenamiento_service.rehidratar(ruta)
+
+
+def test_rehidratar_serie_desde_el_bucket(volumen):
+    # Nodo A: una instancia en el CAS (enlazada desde la serie), una sin clave
+    # CAS y el mapping; todo publicado
+    serie = volumen / "series" / "s1"
+    serie.mkdir(parents=True)
+    clave = "ab" + "1" * 62
+    cas_service.guardar_instancia(clave, b"instancia", serie / "a.dcm")
+
+    sin_cas = serie / "b.dcm"
+    sin_cas.write_bytes(b"sin cas")
+    almacenamiento_service.publicar(sin_cas)
+
+    mapping = {
+        "image_0.png": {"dicom_name": "a.dcm", "archivodicomid": 1, "cas": clave},
+        "image_1.png": {"dicom_name": "b.dcm", "archivodicomid": 2, "cas": None},
+    }
+    (serie / "mapping.json").write_text(json.dumps(mapping))
+    almacenamiento_service.publicar(serie / "mapping.json")
+
+    # Nodo B: sin nada en disco
+    for ruta in (serie / "a.dcm", sin_cas, serie / "mapping.json", cas_service.ruta_cas(clave)):
+        ruta.unlink()
+
+    assert cas_service.rehidratar_serie("s1")
+    assert json.loads((serie / "mapping.json").read_text()) == mapping
+    assert (serie / "a.dcm").read_bytes() == b"instancia"
+    assert sin_cas.read_bytes() == b"sin cas"
+    assert os.stat(serie / "a.dcm").st_ino == os.stat(cas_service.ruta_cas(clave)).st_ino
+
+    assert not cas_service.rehidratar_serie("no-existe")
@@ -0,0 +1,54 @@
+import hashlib
+from unittest import mock
+
+import pytest
+
+from api.services import artefactos_service
+
+
+@pytest.fixture
+def almacen(tmp_path, monkeypatch):
+    monkeypatch.setattr(artefactos_service, "ARTEFACTOS_DIR", tmp_path)
+    monkeypatch.setattr(artefactos_service, "_regeneradores", {})
+
+    # Dos propietarios referencian el blob, en orden de creación
+    conn = mock.MagicMock()
+    conn.cursor.return_value.fetchall.return_value = [("seg3d:1", "stl"), ("modelo3d:2", "stl")]
+    monkeypatch.setattr(artefactos_service, "get_connection", lambda: conn)
+    return tmp_path
+
+
+CONTENIDO = b"solid seg3d\nendsolid seg3d\n"
+CLAVE = hashlib.sha256(CONTENIDO).hexdigest()
+
+
+def _regenerador(contenido):
+    def escribir(ident, rol, destino):
+        destino.write_bytes(contenido)
+    return escribir
+
+
+def test_regenera_con_el_mismo_hash(almacen):
+    artefactos_service.registrar_regenerador("seg3d", _regenerador(CONTENIDO))
+    ruta = artefactos_service.ruta_artefacto(CLAVE, ".stl")
+
+    assert artefactos_service.regenerar_artefacto(ruta) is True
+    assert ruta.read_bytes() == CONTENIDO
+
+
+def test_hash_distinto_prueba_el_siguiente_propietario(almacen):
+    artefactos_service.registrar_regenerador("seg3d", _regenerador(b"otra malla"))
+    artefactos_service.registrar_regenerador("modelo3d", _regenerador(CONTENIDO))
+    ruta = artefactos_service.ruta_artefacto(CLAVE, ".stl")
+
+    assert artefactos_service.regenerar_artefacto(ruta) is True
+    assert ruta.read_bytes() == CONTENIDO
+
+
+def test_hash_distinto_no_se_sirve_bajo_la_clave(almacen):
+    artefactos_service.registrar_regenerador("seg3d", _regenerador(b"otra malla"))
+    ruta = artefactos_service.ruta_artefacto(CLAVE, ".stl")
+
+    assert artefactos_service.regenerar_artefacto(ruta) is False
+    assert not ruta.exists()
+    assert list((almacen / "tmp").iterdir()) == []
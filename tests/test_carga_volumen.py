@@ -0,0 +1,123 @@
+import json
+import types
+
+import numpy as np
+import pydicom
+import pytest
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import CTImageStorage, ExplicitVRLittleEndian, generate_uid
+
+from api.services import cache_service, metadatos_service, segmentation3d_service
+
+
+def _slice_dicom(ruta, i, serie_uid):
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.file_meta.MediaStorageSOPClassUID = CTImageStorage
+    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID = generate_uid()
+    ds.SOPClassUID = CTImageStorage
+    ds.SeriesInstanceUID = serie_uid
+    ds.Modality = "CT"
+    ds.Rows, ds.Columns = 16, 12
+    ds.PixelSpacing = [0.7, 0.5]
+    ds.SliceThickness = 2.5
+    ds.ImagePositionPatient = [0, 0, 100.0 - 2.0 * i]
+    ds.InstanceNumber = i + 1
+    ds.RescaleSlope, ds.RescaleIntercept = 1, -1024
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 16, 15, 1
+    ds.PixelData = np.full((16, 12), 10 * i, dtype=np.int16).tobytes()
+    ds.save_as(ruta, enforce_file_format=True)
+
+
+@pytest.fixture
+def serie(tmp_path, monkeypatch):
+    monkeypatch.setattr(segmentation3d_service, "SERIES_DIR", tmp_path)
+    monkeypatch.setattr(cache_service, "SERIES_DIR", tmp_path)
+    monkeypatch.setattr(metadatos_service, "SERIES_DIR", tmp_path)
+
+    session_id = "s1"
+    base = tmp_path / session_id
+    base.mkdir()
+    serie_uid = generate_uid()
+
+    # Nombres en orden inverso a la posición z
+    mapping = {}
+    for i in range(5):
+        _slice_dicom(base / f"{i}.dcm", i, serie_uid)
+        mapping[f"image_{i}.png"] = {"dicom_name": f"{i}.dcm", "archivodicomid": 100 + i, "cas": None}
+    (base / "mapping.json").write_text(json.dumps(mapping))
+    return session_id
+
+
+def _geometria_desde_cabeceras(session_id, base):
+    instancias = {}
+    for image_name, meta in json.loads((base / "mapping.json").read_text()).items():
+        m = metadatos_service.extraer_metadatos(
+            pydicom.dcmread(str(base / meta["dicom_name"]), stop_before_pixels=True)
+        )
+        instancias[image_name] = (m["posicion_z"], m["instance_number"])
+    return {
+        "modality": m["modality"],
+        "pixel_spacing": (m["pixel_spacing_y"], m["pixel_spacing_x"]),
+        "slice_thickness": m["slice_thickness"],
+        "instancias": instancias,
+    }
+
+
+def test_load_stack_con_indice_no_relee_cabeceras(serie, tmp_path, monkeypatch):
+    # Sin índice (BD no disponible): se leen las cabeceras
+    def sin_bd(session_id):
+        raise RuntimeError("sin BD")
+
+    monkeypatch.setattr(segmentation3d_service, "geometria_serie", sin_bd)
+    vol_ref, spacing_ref, modality_ref = segmentation3d_service._load_stack(serie)
+
+    geometria = _geometria_desde_cabeceras(serie, tmp_path / serie)
+    monkeypatch.setattr(segmentation3d_service, "geometria_serie", lambda s: geometria)
+
+    def no_leer(*args, **kwargs):
+        raise AssertionError("no debería leer cabeceras con la serie indexada")
+
+    monkeypatch.setattr(segmentation3d_service, "pydicom", types.SimpleNamespace(dcmread=no_leer))
+    vol, spacing, modality = segmentation3d_service._load_stack(serie)
+
+    np.testing.assert_array_equal(vol, vol_ref)
+    assert spacing == pytest.approx(spacing_ref)
+    assert modality == modality_ref == "CT"
+    # Ordenado por z ascendente: el último archivo queda primero
+    assert vol[0, 0, 0] == 40 - 1024
+    assert spacing == pytest.approx((2.0, 0.7, 0.5))
+
+
+def test_espaciado_serie_coincide_con_load_stack(serie, tmp_path, monkeypatch):
+    geometria = _geometria_desde_cabeceras(serie, tmp_path / serie)
+    monkeypatch.setattr(metadatos_service, "geometria_serie", lambda s: geometria)
+    monkeypatch.setattr(segmentation3d_service, "geometria_serie", lambda s: None)
+
+    _, spacing_ref, _ = segmentation3d_service._load_stack(serie)
+    assert metadatos_service.espaciado_serie(serie) == pytest.approx(spacing_ref)
+
+    # Sin posiciones z, el grosor de corte
+    geometria["instancias"] = {k: (None, n) for k, (_, n) in geometria["instancias"].items()}
+    assert metadatos_service.espaciado_serie(serie) == pytest.approx((2.5, 0.7, 0.5))
+
+
+def test_indexar_serie_lee_solo_cabeceras(serie, monkeypatch):
+    guardadas = {}
+    monkeypatch.setattr(
+        metadatos_service,
+        "guardar_metadatos_serie",
+        lambda session_id, user_id, instancias: guardadas.update(
+            session_id=session_id, user_id=user_id, instancias=instancias
+        ),
+    )
+
+    assert metadatos_service.indexar_serie(serie, user_id=7) == 5
+    assert guardadas["user_id"] == 7
+    por_nombre = {i["image_name"]: i for i in guardadas["instancias"]}
+    assert por_nombre["image_4.png"]["archivodicomid"] == 104
+    assert por_nombre["image_4.png"]["posicion_z"] == pytest.approx(92.0)
+    assert por_nombre["image_0.png"]["pixel_spacing_y"] == pytest.approx(0.7)
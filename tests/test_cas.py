@@ -0,0 +1,84 @@
+import os
+import threading
+
+import pytest
+
+from api.services import cas_service
+
+
+@pytest.fixture
+def cas(tmp_path, monkeypatch):
+    monkeypatch.setattr(cas_service, "INSTANCIAS_CAS_DIR", tmp_path / "cas")
+    monkeypatch.setattr(cas_service, "publicar", lambda ruta, clave=None: None)
+    monkeypatch.setattr(cas_service, "clave_de", lambda ruta: str(ruta))
+    (tmp_path / "serie").mkdir()
+    return tmp_path
+
+
+CLAVE = "ab" + "0" * 62
+
+
+def test_guardar_y_reutilizar(cas):
+    a, b = cas / "serie" / "a.dcm", cas / "serie" / "b.dcm"
+
+    assert cas_service.guardar_instancia(CLAVE, b"datos", a) is False
+    assert cas_service.guardar_instancia(CLAVE, b"otros", b) is True
+
+    ruta = cas_service.ruta_cas(CLAVE)
+    assert os.stat(a).st_ino == os.stat(b).st_ino == os.stat(ruta).st_ino
+    assert b.read_bytes() == b"datos"
+    assert os.listdir(ruta.parent) == [ruta.name]
+
+
+def test_publicacion_simultanea_conserva_la_primera(cas):
+    # Otra ingesta publica la misma instancia entre la comprobación y el link
+    ruta = cas_service.ruta_cas(CLAVE)
+    primera = cas / "serie" / "primera.dcm"
+
+    def transformar(datos):
+        cas_service.guardar_instancia(CLAVE, b"ganadora", primera)
+        return datos
+
+    destino = cas / "serie" / "b.dcm"
+    assert cas_service.guardar_instancia(CLAVE, b"perdedora", destino, transformar=transformar) is True
+
+    # Nadie sobrescribió el inodo que ya enlazaba la primera sesión
+    assert os.stat(destino).st_ino == os.stat(primera).st_ino == os.stat(ruta).st_ino
+    assert os.stat(ruta).st_nlink == 3
+    assert destino.read_bytes() == b"ganadora"
+    assert os.listdir(ruta.parent) == [ruta.name]
+
+
+def test_liberar_espera_a_la_ingesta_que_esta_enlazando(cas, monkeypatch):
+    ruta = cas_service.ruta_cas(CLAVE)
+    a, b = cas / "serie" / "a.dcm", cas / "serie" / "b.dcm"
+    cas_service.guardar_instancia(CLAVE, b"datos", a)
+    a.unlink()  # sesión borrada: solo queda la copia del CAS (st_nlink == 1)
+
+    enlazando, seguir = threading.Event(), threading.Event()
+    enlazar = cas_service._enlazar
+
+    def enlazar_lento(origen, destino):
+        enlazando.set()
+        seguir.wait(5)
+        return enlazar(origen, destino)
+
+    monkeypatch.setattr(cas_service, "_enlazar", enlazar_lento)
+    ingesta = threading.Thread(target=cas_service.guardar_instancia, args=(CLAVE, b"datos", b))
+    ingesta.start()
+    assert enlazando.wait(5)
+
+    liberadas = []
+    borrado = threading.Thread(target=lambda: liberadas.append(cas_service.liberar_instancias([CLAVE])))
+    borrado.start()
+    borrado.join(0.2)
+    assert borrado.is_alive()
+
+    seguir.set()
+    ingesta.join(5)
+    borrado.join(5)
+
+    # La instancia sigue en el CAS, enlazada por la nueva sesión
+    assert liberadas == [0]
+    assert os.stat(ruta).st_ino == os.stat(b).st_ino
+    assert os.stat(ruta).st_nlink == 2
@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+from api.services.volumen_service import PERCENTILES, _percentil, calcular_estadisticas
+
+
+def _volumen_int16():
+    rng = np.random.default_rng(3)
+    vol = rng.normal(40, 300, size=(12, 48, 40)).astype(np.int16)
+    vol[0, :4, :4] = -1024
+    vol[-1, -3:, -3:] = 3071
+    return vol
+
+
+@pytest.mark.parametrize(
+    "vol",
+    [
+        _volumen_int16(),
+        np.random.default_rng(5).normal(0, 1, size=(4, 30, 30)).astype(np.float32),
+    ],
+    ids=["int16", "float32"],
+)
+def test_estadisticas_coinciden_con_numpy(vol):
+    stats = calcular_estadisticas(vol)
+    plano = vol.astype(np.float64).ravel()
+
+    assert stats["n"] == plano.size
+    assert stats["min"] == plano.min()
+    assert stats["max"] == plano.max()
+    assert stats["media"] == pytest.approx(plano.mean(), rel=1e-9)
+    assert stats["std"] == pytest.approx(plano.std(), rel=1e-9)
+    for p in PERCENTILES:
+        assert stats["percentiles"][f"{p:g}"] == pytest.approx(np.percentile(plano, p), rel=1e-9, abs=1e-9)
+    assert sum(stats["histograma"]["conteos"]) == plano.size
+
+
+def test_float_ignora_no_finitos():
+    vol = np.array([[[1.0, np.nan, 3.0, np.inf, 2.0]]], dtype=np.float32)
+    stats = calcular_estadisticas(vol)
+
+    assert stats["n"] == 3
+    assert stats["percentiles"]["50"] == 2.0
+
+
+def test_volumen_constante_y_vacio():
+    stats = calcular_estadisticas(np.full((2, 3, 3), -7, dtype=np.int16))
+    assert stats["min"] == stats["max"] == -7
+    assert stats["std"] == 0.0
+    assert all(v == -7 for v in stats["percentiles"].values())
+
+    vacio = calcular_estadisticas(np.array([np.nan], dtype=np.float32))
+    assert vacio["n"] == 0 and vacio["percentiles"] == {}
+
+
+@pytest.mark.parametrize("p", [0, 0.5, 33.3, 50, 99.9, 100])
+def test_percentil_desde_histograma(p):
+    datos = np.array([5, 1, 1, 9, 3, 3, 3, 7], dtype=np.float64)
+    valores, conteos = np.unique(datos, return_counts=True)
+
+    obtenido = _percentil(valores, np.cumsum(conteos), datos.size, p)
+    assert obtenido == pytest.approx(np.percentile(datos, p))
+
+
+def test_histograma_int16_por_bloques(monkeypatch):
+    from api.services import volumen_service
+
+    vol = _volumen_int16()
+    vol[1, 0, 0] = -32768
+    vol[2, 0, 0] = 32767
+    esperado_valores, esperado_conteos = np.unique(vol, return_counts=True)
+
+    # Bloques que no dividen el volumen en partes iguales
+    monkeypatch.setattr(volumen_service, "HISTOGRAMA_BLOQUE_ELEMENTOS", 48 * 40 * 5)
+    valores, conteos = volumen_service._histograma_int16(vol)
+
+    np.testing.assert_array_equal(valores, esperado_valores)
+    np.testing.assert_array_equal(conteos, esperado_conteos)
+
+
+def test_histograma_int16_no_copia_el_volumen(monkeypatch):
+    import tracemalloc
+
+    from api.services import volumen_service
+
+    vol = np.random.default_rng(1).integers(-1024, 3000, size=(64, 256, 256), dtype=np.int16)
+    monkeypatch.setattr(volumen_service, "HISTOGRAMA_BLOQUE_ELEMENTOS", 256 * 256)
+
+    tracemalloc.start()
+    try:
+        volumen_service._histograma_int16(vol)
+        _, pico = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    # Antes: dos copias int32 del volumen más la conversión a intp (~8x)
+    assert pico < vol.nbytes / 4
@@ -0,0 +1,47 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from api.routers import dicom_router
+from api.services import ingesta_service
+
+
+@pytest.fixture
+def cliente(monkeypatch):
+    monkeypatch.setattr(ingesta_service, "_trabajos", {})
+    session_id = ingesta_service._registrar_trabajo(7)
+    ingesta_service._trabajos[session_id]["estado"] = "completado"
+
+    app = FastAPI()
+    app.include_router(dicom_router.router)
+    return TestClient(app), session_id
+
+
+def test_estado_del_propietario(cliente):
+    cliente, session_id = cliente
+    r = cliente.get(f"/ingesta/{session_id}", headers={"X-User-Id": "7"})
+
+    assert r.status_code == 200
+    assert r.json()["estado"] == "completado"
+
+
+def test_estado_y_eventos_de_otro_usuario_no_existen(cliente):
+    cliente, session_id = cliente
+
+    assert cliente.get(f"/ingesta/{session_id}", headers={"X-User-Id": "8"}).status_code == 404
+    assert cliente.get(f"/ingesta/{session_id}/eventos", headers={"X-User-Id": "8"}).status_code == 404
+
+
+def test_sin_usuario_se_rechaza(cliente):
+    cliente, session_id = cliente
+
+    assert cliente.get(f"/ingesta/{session_id}").status_code == 422
+    assert cliente.get(f"/ingesta/{session_id}/eventos").status_code == 422
+
+
+def test_eventos_del_propietario(cliente):
+    cliente, session_id = cliente
+    r = cliente.get(f"/ingesta/{session_id}/eventos?formato=ndjson", headers={"X-User-Id": "7"})
+
+    assert r.status_code == 200
+    assert '"estado": "en_cola"' in r.text
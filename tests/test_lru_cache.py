@@ -0,0 +1,89 @@
+import threading
+
+from api.utils.lru_cache import LRUCache
+
+
+def test_desaloja_la_menos_usada_por_entradas():
+    cache = LRUCache(max_items=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1  # "a" pasa a ser la más reciente
+    cache.put("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+
+
+def test_presupuesto_en_bytes():
+    cache = LRUCache(max_bytes=100)
+    cache.put("a", "x", size=60)
+    cache.put("b", "y", size=30)
+    cache.put("c", "z", size=30)
+
+    assert cache.get("a") is None
+    assert cache.bytes == 60
+    assert cache.stats()["entries"] == 2
+
+
+def test_valor_mayor_que_el_presupuesto_no_se_guarda():
+    cache = LRUCache(max_bytes=10)
+    cache.put("a", "x", size=5)
+    cache.put("grande", "y", size=11)
+
+    assert cache.get("grande") is None
+    assert cache.get("a") == "x"
+    assert cache.bytes == 5
+
+
+def test_reemplazar_clave_actualiza_bytes():
+    cache = LRUCache(max_bytes=100)
+    cache.put("a", "x", size=40)
+    cache.put("a", "y", size=10)
+
+    assert cache.get("a") == "y"
+    assert cache.bytes == 10
+
+
+def test_valido_descarta_entradas_obsoletas():
+    cache = LRUCache(max_items=4)
+    cache.put("a", ("firma1", 1), size=3)
+
+    assert cache.get("a", valido=lambda v: v[0] == "firma1") == ("firma1", 1)
+    assert cache.get("a", valido=lambda v: v[0] == "firma2") is None
+    # La entrada inválida se elimina, no solo se ignora
+    assert cache.get("a") is None
+    assert cache.bytes == 0
+
+
+def test_pop_where_y_contadores():
+    cache = LRUCache()
+    for clave in [("s1", 1), ("s1", 2), ("s2", 1)]:
+        cache.put(clave, clave)
+
+    assert cache.pop_where(lambda k: k[0] == "s1") == 2
+    assert cache.get(("s2", 1)) == ("s2", 1)
+    assert cache.get(("s1", 1)) is None
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["hit_ratio"]) == (1, 1, 0.5)
+
+
+def test_concurrente_respeta_limites():
+    cache = LRUCache(max_items=50, max_bytes=500)
+
+    def trabajar(base):
+        for i in range(2000):
+            cache.put((base, i % 80), i, size=7)
+            cache.get((base, (i * 7) % 80))
+
+    hilos = [threading.Thread(target=trabajar, args=(b,)) for b in range(8)]
+    for h in hilos:
+        h.start()
+    for h in hilos:
+        h.join()
+
+    stats = cache.stats()
+    assert stats["entries"] <= 50
+    assert stats["bytes"] == stats["entries"] * 7 <= 500
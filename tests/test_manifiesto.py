@@ -0,0 +1,99 @@
+import hashlib
+import json
+
+import pytest
+
+from api.services import almacenamiento_service, manifiesto_service
+
+
+@pytest.fixture
+def volumen(tmp_path, monkeypatch):
+    monkeypatch.setattr(almacenamiento_service, "BASE_STATIC_DIR", tmp_path)
+    monkeypatch.setattr(manifiesto_service, "publicar", lambda ruta, clave=None: None)
+    monkeypatch.setattr(manifiesto_service, "rehidratar", lambda ruta: False)
+    monkeypatch.setattr(manifiesto_service, "retirar", lambda ruta: None)
+    for nombre in ("MANIFIESTOS_DIR", "SERIES_DIR", "SEGMENTATIONS_2D_DIR", "SEGMENTATIONS_3D_DIR"):
+        carpeta = tmp_path / nombre.lower()
+        carpeta.mkdir()
+        monkeypatch.setattr(manifiesto_service, nombre, carpeta)
+    monkeypatch.setattr(manifiesto_service, "_manifiestos", manifiesto_service.LRUCache(max_items=8))
+    return tmp_path
+
+
+def _mascara(volumen, i):
+    ruta = volumen / "segmentations_2d_dir" / "s1" / f"image_{i}_mask.png"
+    ruta.parent.mkdir(exist_ok=True)
+    ruta.write_bytes(b"png %d" % i)
+    return ruta
+
+
+def _claves(session_id):
+    return set(manifiesto_service.leer_manifiesto(session_id)["archivos"])
+
+
+def test_slices_sueltos_van_al_diario(volumen):
+    manifiesto_service.registrar("s1", [_mascara(volumen, 0)])
+    base = manifiesto_service.ruta_manifiesto("s1")
+    contenido = base.read_bytes()
+
+    # Cada slice añade una línea; el manifiesto no se reescribe
+    for i in range(1, 4):
+        manifiesto_service.registrar("s1", [_mascara(volumen, i)])
+
+    # La primera llamada construye el manifiesto desde disco (sin hash) y
+    # anota la máscara con su hash; las siguientes, una línea cada una
+    assert base.read_bytes() == contenido
+    assert len(manifiesto_service.ruta_diario("s1").read_text().splitlines()) == 4
+    assert _claves("s1") == {f"segmentations_2d_dir/s1/image_{i}_mask.png" for i in range(4)}
+
+
+def test_compacta_al_pasar_el_maximo(volumen, monkeypatch):
+    monkeypatch.setattr(manifiesto_service, "MANIFIESTO_DIARIO_MAX", 2)
+    for i in range(3):
+        manifiesto_service.registrar("s1", [_mascara(volumen, i)])
+
+    # 0 crea el manifiesto y va al diario, 1 al diario, 2 compacta
+    assert not manifiesto_service.ruta_diario("s1").exists()
+    en_disco = json.loads(manifiesto_service.ruta_manifiesto("s1").read_text())
+    assert len(en_disco["archivos"]) == 3
+    assert all(e["sha256"] for e in en_disco["archivos"].values())
+
+
+def test_quitar_compacta_y_el_diario_viejo_no_resucita(volumen):
+    rutas = [_mascara(volumen, i) for i in range(3)]
+    manifiesto_service.registrar("s1", rutas[:1])
+    manifiesto_service.registrar("s1", rutas[1:])
+    diario = manifiesto_service.ruta_diario("s1")
+    viejo = diario.read_text()
+
+    manifiesto_service.quitar("s1", rutas[1:2])
+
+    # Un diario de la generación anterior (p. ej. un borrado que no llegó a
+    # hacerse) se ignora
+    diario.write_text(viejo)
+    assert _claves("s1") == {
+        "segmentations_2d_dir/s1/image_0_mask.png",
+        "segmentations_2d_dir/s1/image_2_mask.png",
+    }
+
+
+def test_hashes_del_llamador_no_releen(volumen, monkeypatch):
+    ruta = _mascara(volumen, 0)
+    monkeypatch.setattr(
+        manifiesto_service, "_hash_archivo", lambda r: pytest.fail("no debería releer el archivo")
+    )
+
+    manifiesto_service.registrar("s1", [ruta], hashes={ruta: "abc"})
+    assert manifiesto_service.leer_manifiesto("s1")["archivos"]["segmentations_2d_dir/s1/image_0_mask.png"]["sha256"] == "abc"
+
+
+def test_linea_a_medio_escribir_se_ignora(volumen):
+    manifiesto_service.registrar("s1", [_mascara(volumen, 0)])
+    manifiesto_service.registrar("s1", [_mascara(volumen, 1)])
+    with open(manifiesto_service.ruta_diario("s1"), "a", encoding="utf-8") as f:
+        f.write('{"generacion": "x", "archi')
+
+    assert len(_claves("s1")) == 2
+    assert manifiesto_service.leer_manifiesto("s1")["archivos"][
+        "segmentations_2d_dir/s1/image_1_mask.png"
+    ]["sha256"] == hashlib.sha256(b"png 1").hexdigest()
@@ -0,0 +1,36 @@
+import pytest
+
+from api.routers.visor_router import _parsear_rango
+
+
+@pytest.mark.parametrize(
+    "rango, esperado",
+    [
+        ("bytes=0-99", (0, 100)),
+        ("bytes=10-", (10, 1000)),
+        ("bytes=-100", (900, 1000)),
+        ("bytes=-5000", (0, 1000)),
+        ("bytes=990-5000", (990, 1000)),
+        (" bytes=0-0 ", (0, 1)),
+        ("bytes=999-999", (999, 1000)),
+    ],
+)
+def test_rangos_validos(rango, esperado):
+    assert _parsear_rango(rango, 1000) == esperado
+
+
+@pytest.mark.parametrize(
+    "rango",
+    [
+        "bytes=-",
+        "bytes=-0",
+        "bytes=1000-",
+        "bytes=50-10",
+        "bytes=0-10,20-30",
+        "items=0-10",
+        "bytes=a-b",
+        "",
+    ],
+)
+def test_rangos_invalidos(rango):
+    assert _parsear_rango(rango, 1000) is None
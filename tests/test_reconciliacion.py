@@ -0,0 +1,116 @@
+import datetime
+import time
+
+import pytest
+
+from api.services import reconciliacion_service
+
+
+class _Cursor:
+    def __init__(self, bd):
+        self.bd = bd
+        self.filas = []
+
+    def execute(self, sql, params=()):
+        self.bd.sentencias.append((sql, params))
+        if "FROM archivodicom" in sql and "ORDER BY sesion" in sql:
+            self.filas = self.bd.archivos
+        elif "protesisdimension" in sql and sql.lstrip().startswith("SELECT"):
+            self.filas = self.bd.clinicas
+        else:
+            self.filas = []
+
+    def fetchall(self):
+        return list(self.filas)
+
+    def __iter__(self):
+        return iter(self.filas)
+
+    def close(self):
+        pass
+
+
+class _BD:
+    def __init__(self):
+        self.archivos = []
+        self.clinicas = []
+        self.sentencias = []
+
+    def cursor(self, name=None):
+        return _Cursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+    def borradas(self, tabla):
+        return [p for sql, p in self.sentencias if sql.strip().startswith(f"DELETE FROM {tabla}")]
+
+
+@pytest.fixture
+def bd(tmp_path, monkeypatch):
+    bd = _BD()
+    monkeypatch.setattr(reconciliacion_service, "get_connection", lambda: bd)
+    monkeypatch.setattr(reconciliacion_service, "SERIES_DIR", tmp_path / "series")
+    monkeypatch.setattr(reconciliacion_service, "_en_backend", lambda ruta: False)
+    return bd
+
+
+HACE_UNA_SEMANA = datetime.date.today() - datetime.timedelta(days=7)
+
+
+def _fila(tmp_path, session_id, nombre, fecha=HACE_UNA_SEMANA):
+    return (session_id, str(tmp_path / "series" / session_id / nombre), fecha)
+
+
+def test_solo_sesiones_con_archivos_ausentes(bd, tmp_path):
+    presente = tmp_path / "series" / "viva" / "b.dcm"
+    presente.parent.mkdir(parents=True)
+    presente.write_bytes(b"x")
+
+    bd.archivos = [
+        _fila(tmp_path, "huerfana", "a.dcm"),
+        _fila(tmp_path, "viva", "a.dcm"),  # falta uno, pero no todos
+        _fila(tmp_path, "viva", "b.dcm"),
+    ]
+
+    hallazgos = list(reconciliacion_service._sesiones_sin_archivos(False, time.time()))
+    assert [h["session_id"] for h in hallazgos] == ["huerfana"]
+    assert not bd.borradas("archivodicom")
+
+
+def test_respeta_la_gracia(bd, tmp_path):
+    bd.archivos = [_fila(tmp_path, "reciente", "a.dcm", fecha=datetime.date.today())]
+
+    assert list(reconciliacion_service._sesiones_sin_archivos(True, time.time())) == []
+    assert not bd.borradas("archivodicom")
+
+
+def test_resultados_clinicos_solo_se_informan(bd, tmp_path):
+    bd.archivos = [_fila(tmp_path, "con_protesis", "a.dcm"), _fila(tmp_path, "sin_nada", "a.dcm")]
+    bd.clinicas = [("con_protesis", "protesisdimension"), ("con_protesis", "segmentacion3d")]
+
+    hallazgos = {h["session_id"]: h for h in reconciliacion_service._sesiones_sin_archivos(True, time.time())}
+
+    assert hallazgos["con_protesis"]["borrado"] is False
+    assert hallazgos["con_protesis"]["resultados_clinicos"] == ["protesisdimension", "segmentacion3d"]
+    assert hallazgos["sin_nada"]["borrado"] is True
+
+    # Solo se borran filas de la sesión sin resultados, y nunca las clínicas
+    assert bd.borradas("archivodicom") == [(reconciliacion_service._prefijo_series(), ["sin_nada"])]
+    assert not bd.borradas("protesisdimension")
+    assert not bd.borradas("segmentacion3d")
+
+
+def test_filas_fuera_de_series_dir_no_se_consultan(bd, tmp_path):
+    list(reconciliacion_service._sesiones_sin_archivos(False, time.time()))
+
+    sql, params = bd.sentencias[0]
+    assert "rutaarchivo LIKE %s" in sql
+    assert params == (reconciliacion_service._prefijo_series(),)
+    assert params[0].startswith(str(tmp_path).replace("_", "\\_"))
@@ -0,0 +1,99 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+from api.services import render_service
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    series = tmp_path / "series"
+    (series / "s1").mkdir(parents=True)
+    mapping = {}
+    for i in range(6):
+        (series / "s1" / f"{i}.dcm").write_bytes(b"dicom")
+        mapping[f"image_{i}.png"] = {"dicom_name": f"{i}.dcm", "cas": None}
+
+    monkeypatch.setattr(render_service, "SERIES_DIR", series)
+    monkeypatch.setattr(render_service, "RENDER_CACHE_DIR", tmp_path / "render_cache")
+    monkeypatch.setattr(render_service, "cargar_mapping", lambda sid: mapping)
+    rng = np.random.default_rng(0)
+    monkeypatch.setattr(
+        render_service, "leer_slice_dicom", lambda ruta: (None, rng.integers(0, 4000, (64, 64)))
+    )
+    monkeypatch.setattr(render_service, "_indice", OrderedDict())
+    monkeypatch.setattr(render_service, "_indice_at", None)
+    monkeypatch.setattr(render_service, "_stats", dict(render_service._stats, bytes=0, evictions=0))
+    return mapping
+
+
+def _bytes_en_disco(raiz):
+    return sum(os.path.getsize(os.path.join(r, f)) for r, _, fs in os.walk(raiz) for f in fs)
+
+
+def test_desalojo_lru_sin_recorrer_el_directorio(cache, monkeypatch):
+    primero = render_service.renderizar_slice("s1", "image_0.png")
+    tamano = primero.stat().st_size
+    monkeypatch.setattr(render_service, "RENDER_CACHE_MAX_BYTES", int(tamano * 3.5))
+
+    recorridos = []
+    walk = os.walk
+    monkeypatch.setattr(render_service.os, "walk", lambda *a, **k: recorridos.append(a) or walk(*a, **k))
+
+    for i in range(1, 4):
+        render_service.renderizar_slice("s1", f"image_{i}.png")
+    # Acierto: image_1 pasa a ser la más reciente
+    assert render_service.ruta_slice_cacheada("s1", "image_1.png") is not None
+    render_service.renderizar_slice("s1", "image_4.png")
+
+    assert recorridos == []
+    assert render_service.ruta_slice_cacheada("s1", "image_0.png") is None
+    assert render_service.ruta_slice_cacheada("s1", "image_1.png") is not None
+    stats = render_service.estadisticas_render()
+    assert stats["evictions"] >= 1
+    assert stats["bytes"] == _bytes_en_disco(render_service.RENDER_CACHE_DIR)
+    assert stats["bytes"] <= render_service.RENDER_CACHE_MAX_BYTES
+
+
+def test_resincroniza_con_archivos_borrados_por_otros(cache, monkeypatch):
+    for i in range(3):
+        render_service.renderizar_slice("s1", f"image_{i}.png")
+    # Otro proceso (o el presupuesto de disco) borra un render
+    os.remove(render_service._ruta_render("s1", "image_0.png"))
+
+    monkeypatch.setattr(render_service, "_indice_at", None)
+    render_service.renderizar_slice("s1", "image_3.png")
+
+    assert render_service.estadisticas_render()["bytes"] == _bytes_en_disco(render_service.RENDER_CACHE_DIR)
+
+
+def test_invalidar_borra_solo_los_no_compartidos(cache, tmp_path):
+    for i in range(3):
+        render_service.renderizar_slice("s1", f"image_{i}.png")
+    # image_1 viene del CAS (enlace del almacén + serie); image_2 además lo enlaza otra sesión
+    cas = tmp_path / "cas"
+    cas.mkdir()
+    for i in (1, 2):
+        cache[f"image_{i}.png"]["cas"] = f"clave{i}"
+        os.link(render_service.SERIES_DIR / "s1" / f"{i}.dcm", cas / f"{i}.dcm")
+    os.link(render_service.SERIES_DIR / "s1" / "2.dcm", tmp_path / "otra_sesion.dcm")
+
+    rutas = {i: render_service._ruta_render("s1", f"image_{i}.png") for i in range(3)}
+    assert render_service.invalidar_renders("s1") == 2
+
+    assert not rutas[0].exists()
+    assert not rutas[1].exists()
+    assert rutas[2].exists()
+    assert render_service.estadisticas_render()["bytes"] == _bytes_en_disco(render_service.RENDER_CACHE_DIR)
+
+
+def test_locks_de_atlas_no_se_acumulan(cache, monkeypatch):
+    (render_service.SERIES_DIR / "s1" / "mapping.json").write_text("{}")
+    monkeypatch.setattr(render_service, "_generar_atlas", lambda sid, lado, carpeta, firma: {})
+
+    for lado in range(32, 64):
+        render_service.obtener_atlas("s1", lado)
+
+    assert len(render_service._atlas_locks) == 0
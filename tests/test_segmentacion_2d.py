@@ -0,0 +1,119 @@
+import inspect
+
+import numpy as np
+import pytest
+from skimage import measure, morphology
+from skimage.measure import regionprops
+
+from api.services.segmentation_services import segmentar_stack_2d
+
+
+def _quitar_pequenos(mascara, min_size):
+    # Quita objetos con área < min_size (semántica de skimage 0.25). Desde
+    # 0.26 `min_size` está obsoleto y su reemplazo, max_size, quita <=
+    if "max_size" in inspect.signature(morphology.remove_small_objects).parameters:
+        return morphology.remove_small_objects(mascara, max_size=min_size - 1)
+    return morphology.remove_small_objects(mascara, min_size=min_size)
+
+
+def _segmentar_por_slice(imagen, umbral, min_size):
+    # Ruta original (un slice cada vez): umbral + remove_small_objects +
+    # label + mayor región de regionprops
+    mascara = _quitar_pequenos(imagen > umbral, min_size)
+
+    etiquetas = measure.label(mascara)
+    props = regionprops(etiquetas)
+    if not props:
+        return None
+
+    r = max(props, key=lambda r: r.area)
+    return {
+        "mascara": etiquetas == r.label,
+        "area": r.area,
+        "bbox": r.bbox,
+        "perimetro": r.perimeter,
+    }
+
+
+def _stack_sintetico():
+    stack = np.zeros((6, 64, 80), dtype=np.int16)
+
+    # 0: varias componentes de distinto tamaño, una demasiado pequeña
+    stack[0, 5:20, 5:30] = 800
+    stack[0, 30:60, 40:75] = 900
+    stack[0, 2:4, 70:72] = 1000
+
+    # 1: vacío (todo por debajo del umbral)
+    stack[1] = 100
+
+    # 2: región que toca los cuatro bordes, con un hueco
+    stack[2] = 700
+    stack[2, 20:30, 20:30] = 0
+
+    # 3: empate de áreas (gana la primera en orden raster)
+    stack[3, 40:50, 10:30] = 500
+    stack[3, 5:15, 50:70] = 500
+
+    # 4: formas irregulares y conexiones solo en diagonal (conectividad 8)
+    yy, xx = np.mgrid[:64, :80]
+    stack[4][(yy - 32) ** 2 + (xx - 25) ** 2 < 150] = 600
+    stack[4][(yy - 20) ** 2 / 4 + (xx - 60) ** 2 < 80] = 600
+    for k in range(20):
+        stack[4, 40 + k, 45 + k] = 600
+        stack[4, 40 + k, 46 + k] = 600
+
+    # 5: ruido aleatorio umbralizado
+    rng = np.random.default_rng(7)
+    stack[5] = (rng.random((64, 80)) > 0.45) * 700
+    return stack
+
+
+@pytest.mark.parametrize("min_size", [1, 20, 150])
+def test_stack_coincide_con_regionprops_por_slice(min_size):
+    stack = _stack_sintetico()
+    umbral = 400
+
+    seg = segmentar_stack_2d(stack, umbral=umbral, min_size=min_size)
+
+    for i, imagen in enumerate(stack):
+        esperado = _segmentar_por_slice(imagen, umbral, min_size)
+        if esperado is None:
+            assert not seg["valido"][i]
+            assert not seg["mascaras"][i].any()
+            assert seg["area"][i] == 0
+            assert tuple(seg["bbox"][i]) == (0, 0, 0, 0)
+            assert seg["perimetro"][i] == 0
+            continue
+
+        assert seg["valido"][i]
+        np.testing.assert_array_equal(seg["mascaras"][i], esperado["mascara"])
+        assert seg["area"][i] == esperado["area"]
+        assert tuple(int(v) for v in seg["bbox"][i]) == esperado["bbox"]
+        assert seg["perimetro"][i] == pytest.approx(esperado["perimetro"], abs=1e-9)
+
+
+def test_slices_vacios_y_borde():
+    stack = _stack_sintetico()
+    seg = segmentar_stack_2d(stack, umbral=400, min_size=150)
+
+    assert not seg["valido"][1]
+    # El slice que toca el borde conserva la caja completa
+    assert tuple(int(v) for v in seg["bbox"][2]) == (0, 0, 64, 80)
+
+
+def test_slice_suelto_2d():
+    imagen = _stack_sintetico()[0]
+    seg = segmentar_stack_2d(imagen, umbral=400, min_size=20)
+    esperado = _segmentar_por_slice(imagen, 400, 20)
+
+    assert seg["mascaras"].shape == (1,) + imagen.shape
+    assert seg["area"][0] == esperado["area"]
+    assert seg["perimetro"][0] == pytest.approx(esperado["perimetro"], abs=1e-9)
+
+
+def test_stack_todo_vacio():
+    seg = segmentar_stack_2d(np.zeros((3, 16, 16), dtype=np.int16), umbral=400, min_size=1)
+
+    assert not seg["valido"].any()
+    assert not seg["mascaras"].any()
+    assert seg["perimetro"].tolist() == [0.0, 0.0, 0.0]
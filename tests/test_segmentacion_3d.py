@@ -0,0 +1,135 @@
+import numpy as np
+import pytest
+from scipy.ndimage import median_filter
+from skimage.filters import threshold_otsu
+
+from api.services.segmentation3d_service import _mascara_umbral, _volumen_a_umbralizar
+from api.services.volumen_service import calcular_estadisticas
+
+
+def _umbral_original(vol, modality, preset=None):
+    # Algoritmo original: mediana sobre float32 en volúmenes grandes y
+    # percentiles / Otsu calculados sobre ese mismo volumen filtrado
+    vol = vol.astype(np.float32)
+    if vol.size > 2_000_000:
+        vol = median_filter(vol, size=3)
+
+    v = vol[np.isfinite(vol)]
+    if v.size == 0:
+        return np.zeros_like(vol, dtype=bool)
+    if modality == "CT":
+        if preset == "ct_bone":
+            return (vol >= 250) & (vol <= 4000)
+        lo, hi = np.percentile(v, [40, 99])
+        return (vol > lo) & (vol < hi)
+
+    lo, hi = np.percentile(v, [2, 98])
+    vclip = np.clip(vol, lo, hi)
+    vclip = (vclip - lo) / (hi - lo + 1e-6)
+    return vclip > threshold_otsu(vclip)
+
+
+def _volumen_sintetico(forma, fondo, tejido, hueso, ruido, seed):
+    rng = np.random.default_rng(seed)
+    zz, yy, xx = np.indices(forma)
+    cz, cy, cx = (np.array(forma) - 1) / 2.0
+    r = np.sqrt(((zz - cz) * 3) ** 2 + (yy - cy) ** 2 + (xx - cx) ** 2)
+
+    vol = np.full(forma, fondo, dtype=np.float32)
+    vol[r < min(forma[1:]) * 0.45] = tejido
+    vol[(r > min(forma[1:]) * 0.30) & (r < min(forma[1:]) * 0.36)] = hueso
+    vol += rng.normal(0, ruido, forma)
+    return np.round(vol).astype(np.int16)
+
+
+@pytest.mark.parametrize(
+    "modality, preset, niveles",
+    [
+        ("CT", None, (-1000, 40, 900, 60)),
+        ("CT", "ct_bone", (-1000, 40, 900, 60)),
+        ("MR", None, (0, 300, 900, 80)),
+    ],
+)
+def test_volumen_grande_coincide_con_el_algoritmo_original(modality, preset, niveles):
+    vol = _volumen_sintetico((36, 240, 250), *niveles, seed=3)
+    assert vol.size > 2_000_000
+
+    # Las estadísticas guardadas de la serie son las del volumen sin filtrar:
+    # con el filtro de mediana no deben usarse
+    def estadisticas_sin_filtrar():
+        raise AssertionError("el volumen filtrado necesita sus propias estadísticas")
+
+    filtrado, stats = _volumen_a_umbralizar(vol, estadisticas_sin_filtrar)
+    mascara = _mascara_umbral(filtrado, modality, stats, preset)
+
+    esperada = _umbral_original(vol, modality, preset)
+    assert mascara.any()
+    np.testing.assert_array_equal(mascara, esperada)
+
+
+@pytest.mark.parametrize("modality", ["CT", "MR"])
+def test_volumen_pequeno_usa_las_estadisticas_de_la_serie(modality):
+    vol = _volumen_sintetico((10, 64, 64), 0, 300, 900, 80, seed=5)
+
+    filtrado, stats = _volumen_a_umbralizar(vol, lambda: calcular_estadisticas(vol))
+    np.testing.assert_array_equal(filtrado, vol.astype(np.float32))
+    np.testing.assert_array_equal(
+        _mascara_umbral(filtrado, modality, stats, None), _umbral_original(vol, modality)
+    )
+
+
+# ==============================================================
+# Spacing de las mallas regeneradas
+# ==============================================================
+
+def _sin_volumen(session_id):
+    raise AssertionError("no debería cargar el volumen")
+
+
+def test_espaciado_guardado_tiene_prioridad(monkeypatch):
+    from api.services import segmentation3d_service, volumen_service
+
+    monkeypatch.setattr(segmentation3d_service, "espaciado_serie", lambda sid: (9.0, 9.0, 9.0))
+    monkeypatch.setattr(volumen_service, "cargar_volumen", _sin_volumen)
+
+    assert segmentation3d_service.espaciado_malla("s1", (2.5, 0.7, 0.7)) == (2.5, 0.7, 0.7)
+
+
+def test_filas_sin_espaciado_usan_el_indice_y_luego_el_volumen(monkeypatch):
+    from api.services import segmentation3d_service, volumen_service
+
+    monkeypatch.setattr(segmentation3d_service, "espaciado_serie", lambda sid: (3.0, 0.5, 0.5))
+    monkeypatch.setattr(volumen_service, "cargar_volumen", _sin_volumen)
+    assert segmentation3d_service.espaciado_malla("s1", (None, None, None)) == (3.0, 0.5, 0.5)
+
+    monkeypatch.setattr(segmentation3d_service, "espaciado_serie", lambda sid: None)
+    monkeypatch.setattr(
+        volumen_service, "cargar_volumen", lambda sid: (None, {"spacing": [1.0, 0.8, 0.8]})
+    )
+    assert segmentation3d_service.espaciado_malla("s1") == (1.0, 0.8, 0.8)
+
+
+def test_regenerar_stl_usa_el_espaciado_guardado(tmp_path, monkeypatch):
+    from unittest import mock
+
+    from api.services import segmentation3d_service, volumen_service
+
+    mask = np.zeros((6, 8, 8), dtype=np.uint8)
+    mask[2:4, 2:6, 2:6] = 1
+    ruta_mask = tmp_path / "mask.npy"
+    np.save(ruta_mask, mask)
+
+    conn = mock.MagicMock()
+    conn.cursor.return_value.fetchone.return_value = ("s1", 2.5, 0.7, 0.6)
+    monkeypatch.setattr(segmentation3d_service, "get_connection", lambda: conn)
+    monkeypatch.setattr(segmentation3d_service, "ruta_referenciada", lambda propietario, rol: ruta_mask)
+    monkeypatch.setattr(segmentation3d_service, "espaciado_serie", lambda sid: pytest.fail("usa el índice"))
+    monkeypatch.setattr(volumen_service, "cargar_volumen", _sin_volumen)
+
+    destino = tmp_path / "regenerado.stl"
+    segmentation3d_service._regenerar_artefacto_seg3d("1", "stl", destino)
+
+    esperado = tmp_path / "original.stl"
+    verts, faces = segmentation3d_service._malla(mask > 0, (2.5, 0.7, 0.6))
+    segmentation3d_service._save_ascii_stl(verts, faces, str(esperado))
+    assert destino.read_bytes() == esperado.read_bytes()
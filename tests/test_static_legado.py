@@ -0,0 +1,42 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from api.services import derivados_service
+
+
+@pytest.fixture
+def cliente(tmp_path, monkeypatch):
+    series = tmp_path / "series"
+    (series / "s1").mkdir(parents=True)
+    monkeypatch.setattr(derivados_service, "BASE_STATIC_DIR", tmp_path)
+    monkeypatch.setattr(derivados_service, "SERIES_DIR", series)
+    monkeypatch.setattr(derivados_service, "rehidratar_serie", lambda session_id: False)
+    monkeypatch.setattr(derivados_service, "rehidratar", lambda ruta: False)
+
+    app = FastAPI()
+    app.mount("/static", derivados_service.StaticConRegeneracion(directory=tmp_path), name="static")
+    return TestClient(app, follow_redirects=False), series
+
+
+def test_png_antiguo_redirige_al_render(cliente):
+    cliente, _ = cliente
+    r = cliente.get("/static/series/s1/image_3.png")
+
+    assert r.status_code == 301
+    assert r.headers["location"] == "/series/s1/imagenes/image_3.png"
+
+
+def test_png_antiguo_en_disco_se_sirve(cliente):
+    cliente, series = cliente
+    (series / "s1" / "image_0.png").write_bytes(b"png")
+
+    r = cliente.get("/static/series/s1/image_0.png")
+    assert r.status_code == 200
+    assert r.content == b"png"
+
+
+@pytest.mark.parametrize("ruta", ["/static/series/s1/mapping.json", "/static/series/s1/otro.png", "/static/otra/s1/image_0.png"])
+def test_otras_rutas_siguen_en_404(cliente, ruta):
+    cliente, _ = cliente
+    assert cliente.get(ruta).status_code == 404
@@ -0,0 +1,202 @@
+import io
+import os
+import zipfile
+
+import pytest
+
+from api.services.upload_service import _completar_extraccion, _extraer_completos
+
+
+def _zip(miembros, streaming=False):
+    buffer = io.BytesIO()
+    destino = _NoSeekable(buffer) if streaming else buffer
+    with zipfile.ZipFile(destino, "w") as zf:
+        for nombre, datos, metodo in miembros:
+            zf.writestr(zipfile.ZipInfo(nombre), datos, compress_type=metodo)
+    return buffer.getvalue()
+
+
+class _NoSeekable(io.RawIOBase):
+    # zipfile escribe los tamaños en un data descriptor si no puede volver atrás
+    def __init__(self, buffer):
+        self.buffer = buffer
+
+    def writable(self):
+        return True
+
+    def write(self, datos):
+        return self.buffer.write(datos)
+
+
+MIEMBROS = [
+    ("serie/a.dcm", b"A" * 5000, zipfile.ZIP_STORED),
+    ("serie/b.dcm", os.urandom(3000) + b"B" * 20000, zipfile.ZIP_DEFLATED),
+    ("otra/a.dcm", b"", zipfile.ZIP_STORED),
+    ("serie/sub/", b"", zipfile.ZIP_STORED),
+    ("serie/c.dcm", b"C" * 12345, zipfile.ZIP_DEFLATED),
+]
+
+
+def _subida(tmp_path):
+    (tmp_path / "miembros").mkdir()
+    (tmp_path / "datos.zip.part").write_bytes(b"")
+    return {"recibido": 0, "cursor_zip": 0, "extraccion_incremental": True, "miembros": []}
+
+
+def _recibir(tmp_path, estado, contenido, hasta):
+    with open(tmp_path / "datos.zip.part", "ab") as f:
+        f.write(contenido[estado["recibido"]:hasta])
+    estado["recibido"] = hasta
+    _extraer_completos(tmp_path, estado)
+
+
+@pytest.mark.parametrize("chunk", [1, 777, 4096, 10 ** 6])
+def test_extrae_miembros_a_medida_que_llegan(tmp_path, chunk):
+    contenido = _zip(MIEMBROS)
+    estado = _subida(tmp_path)
+
+    extraidos_por_paso = []
+    for hasta in range(chunk, len(contenido) + chunk, chunk):
+        _recibir(tmp_path, estado, contenido, min(hasta, len(contenido)))
+        extraidos_por_paso.append(len(estado["miembros"]))
+
+    esperados = [(n, d) for n, d, _ in MIEMBROS if not n.endswith("/")]
+    assert [m["nombre"] for m in estado["miembros"]] == [n for n, _ in esperados]
+    for m, (_, datos) in zip(estado["miembros"], esperados):
+        with open(m["ruta"], "rb") as f:
+            assert f.read() == datos
+
+    # Al llegar al directorio central la pasada incremental termina
+    assert estado["extraccion_incremental"] is False
+    if chunk < len(contenido):
+        assert extraidos_por_paso[0] < len(esperados)
+
+
+def test_no_extrae_miembros_incompletos(tmp_path):
+    contenido = _zip(MIEMBROS)
+    estado = _subida(tmp_path)
+
+    # Cabecera del primero completa, pero no su contenido
+    _recibir(tmp_path, estado, contenido, 30 + len("serie/a.dcm") + 100)
+    assert estado["miembros"] == []
+    assert estado["cursor_zip"] == 0
+    assert estado["extraccion_incremental"] is True
+
+
+def test_data_descriptor_se_deja_para_finalizar(tmp_path):
+    contenido = _zip(MIEMBROS, streaming=True)
+    estado = _subida(tmp_path)
+    _recibir(tmp_path, estado, contenido, len(contenido))
+
+    assert estado["miembros"] == []
+    assert estado["extraccion_incremental"] is False
+
+    archivos = _completar_extraccion(tmp_path, tmp_path / "datos.zip.part", estado)
+    assert [n for n, _ in archivos] == [n for n, _, _ in MIEMBROS if not n.endswith("/")]
+
+
+def test_completar_reutiliza_lo_extraido(tmp_path):
+    contenido = _zip(MIEMBROS)
+    estado = _subida(tmp_path)
+    _recibir(tmp_path, estado, contenido, len(contenido) // 2)
+    ya_extraidos = list(estado["miembros"])
+    _recibir(tmp_path, estado, contenido, len(contenido))
+
+    archivos = _completar_extraccion(tmp_path, tmp_path / "datos.zip.part", estado)
+
+    rutas = dict(archivos)
+    for m in ya_extraidos:
+        assert rutas[m["nombre"]] == m["ruta"]
+    # Mismo basename en carpetas distintas: rutas distintas
+    assert rutas["serie/a.dcm"] != rutas["otra/a.dcm"]
+
+
+def test_finalizar_reintentable_si_falla_la_ingesta(tmp_path, monkeypatch):
+    from api.services import upload_service
+
+    monkeypatch.setattr(upload_service, "UPLOADS_DIR", tmp_path)
+    contenido = _zip(MIEMBROS)
+    estado = upload_service.crear_upload("serie.zip", len(contenido), user_id=1)
+    upload_id = estado["upload_id"]
+    upload_service.escribir_chunk(upload_id, 1, 0, contenido)
+
+    def falla(*args, **kwargs):
+        raise RuntimeError("pool cerrado")
+
+    monkeypatch.setattr(upload_service, "iniciar_ingesta_series", falla)
+    with pytest.raises(RuntimeError):
+        upload_service.finalizar_upload(upload_id, 1)
+    assert (tmp_path / upload_id / "datos.zip.part").is_file()
+
+    recibidos = []
+
+    def acepta(archivos, user_id, limpiar):
+        recibidos.extend(archivos)
+        return [{"session_id": "s1", "series_instance_uid": None, "n_archivos": None}]
+
+    monkeypatch.setattr(upload_service, "iniciar_ingesta_series", acepta)
+    estado = upload_service.finalizar_upload(upload_id, 1)
+
+    assert estado["session_id"] == "s1"
+    assert [n for n, _ in recibidos] == [n for n, _, _ in MIEMBROS if not n.endswith("/")]
+    assert not (tmp_path / upload_id / "datos.zip.part").exists()
+    # Repetir finalize devuelve la misma sesión sin volver a leer el ZIP
+    assert upload_service.finalizar_upload(upload_id, 1)["session_id"] == "s1"
+
+
+def test_staging_fuera_del_volumen_publico():
+    from config.paths import BASE_STATIC_DIR, UPLOADS_DIR
+
+    assert BASE_STATIC_DIR not in UPLOADS_DIR.parents
+
+
+def _bomba():
+    # 64 MiB de ceros comprimen a ~64 KiB
+    return _zip([("serie/bomba.dcm", bytes(64 * 1024 * 1024), zipfile.ZIP_DEFLATED)])
+
+
+def test_zip_bomb_se_rechaza_al_extraer(tmp_path, monkeypatch):
+    from api.services import upload_service
+
+    monkeypatch.setattr(upload_service, "UPLOAD_MAX_DESCOMPRIMIDO_BYTES", 8 * 1024 * 1024)
+    contenido = _bomba()
+    estado = _subida(tmp_path)
+
+    with pytest.raises(ValueError):
+        _recibir(tmp_path, estado, contenido, len(contenido))
+    assert estado["miembros"] == []
+    assert list((tmp_path / "miembros").iterdir()) == []
+
+
+def test_zip_bomb_se_rechaza_al_finalizar(tmp_path, monkeypatch):
+    from api.services import upload_service
+
+    monkeypatch.setattr(upload_service, "UPLOAD_MAX_DESCOMPRIMIDO_BYTES", 8 * 1024 * 1024)
+    contenido = _bomba()
+    estado = _subida(tmp_path)
+    (tmp_path / "datos.zip.part").write_bytes(contenido)
+    estado["extraccion_incremental"] = False
+
+    with pytest.raises(ValueError):
+        _completar_extraccion(tmp_path, tmp_path / "datos.zip.part", estado)
+    assert list((tmp_path / "miembros").iterdir()) == []
+
+
+def test_el_limite_cuenta_toda_la_subida(tmp_path, monkeypatch):
+    from api.services import upload_service
+
+    total = sum(len(d) for _, d, _ in MIEMBROS)
+    monkeypatch.setattr(upload_service, "UPLOAD_MAX_DESCOMPRIMIDO_BYTES", total)
+    contenido = _zip(MIEMBROS)
+    estado = _subida(tmp_path)
+    _recibir(tmp_path, estado, contenido, len(contenido))
+    assert estado["descomprimido"] == total
+
+    # Un byte menos: el último miembro ya no cabe
+    monkeypatch.setattr(upload_service, "UPLOAD_MAX_DESCOMPRIMIDO_BYTES", total - 1)
+    otra = tmp_path / "otra"
+    otra.mkdir()
+    estado = _subida(otra)
+    with pytest.raises(ValueError):
+        _recibir(otra, estado, contenido, len(contenido))
+    assert [m["nombre"] for m in estado["miembros"]] == ["serie/a.dcm", "serie/b.dcm", "otra/a.dcm"]